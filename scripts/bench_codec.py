@@ -0,0 +1,76 @@
+"""Benchmark the json codec against the stdlib json on synthetic gmeta pages.
+
+usage: python scripts/bench_codec.py [n_entries]
+"""
+import json
+import sys
+import time
+from collections.abc import Callable
+from typing import Any
+
+from metadata_migrate_sync import codec
+
+
+def synthetic_page(n_entries: int, with_floats: bool) -> list[dict[str, Any]]:
+    """Gmeta entries of files, the dataset-like ones carry the float bounds."""
+    page = []
+    for n in range(n_entries):
+        path = f"CMIP6/CMIP/NCAR/CESM2/historical/r{n}i1p1f1/Amon/tas/gn/v20190308/tas_{n}.nc"
+        content: dict[str, Any] = {
+            "id": f"{path.replace('/', '.')}|esgf-node.ornl.gov",
+            "project": ["CMIP6"],
+            "variable_id": ["tas"],
+            "size": 1_000_000 + n,
+            "checksum": [f"{n:064x}"],
+            "url": [f"https://esgf-node.ornl.gov/thredds/fileServer/{path}|application/netcdf|HTTPServer"],
+            "latest": True,
+            "_timestamp": "2024-05-01T00:00:00Z",
+        }
+        if with_floats:
+            content.update({"north_degrees": 90.0, "south_degrees": -90.0, "west_degrees": 0.0})
+        page.append({"id": "file", "subject": content["id"], "visible_to": ["public"], "content": content})
+    return page
+
+
+def _time(fn: Callable[[], Any], repeat: int = 3) -> tuple[float, Any]:
+    """The best time of a few runs and the result."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main(n_entries: int) -> None:
+    """Time the codec and json on the pages without and with floats."""
+    print(f"codec backend: {codec.CodecConfig.BACKEND}")
+    for with_floats in (False, True):
+        page = synthetic_page(n_entries, with_floats)
+        text = json.dumps(page)
+        print(f"\n{n_entries} entries, {len(text)} bytes, floats: {with_floats}")
+
+        # the stored strings and sizes are json.dumps, checked against it
+        cases = {
+            "encoded_size": (lambda: [len(json.dumps(g)) for g in page],
+                             lambda: [codec.encoded_size(g) for g in page]),
+            "fingerprint": (
+                lambda: [json.dumps(g, sort_keys=True, separators=(",", ":"), default=str) for g in page],
+                lambda: [codec.dumps(g, compact=True, sort_keys=True, default=str) for g in page],
+            ),
+            "loads": (lambda: json.loads(text), lambda: codec.loads(text)),
+            "round trip": (
+                lambda: json.loads(json.dumps(page).encode("utf-8")),
+                lambda: codec.loads(codec.dumpb(page)),
+            ),
+        }
+        for name, (stdlib, fast) in cases.items():
+            t_json, expected = _time(stdlib)
+            t_codec, result = _time(fast)
+            if result != expected:
+                raise ValueError(f"{name}: the codec output differs")
+            print(f"{name:13}: json {t_json:7.3f}s  codec {t_codec:7.3f}s  speedup {t_json / t_codec:6.2f}x")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
@@ -0,0 +1,135 @@
+"""Compare the database sizes of the storage modes on a synthetic migration.
+
+usage: python scripts/bench_db_size.py [n_files] [output_dir]
+
+The files, ingest and query rows of n_files files (pages of 1000 files,
+one ingest per page) are written as prov_collect writes them in every
+StorageConfig mode, and the sizes of the database files are reported.
+"""
+import pathlib
+import sys
+import tempfile
+import time
+from collections.abc import Iterator
+from typing import Any
+
+from sqlalchemy import create_engine, text
+
+from metadata_migrate_sync.database import (
+    FILES_VIEW,
+    Base,
+    Files,
+    FilesCompact,
+    Index,
+    Ingest,
+    Query,
+    StorageConfig,
+    compact_uri,
+)
+from metadata_migrate_sync.ingest import _stored_response
+
+PAGE_SIZE = 1000
+SOURCE = "https://esgf-node.ornl.gov/esg-search/search"
+TARGET = "a37bc34d-de15-493b-9221-b95b13114fd8"
+
+
+def synthetic_page(page: int) -> Iterator[dict[str, Any]]:
+    """The files rows of a page, with the three urls of a CMIP6 file."""
+    for n in range(page * PAGE_SIZE, (page + 1) * PAGE_SIZE):
+        path = f"CMIP6/CMIP/NCAR/CESM2/historical/r{n % 50}i1p1f1/Amon/tas/gn/v20190308/tas_{n}.nc"
+        uri = ",".join([
+            f"https://esgf-node.ornl.gov/thredds/fileServer/css03_data/{path}|application/netcdf|HTTPServer",
+            f"globus:dea29ae8-bb92-4c0a-a2f4-ba0d3fcd2b91/css03_data/{path}|Globus|Globus",
+            f"https://esgf-node.ornl.gov/thredds/dodsC/css03_data/{path}.html"
+            "|application/opendap-html|OPENDAP",
+        ])
+        yield {
+            "files_id": f"{path.replace('/', '.')}|esgf-node.ornl.gov",
+            "size": 1_000_000 + n,
+            "uri": uri,
+            "success": 0,
+            "error": None,
+        }
+
+
+def _response(page: int) -> dict[str, Any]:
+    return {
+        "acknowledged": True,
+        "success": True,
+        "task_id": f"a04ae23d-6fd4-42af-b52c-{page:012d}",
+        "num_documents_ingested": PAGE_SIZE,
+        "as_identity": "urn:globus:auth:identity:8b5c7bd8-5a64-4ff6-9e35-3b1a4e6a2b09",
+        "request_id": f"{page:032x}",
+        "http_status": 200,
+    }
+
+
+def write_db(db_file: pathlib.Path, mode: str, n_files: int) -> float:
+    """Write the rows of the synthetic migration in a storage mode."""
+    StorageConfig.MODE = mode
+    engine = create_engine(f"sqlite:///{db_file}")
+    Base.metadata.create_all(engine)
+
+    start = time.perf_counter()
+    with engine.begin() as conn:
+        conn.execute(text(FILES_VIEW))
+        conn.execute(Index.__table__.insert(), [
+            {"id": 1, "index_id": SOURCE, "index_name": "ornl", "index_type": "solr"},
+            {"id": 2, "index_id": TARGET, "index_name": "public", "index_type": "globus"},
+        ])
+
+        for page in range(n_files // PAGE_SIZE):
+            conn.execute(Query.__table__.insert(), {
+                "project": "CMIP6", "project_type": "readonly", "query_str": f'{{"offset": {page}}}',
+                "pages": page + 1, "index_id": SOURCE, "n_files": PAGE_SIZE,
+            })
+            rows = list(synthetic_page(page))
+            if mode == "full":
+                conn.execute(Files.__table__.insert(), [
+                    {**row, "pages": page + 1, "source_index": SOURCE, "target_index": TARGET}
+                    for row in rows
+                ])
+            else:
+                conn.execute(FilesCompact.__table__.insert(), [
+                    {
+                        "pages": page + 1,
+                        "files_id": row["files_id"],
+                        "size": row["size"],
+                        "source_key": 1,
+                        "target_key": 2,
+                        "success": row["success"],
+                        "error": row["error"],
+                        **compact_uri(row["uri"], keep=mode == "compact"),
+                    }
+                    for row in rows
+                ])
+            response = _response(page)
+            conn.execute(Ingest.__table__.insert(), {
+                "pages": page + 1, "n_ingested": PAGE_SIZE, "n_files": PAGE_SIZE, "index_id": TARGET,
+                "task_id": response["task_id"], "ingest_response": _stored_response(response),
+                "submitted": 1,
+            })
+    engine.dispose()
+    return time.perf_counter() - start
+
+
+def main(n_files: int, output_dir: str | None) -> None:
+    """Write and measure the databases one after the other."""
+    with tempfile.TemporaryDirectory(dir=output_dir) as tmp:
+        sizes = {}
+        for mode in ("full", "compact", "hashed"):
+            db_file = pathlib.Path(tmp) / f"{mode}.sqlite"
+            elapsed = write_db(db_file, mode, n_files)
+            sizes[mode] = db_file.stat().st_size
+            print(
+                f"{mode:8}: {sizes[mode] / 1e6:10.1f} MB  {sizes[mode] / n_files:6.1f} B/file  "
+                f"{sizes['full'] / sizes[mode]:5.2f}x smaller  written in {elapsed:6.1f}s"
+            )
+            db_file.unlink()
+
+
+if __name__ == "__main__":
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 10_000_000,
+        sys.argv[2] if len(sys.argv) > 2 else None,
+    )
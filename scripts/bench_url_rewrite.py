@@ -0,0 +1,62 @@
+"""Benchmark the url rewriting of the replication on synthetic file urls.
+
+usage: python scripts/bench_url_rewrite.py [n_urls]
+"""
+import sys
+import time
+
+from metadata_migrate_sync.convert import GLOBUS_IDS, _process_urls, get_url_rewriter
+
+SOURCE_NODES = ["esgf-data1.llnl.gov", "esgf-data2.llnl.gov", "aims3.llnl.gov"]
+
+
+def synthetic_files(n_urls: int) -> list[list[str]]:
+    """Url lists of files, half with the thredds urls and half with the globus url only."""
+    files: list[list[str]] = []
+    total = 0
+    n = 0
+    while total < n_urls:
+        n += 1
+        node = SOURCE_NODES[n % len(SOURCE_NODES)]
+        path = f"/css03_data/CMIP6/CMIP/NCAR/CESM2/historical/r{n}i1p1f1/Amon/tas/gn/v20190308/tas_{n}.nc"
+        globus = f"globus:415a6320-e49c-11e5-9798-22000b9da45e{path}|Globus|Globus"
+        if n % 2:
+            urls = [globus]
+        else:
+            urls = [
+                f"https://{node}/thredds/fileServer{path}|application/netcdf|HTTPServer",
+                f"https://{node}/thredds/dodsC{path}.html|application/opendap-html|OPENDAP",
+                f"gsiftp://{node}:2811{path}|application/gridftp|GridFTP",
+                globus,
+            ]
+        files.append(urls)
+        total += len(urls)
+    return files
+
+
+def main(n_urls: int) -> None:
+    """Time the regex rewrite and the url rewriter on the same synthetic files."""
+    files = synthetic_files(n_urls)
+    total = sum(len(urls) for urls in files)
+    data_node, globus_uuid = "esgf-node.ornl.gov", GLOBUS_IDS["ornl"]
+
+    start = time.perf_counter()
+    expected = [_process_urls(urls, data_node, globus_uuid) for urls in files]
+    t_regex = time.perf_counter() - start
+
+    rewriter = get_url_rewriter(data_node, globus_uuid)
+    start = time.perf_counter()
+    result = [rewriter.rewrite(urls) for urls in files]
+    t_rewriter = time.perf_counter() - start
+
+    if result != expected:
+        raise ValueError("the rewritten urls differ")
+
+    print(f"{total} urls in {len(files)} files")
+    print(f"regex    : {t_regex:8.2f}s {total / t_regex:12.0f} urls/s")
+    print(f"rewriter : {t_rewriter:8.2f}s {total / t_rewriter:12.0f} urls/s")
+    print(f"speedup  : {t_regex / t_rewriter:8.2f}x")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
@@ -14,25 +14,48 @@ import datetime
 import json
 import pathlib
 import sys
-import time
 from enum import Enum
+from itertools import islice
 
 import typer
 from pydantic import ValidationError
 
 #-from rich import print
+from metadata_migrate_sync import summary
 from metadata_migrate_sync.check_ingest_tasks import check_ingest_tasks
-from metadata_migrate_sync.delete import metadata_delete_llnl
+from metadata_migrate_sync.coalesce import CoalesceConfig
+from metadata_migrate_sync.database import MigrationDB
+from metadata_migrate_sync.delete import (
+    DeleteConfig,
+    batch_delete_subjects,
+    iter_subjects_file,
+    metadata_delete_llnl,
+)
 from metadata_migrate_sync.globus import GlobusClient
 from metadata_migrate_sync.migrate import metadata_migrate
 from metadata_migrate_sync.project import ProjectReadOnly, ProjectReadWrite
 from metadata_migrate_sync.query import GlobusQuery, SolrQuery
 from metadata_migrate_sync.replica import metadata_replica
 from metadata_migrate_sync.revise import metadata_revise
+from metadata_migrate_sync.snapshot import ExportConfig, LoadConfig, metadata_export, metadata_load
 from metadata_migrate_sync.solr import SolrIndexes
-from metadata_migrate_sync.sync import metadata_sync
-from metadata_migrate_sync.transfer import globus_transfer, paginate_json
+from metadata_migrate_sync.spool import PageSpool
+from metadata_migrate_sync.sync import metadata_sync, metadata_sync_many
+from metadata_migrate_sync.task_tracker import TrackerConfig
+from metadata_migrate_sync.transfer import (
+    TransferConfig,
+    globus_transfer,
+    iter_json_batches,
+)
 from metadata_migrate_sync.util import create_lock, release_lock
+from metadata_migrate_sync.workqueue import (
+    WorkQueue,
+    WorkQueueConfig,
+    id_chunks,
+    merge_databases,
+    run_worker,
+    timestamp_slices,
+)
 
 from metadata_migrate_sync.lite_model import enforced_field, enforced_field_extend
 
@@ -77,6 +100,11 @@ def _validate_tgt_ep(ep: str) -> str:
     return ep
 
 
+def _validate_tgt_eps(eps: str) -> list[str]:
+    """Split a comma separated list of target end points."""
+    return [_validate_tgt_ep(ep.strip()) for ep in eps.split(",")]
+
+
 def _validate_project(project: str) -> str:
     if project is not None:
         for p in ProjectReadOnly:
@@ -101,6 +129,17 @@ def migrate(
     meta: str = typer.Option(help="metadata type", callback=_validate_meta),
     prod: bool = typer.Option(help="production run", default=False),
     final: bool = typer.Option(help="final migration", default=False),
+    spool_dir: str = typer.Option(None, help="directory to spool the converted pages"),
+    spool_max_mb: int = typer.Option(2048, help="size cap of the spool in MB"),
+    review: bool = typer.Option(False, help="re-ingest the failed pages from the spool"),
+    export: bool = typer.Option(
+        False, help="stream the documents with the solr /export handler (read-only projects)"),
+    export_fields: str = typer.Option(
+        None, help="comma separated docValues fields to export, required with --export"),
+    track_tasks: bool = typer.Option(
+        False, help="check the ingest tasks during the run instead of check_task --update"),
+    max_pending: int = typer.Option(
+        TrackerConfig.MAX_PENDING, help="pause the ingestion above this many pending tasks", min=1),
 ) -> None:
     """Migrate documents in solr index to the globus index.
 
@@ -113,8 +152,29 @@ def migrate(
         project=project,
         production=prod,
         final=final,
+        spool_dir=spool_dir,
+        spool_max_mb=spool_max_mb,
+        review=review,
+        export=export,
+        export_fields=export_fields.split(",") if export_fields else None,
+        track_tasks=track_tasks,
+        max_pending=max_pending,
     )
 
+
+@app.command()
+def inspect_spool(
+    spool_dir: str = typer.Argument(help="directory of the spooled pages"),
+    page: int = typer.Argument(help="the page number in the query table"),
+) -> None:
+    """Print a spooled page without querying the source index."""
+    spooled = PageSpool(spool_dir, max_bytes=sys.maxsize).get(page)
+    if spooled is None:
+        print (f"page {page} is not in the spool {spool_dir}")
+        raise typer.Abort()
+
+    print (json.dumps(spooled["gmeta_ingest"], indent=2))
+
 def _validate_tgt_ep_all(ep: str) -> str:
     if ep not in ["test", "test_1", "public", "stage", "all-prod", "backup"]:
         raise typer.BadParameter(f"{ep} is not a supported ep ")
@@ -164,14 +224,25 @@ def sync(
         help="source end point name", callback=_validate_src_ep
     ),
     target_ep: str = typer.Argument(
-        help="target end point name", callback=_validate_tgt_ep
+        help="target end point names, comma separated (e.g. public,backup)", callback=_validate_tgt_eps
     ),
     project: str = typer.Argument(help="project name", callback=_validate_project),
     prod: bool = typer.Option(help="production run", default=False),
     start_time: datetime.datetime = typer.Option(help="start time", default=None),
+    skip_unchanged: bool = typer.Option(False, help="skip the documents unchanged in the target"),
+    track_tasks: bool = typer.Option(
+        False, help="check the ingest tasks during the run instead of check_task --update"),
+    max_pending: int = typer.Option(
+        TrackerConfig.MAX_PENDING, help="pause the ingestion above this many pending tasks", min=1),
+    coalesce: bool = typer.Option(False, help="fill the ingest requests with consecutive pages"),
+    max_age: float = typer.Option(
+        CoalesceConfig.MAX_AGE, help="seconds before the coalesced entries are ingested", min=0),
+    propagate_deletes: bool = typer.Option(
+        False, help="delete the subjects removed from the source, with a subject snapshot"),
 ) -> None:
     """Sync the ESGF-1.5 staged indexes to the public index.
 
+    With several targets, the staged index is read once for all of them.
     Details can be seen in the design.md
     """
     lock_file_path = f"/tmp/metadata_migrate_sync_{project.value}.lock"  # noqa S108
@@ -186,11 +257,69 @@ def sync(
             production=prod,
             sync_freq=5,
             start_time=start_time,
+            skip_unchanged=skip_unchanged,
+            track_tasks=track_tasks,
+            max_pending=max_pending,
+            coalesce=coalesce,
+            max_age=max_age,
+            propagate_deletes=propagate_deletes,
         )
     finally:
         release_lock(lock_fd, lock_file_path)
 
 
+@app.command()
+def sync_many(
+    source_ep: str = typer.Argument(
+        help="source end point name", callback=_validate_src_ep
+    ),
+    target_ep: str = typer.Argument(
+        help="target end point names, comma separated (e.g. public,backup)", callback=_validate_tgt_eps
+    ),
+    projects: list[str] = typer.Argument(help="project names"),
+    prod: bool = typer.Option(help="production run", default=False),
+    start_time: datetime.datetime = typer.Option(help="start time", default=None),
+    skip_unchanged: bool = typer.Option(False, help="skip the documents unchanged in the target"),
+    track_tasks: bool = typer.Option(
+        False, help="check the ingest tasks during the run instead of check_task --update"),
+    max_pending: int = typer.Option(
+        TrackerConfig.MAX_PENDING, help="pause the ingestion above this many pending tasks", min=1),
+    workers: int = typer.Option(None, help="projects synced at once (all by default)", min=1),
+    propagate_deletes: bool = typer.Option(
+        False, help="delete the subjects removed from the source, with a subject snapshot"),
+) -> None:
+    """Sync several staged projects to the public index in one process."""
+    project_list = [_validate_project(p) for p in projects]
+
+    locks = {}
+    try:
+        for project in project_list:
+            lock_file_path = f"/tmp/metadata_migrate_sync_{project.value}.lock"  # noqa S108
+            locks[lock_file_path] = create_lock(lock_file_path)
+
+        results = metadata_sync_many(
+            source_epname=source_ep,
+            target_epname=target_ep,
+            projects=project_list,
+            max_workers=workers,
+            production=prod,
+            sync_freq=5,
+            start_time=start_time,
+            skip_unchanged=skip_unchanged,
+            track_tasks=track_tasks,
+            max_pending=max_pending,
+            propagate_deletes=propagate_deletes,
+        )
+    finally:
+        for lock_file_path, lock_fd in locks.items():
+            release_lock(lock_fd, lock_file_path)
+
+    for name, result in results.items():
+        print (f"{name}: {'failed: ' + repr(result) if isinstance(result, BaseException) else 'done'}")
+    if any(isinstance(result, BaseException) for result in results.values()):
+        raise typer.Exit(code=1)
+
+
 @app.command()
 def create_index() -> None:
     """Create index for the test app."""
@@ -435,17 +564,24 @@ def delete_subjects_query(
     project: str = typer.Argument(help="project name", callback=_validate_project),
     production: bool = typer.Option(help="production run", default=False),
     dryrun: bool = typer.Option(help="dry run", default=True),
+    workers: int = typer.Option(
+        help="concurrent deletion calls", default=DeleteConfig.MAX_WORKERS, min=1),
 ) -> None:
     """Delete metadata from the query."""
 
     # currently, this function is for deleting llnl metadata only
 
-    metadata_delete_llnl(
+    counts = metadata_delete_llnl(
        globus_epname=globus_ep,
        project=project,
        production=production,
-       dryrun=dryrun
+       dryrun=dryrun,
+       max_workers=workers,
     )
+    if dryrun:
+        print (f"dry run: {counts['dry_run_subjects']} subjects in {counts['dry_run_chunks']} chunks")
+    else:
+        print (counts)
 
 
 @app.command()
@@ -453,7 +589,12 @@ def delete_subjects_json(
     globus_ep: str = typer.Argument(
         help="globus end point name", callback=_validate_tgt_ep),
     project: str = typer.Argument(help="project name", callback=_validate_project),
-    json_file: str = typer.Argument(help="the json file stores the query results"),
+    json_file: str = typer.Argument(
+        help="the json file stores the query results, or a ndjson file of subjects"),
+    workers: int = typer.Option(
+        help="concurrent deletion calls", default=DeleteConfig.MAX_WORKERS, min=1),
+    chunk_size: int = typer.Option(
+        help="subjects per deletion call", default=DeleteConfig.MAX_SUBJECTS, min=1),
 ) -> None:
     """Delete the subjects in a globus index."""
 
@@ -484,45 +625,112 @@ def delete_subjects_json(
 
     typer.echo(message)
 
-    with open(json_file) as f:
-        # Load the JSON data from the file
-        del_data = json.load(f)
+    # stream the file once to check the project and count the subjects
+    try:
+        del_data_length = sum(1 for _ in iter_subjects_file(json_file, project.value))
+    except ValueError as e:
+        print (e)
+        raise typer.Abort()
 
-    del_data_length =  len(del_data["gmeta"])
+    message = typer.style(
+        f"you are going to delete {del_data_length} records \n",
+        fg=typer.colors.RED, bold=True
+    ) + typer.style(
+        "\n\n\n Yes or No?",
+        fg=typer.colors.BLUE, bold=True
+    )
+    confirm = typer.prompt(message)
+    if confirm != 'Yes':
+        print ("Do nothing and quit\n")
+        raise typer.Abort()
 
-    to_be_deleted = []
-    for g in del_data["gmeta"]:
-        if g["entries"][0]["content"]["project"] != [project.value]:
-            project_in_doc = g["entries"][0]["content"]["project"][0]
-            print (f"the project of the document {project_in_doc}, "
-                f"but the project {project.value} is provided")
-            raise typer.Abort()
-        else:
-            to_be_deleted.append(g['subject'])
+    print (confirm)
 
-    if len(to_be_deleted) != del_data_length:
-        raise ValueError("the length of to be deleted docs are not the same as that from the json file")
-    else:
-        message = typer.style(
-            f"you are going to delete {del_data_length} records \n",
-            fg=typer.colors.RED, bold=True
-        ) + typer.style(
-            "\n\n\n Yes or No?",
-            fg=typer.colors.BLUE, bold=True
-        )
-        confirm = typer.prompt(message)
-        if confirm == 'Yes':
-            print (confirm)
-            response = sc.batch_delete_by_subject(
-                _globus_index_id,
-                subjects=to_be_deleted,
-            )
-        else:
-            print ("Do nothing and quit\n")
-            raise typer.Abort()
+    # the checkpoint of the submitted chunks, a rerun resumes the deletion
+    db_file = f"Deletion_{globus_ep}_{project.value}_{pathlib.Path(json_file).name.split('.')[0]}.sqlite"
+    MigrationDB(db_file, False)
 
+    counts = batch_delete_subjects(
+        sc,
+        _globus_index_id,
+        iter_subjects_file(json_file, project.value),
+        chunk_size=chunk_size,
+        max_workers=workers,
+    )
+    print (counts)
+    if counts["failed_chunks"]:
+        print (f"{counts['failed_chunks']} chunks failed, rerun the command to retry them")
+        raise typer.Exit(code=1)
 
 
+@app.command()
+def export(
+    globus_ep: str = typer.Argument(
+        help="globus end point name", callback=_validate_tgt_ep),
+    project: str = typer.Argument(help="project name", callback=_validate_project),
+    out_dir: str = typer.Argument(help="the directory of the shards and the manifest"),
+    time_range: str = typer.Option(
+        "2000-01-01TO", help="time range of the documents datetime-datetime (now if no end)"),
+    partition_by: str = typer.Option(
+        "_timestamp", help="partition by _timestamp ranges or by the values of a facet field"),
+    partitions: int = typer.Option(
+        ExportConfig.N_PARTITIONS, help="number of _timestamp partitions", min=1),
+    workers: int = typer.Option(
+        ExportConfig.MAX_WORKERS, help="concurrent partition scrolls", min=1),
+    limit: int = typer.Option(ExportConfig.PAGE_SIZE, help="the limit of a page"),
+) -> None:
+    """Export the documents of a project to compressed NDJSON shards."""
+    if 'TO' not in time_range:
+        print ("please provide a validate time range datetime-datetime")
+        raise typer.Abort()
+
+    start_time, end_time = time_range.split('TO', 1)
+    if start_time == '':
+        print ("please provide the start of the time range")
+        raise typer.Abort()
+
+    time_from = datetime.datetime.fromisoformat(start_time)
+    time_to = (
+        datetime.datetime.fromisoformat(end_time) if end_time != ''
+        else datetime.datetime.utcnow().replace(microsecond=0)
+    )
+
+    manifest = metadata_export(
+        globus_epname=globus_ep,
+        project=project,
+        out_dir=out_dir,
+        partition_by=partition_by,
+        n_partitions=partitions,
+        time_from=time_from,
+        time_to=time_to,
+        max_workers=workers,
+        page_size=limit,
+    )
+    print (f"exported {manifest['total']} documents in {len(manifest['shards'])} shards to {out_dir}")
+
+
+@app.command()
+def load(
+    globus_ep: str = typer.Argument(
+        help="globus end point name", callback=_validate_tgt_ep),
+    project: str = typer.Argument(help="project name", callback=_validate_project),
+    shard_dir: str = typer.Argument(help="the directory of the NDJSON shards"),
+    fix_dtype: bool = typer.Option(False, help="apply the data type fixes to the entries"),
+    workers: int = typer.Option(
+        LoadConfig.MAX_WORKERS, help="concurrent ingest submissions", min=1),
+    dry_run: bool = typer.Option(False, help="convert and pack without ingesting"),
+) -> None:
+    """Load the NDJSON shards (of the export) into a globus index."""
+    totals = metadata_load(
+        globus_epname=globus_ep,
+        project=project,
+        shard_dir=shard_dir,
+        fix_dtype=fix_dtype,
+        max_workers=workers,
+        dry_run=dry_run,
+    )
+    print (f"ingested {totals['n_ingested']} and skipped {totals['n_skipped']} documents "
+           f"in {totals['batches']} batches")
 
 
 @app.callback()
@@ -655,6 +863,7 @@ def compare_globus(
         generator=True,
         paginator="scroll",
         skip_prov=True,
+        ids_only=True,
     )
 
     gq_2 = GlobusQuery(
@@ -666,6 +875,7 @@ def compare_globus(
         generator=True,
         paginator="scroll",
         skip_prov=True,
+        ids_only=True,
     )
 
     s_left = set()
@@ -799,7 +1009,7 @@ def compare_solr_globus(
         "sort": "id asc",
         "rows": 1500,
         "cursorMark": "*",
-        "wt": "json",
+        "wt": "csv",
         "q": "project:" + project.value,
         "fq": ["institution_id:"+institution_id, "data_node:"+data_node, "_timestamp:[* TO 2025-03-16T00:00:00Z]"],
     }
@@ -811,6 +1021,7 @@ def compare_solr_globus(
         project=project,
         query=solr_search_dict,
         skip_prov=True,
+        id_only=True,
     )
 
 
@@ -856,6 +1067,7 @@ def compare_solr_globus(
         generator=True,
         paginator="scroll",
         skip_prov=True,
+        ids_only=True,
     )
 
     s_left = set()
@@ -865,7 +1077,7 @@ def compare_solr_globus(
     for num, (page_s, page_g) in enumerate(zip_longest(sq.run(), gq.run())):
 
         if page_g is not None:
-            print ("num =", num, page_g["total"], sq._numFound)
+            print ("num =", num, page_g["total"], sq._num_found)
         else:
             print ("num =", num)
 
@@ -901,44 +1113,39 @@ def transfer(
     json_file: str = typer.Argument(help="json file"),
     json_type: str = typer.Argument(help="json file type"),
     page_start: int = typer.Option(0, help="start page"),
-    per_page: int = typer.Option(5000, help="items per page"),
+    per_page: int = typer.Option(TransferConfig.PER_PAGE, help="items per page"),
+    max_in_flight: int = typer.Option(
+        TransferConfig.MAX_IN_FLIGHT, help="unfinished transfer tasks at a time", min=1),
+    workers: int = typer.Option(
+        TransferConfig.MAX_WORKERS, help="concurrent transfer submissions", min=1),
+    wait: bool = typer.Option(False, help="wait for the transfer tasks to finish"),
+    dryrun: bool = typer.Option(False, help="print the batches only"),
 ) -> None:
     """Transfer files from one globus ep to another ep."""
 
-    page = page_start
-
-    while True:
-        page = page + 1
-        try:
-            result = paginate_json(
-                json_file,
-                page=page,
-                per_page=per_page,
-                json_type=json_type,
-                )
-
-            if len(result["items"]) == 0:
-                break
-
-            #-file_paths = []
-            #-for item in result["items"]:
-            #-    file_paths.append(item["local_path"])
-            file_paths = result["items"]
-
-            ep_between = f"{globus_ep_source}-{globus_ep_target}"
-            globus_transfer(
-                globus_ep_source,
-                globus_ep_target,
-                file_paths,
-                batch_n=page,
-                transfer_label=f'prod-{ep_between}-{json_type}_{project}'
-            )
-
-            time.sleep(30)
-
-        except Exception as e:
-            print (f"No more page left {e}")
-            break
+    ep_between = f"{globus_ep_source}-{globus_ep_target}"
+    transfer_label = f'prod-{ep_between}-{json_type}_{project}'
+
+    # the task ids of the submitted batches, a rerun resumes the transfer
+    MigrationDB(f"Transfer_{transfer_label}.sqlite", False)
+
+    batches = islice(iter_json_batches(json_file, json_type, per_page), page_start, None)
+
+    counts = globus_transfer(
+        globus_ep_source,
+        globus_ep_target,
+        batches,
+        transfer_label=transfer_label,
+        first_batch=page_start + 1,
+        max_in_flight=max_in_flight,
+        max_workers=workers,
+        wait=wait,
+        dry_run=dryrun,
+    )
+    print (counts)
+    if counts["failed_batches"]:
+        print (f"{counts['failed_batches']} batches failed, rerun the command to retry them")
+        raise typer.Exit(code=1)
 
 @app.command()
 def revise(
@@ -1023,6 +1230,8 @@ def replica(
     has_globus: bool = typer.Option(True, help="has globus link?"),
     is_replica: bool = typer.Option(True, help="replica?"),
     dry_run: bool = typer.Option(False, help="dry run"),
+    processes: int = typer.Option(
+        None, help="worker processes for the document conversion (default: in process)", min=1),
 
 ) -> None:
     """Replicate the metadata in the index by changing documents directly."""
@@ -1038,6 +1247,7 @@ def replica(
         has_globus = has_globus,
         is_replica = is_replica,
         dry_run = dry_run,
+        processes = processes,
     )
 
 
@@ -1048,7 +1258,16 @@ def fixes(
     ),
     project: str = typer.Argument(help="project name", callback=_validate_project),
     prod: bool = typer.Option(help="production run", default=False),
-    dry_run: bool = True
+    dry_run: bool = True,
+    partitions: int = typer.Option(
+        help="scroll the index in this many partitions concurrently", default=None
+    ),
+    partition_by: str = typer.Option(
+        help="split by the _timestamp histogram or the values of a field", default="_timestamp"
+    ),
+    coalesce: bool = typer.Option(False, help="fill the ingest requests with consecutive pages"),
+    max_age: float = typer.Option(
+        CoalesceConfig.MAX_AGE, help="seconds before the coalesced entries are ingested", min=0),
 ) -> None:
 
     metadata_fixes(
@@ -1056,6 +1275,10 @@ def fixes(
         project = project,
         production = prod,
         dry_run = dry_run,
+        partitions = partitions,
+        partition_by = partition_by,
+        coalesce = coalesce,
+        max_age = max_age,
     )
 
 @app.command()
@@ -1076,5 +1299,180 @@ def check_skipped(
     out_dict={"operation":operation, "project": project, "timestamp": timestamp, "ids":skipped_list}
     print (json.dumps(out_dict))
 
+
+@app.command()
+def report(
+    db_file: str,
+    skipped: pathlib.Path = typer.Option(None, help="write the skipped ids to this NDJSON file"),
+    meta: str = typer.Option("File", help="the skipped File or Dataset ids"),
+) -> None:
+    """Report the counts, throughput and pending tasks from the summary tables (read-only)."""
+    if not pathlib.Path(db_file).is_file():
+        print (f"{db_file} is not exist")
+        raise typer.Exit(code=1)
+
+    with summary.read_only_session(db_file)() as session:
+        # the databases written before the summary tables are summarized once with rebuild_summary
+        if summary.needs_rebuild(session):
+            print (f"the summary tables of {db_file} are missing, run rebuild-summary first")
+            raise typer.Exit(code=1)
+
+        stats = summary.report(session)
+
+    print (json.dumps(stats, indent=2, default=str))
+
+    if skipped is not None:
+        n = summary.write_skipped(db_file, meta, skipped)
+        print (f"{n} skipped ids written to {skipped}")
+
+
+@app.command()
+def rebuild_summary(db_file: str) -> None:
+    """Rebuild the summary tables of a database from its files, datasets and ingest tables."""
+    if not pathlib.Path(db_file).is_file():
+        print (f"{db_file} is not exist")
+        raise typer.Exit(code=1)
+
+    _ = MigrationDB(db_file, False)
+    with MigrationDB.get_session()() as session:
+        n_pages = summary.rebuild(session)
+        session.commit()
+    print (f"rebuilt the summaries of {n_pages} pages")
+
+
+@app.command()
+def queue_migrate(
+    queue_file: str = typer.Argument(help="sqlite file of the work queue (on a shared file system)"),
+    source_ep: str = typer.Argument(help="source end point name", callback=_validate_src_ep),
+    target_ep: str = typer.Argument(help="target end point name", callback=_validate_tgt_ep),
+    project: str = typer.Argument(help="project name", callback=_validate_project),
+    meta: str = typer.Option(help="metadata type", callback=_validate_meta),
+    prod: bool = typer.Option(help="production run", default=False),
+    final: bool = typer.Option(help="final migration", default=False),
+    units: int = typer.Option(16, help="number of the _timestamp slices", min=1),
+    start: datetime.datetime = typer.Option(
+        "2000-01-01", help="first slice boundary, the first slice takes the older documents"),
+    track_tasks: bool = typer.Option(
+        False, help="check the ingest tasks during the run instead of check_task --update"),
+) -> None:
+    """Split a migration into _timestamp slices in the work queue."""
+    if final:
+        slices = timestamp_slices(WorkQueueConfig.CUTOFF, WorkQueueConfig.FINAL_END, units)
+    else:
+        slices = timestamp_slices(start, WorkQueueConfig.CUTOFF, units, open_start=True)
+
+    spec = {
+        "source_epname": source_ep,
+        "target_epname": target_ep,
+        "metatype": meta,
+        "project": project.value,
+        "production": prod,
+        "final": final,
+        "track_tasks": track_tasks,
+    }
+    n = WorkQueue(queue_file).put("migrate", [(fq, {**spec, "time_slice": fq}) for fq in slices])
+    print (f"{n} units added to {queue_file}")
+
+
+@app.command()
+def queue_replica(
+    queue_file: str = typer.Argument(help="sqlite file of the work queue (on a shared file system)"),
+    source_ep: str = typer.Argument(help="source globus index", callback=_validate_tgt_ep),
+    target_ep: str = typer.Argument(help="target globus index", callback=_validate_tgt_ep),
+    project: str = typer.Argument(help="project name", callback=_validate_project),
+    replica_json: pathlib.Path = typer.Argument(help="json file containing the document needed to replicate"),
+    meta: str = typer.Argument(help="meta type: File or Dataset"),
+    src_data_node: str = typer.Argument(help="source data node: llnl/anl"),
+    dst_data_node: str = typer.Argument(help="target data node: ornl"),
+    has_globus: bool = typer.Option(True, help="has globus link?"),
+    is_replica: bool = typer.Option(True, help="replica?"),
+    per_page: int = typer.Option(2000, help="ids per query", min=1),
+    pages_per_unit: int = typer.Option(10, help="pages of ids per unit", min=1),
+) -> None:
+    """Split a replication into chunks of ids in the work queue."""
+    spec = {
+        "source_ep": source_ep,
+        "target_ep": target_ep,
+        "project": project.value,
+        "replica_json": str(replica_json.resolve()),
+        "meta": meta,
+        "src_data_node": src_data_node,
+        "dst_data_node": dst_data_node,
+        "has_globus": has_globus,
+        "is_replica": is_replica,
+        "per_page": per_page,
+    }
+    n = WorkQueue(queue_file).put("replica", [
+        (f"pages {page_start + 1}-{page_end}", {**spec, "page_start": page_start, "page_end": page_end})
+        for page_start, page_end in id_chunks(replica_json, per_page, pages_per_unit)
+    ])
+    print (f"{n} units added to {queue_file}")
+
+
+@app.command()
+def queue_revise(
+    queue_file: str = typer.Argument(help="sqlite file of the work queue (on a shared file system)"),
+    globus_ep: str = typer.Argument(help="globus index", callback=_validate_tgt_ep),
+    project: str = typer.Argument(help="project name", callback=_validate_project),
+    revise_json: pathlib.Path = typer.Argument(help="json file containing the document needed to revise"),
+    revise_conf: str = typer.Argument(help="json file containing the revise settings"),
+    meta: str = typer.Argument(help="meta type: File or Dataset"),
+    per_page: int = typer.Option(2000, help="ids per query", min=1),
+    pages_per_unit: int = typer.Option(10, help="pages of ids per unit", min=1),
+) -> None:
+    """Split a revision into chunks of ids in the work queue."""
+    with open(revise_conf) as f:
+        revise_item = json.load(f)
+
+    spec = {
+        "globus_ep": globus_ep,
+        "project": project.value,
+        "meta": meta,
+        "revise_json": str(revise_json.resolve()),
+        "revise_item": revise_item,
+        "per_page": per_page,
+    }
+    n = WorkQueue(queue_file).put("revise", [
+        (f"pages {page_start + 1}-{page_end}", {**spec, "page_start": page_start, "page_end": page_end})
+        for page_start, page_end in id_chunks(revise_json, per_page, pages_per_unit)
+    ])
+    print (f"{n} units added to {queue_file}")
+
+
+@app.command()
+def queue_work(
+    queue_file: str = typer.Argument(help="sqlite file of the work queue"),
+    work_dir: pathlib.Path = typer.Option(".", help="directory of the unit databases"),
+    worker: str = typer.Option(None, help="worker name (default: host-pid), reuse it to resume"),
+    max_units: int = typer.Option(None, help="stop after this many units", min=1),
+) -> None:
+    """Lease and run the units of the work queue until it is empty."""
+    n = run_worker(WorkQueue(queue_file), work_dir, worker=worker, max_units=max_units)
+    print (f"{n} units done")
+
+
+@app.command()
+def queue_status(
+    queue_file: str = typer.Argument(help="sqlite file of the work queue"),
+) -> None:
+    """Count the units of the work queue by status."""
+    print (json.dumps(WorkQueue(queue_file).counts()))
+
+
+@app.command()
+def queue_merge(
+    queue_file: str = typer.Argument(help="sqlite file of the work queue"),
+    db_file: str = typer.Argument(help="new sqlite file of the merged pages"),
+) -> None:
+    """Merge the databases of the done units into one."""
+    queue = WorkQueue(queue_file)
+    counts = queue.counts()
+    if set(counts) != {"done"}:
+        print (f"not every unit is done: {counts}")
+
+    n_pages = merge_databases(queue.done_units(), db_file)
+    print (f"{n_pages} pages merged into {db_file}")
+
+
 if __name__ == "__main__":
     app()
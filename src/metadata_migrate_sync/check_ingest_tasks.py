@@ -99,6 +99,8 @@ def check_ingest_tasks(*,
                                              progress.update(task, advance=1,
                                                  success=progress.tasks[0].fields["success"] + 1)
                                          else:
+                                             if r.data["state"] == "FAILED":
+                                                 item.n_failed = (item.n_failed or 0) + 1
                                              progress.update(task, advance=1)
                                      except GlobusAPIError as e:
                                          print(f"Error processing task {item.task_id}: {e}")
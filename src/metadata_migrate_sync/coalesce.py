@@ -0,0 +1,185 @@
+"""Coalesce the ingest entries of consecutive pages.
+
+A page of small documents fills a fraction of an ingest request, so the
+IngestCoalescer buffers the gmeta entries over the pages and submits them
+when the next entry would pass the size limit, when the oldest buffered
+entry is older than MAX_AGE, or at the end of the stream.
+
+Every flushed request is recorded for each page it holds entries of, as an
+ingest row of the page with the task of the request. A page is closed, with
+n_datasets set to the number of its ingest rows (plus its failed requests),
+after all its entries are flushed, and the pages close in order. The
+resumption (GlobusQuery.get_offset_marker) queries again from the earliest
+unclosed page of the coalesced ones before the last page.
+"""
+import logging
+import time
+from dataclasses import dataclass
+from functools import partial
+from typing import Any, Literal
+
+from sqlalchemy.orm import Session
+
+from metadata_migrate_sync.codec import encoded_size
+from metadata_migrate_sync.database import Ingest, MigrationDB, Query
+from metadata_migrate_sync.globus import GlobusCV
+from metadata_migrate_sync.ingest import GlobusIngest
+from metadata_migrate_sync.provenance import provenance
+
+
+class CoalesceConfig:
+    """config class for the ingest coalescer."""
+
+    MAX_AGE = 30.0      # seconds before the buffered entries are flushed
+
+
+def _mark_coalesced(session: Session, query_id: int) -> None:
+    """Mark a page whose entries are ingested with the ones of the next pages."""
+    page = session.get(Query, query_id)
+    if page is not None:
+        page.coalesced = 1  # type: ignore[assignment]
+    else:
+        raise ValueError("cannot find the page in the query table")
+
+
+def _close_page(session: Session, query_id: int, n_failed: int) -> None:
+    """Set the number of the ingest rows of a page, a failed request is missing."""
+    page = session.get(Query, query_id)
+    if page is None:
+        raise ValueError("cannot find the page in the query table")
+    n_rows = session.query(Ingest).filter(Ingest.pages == page.pages).count()
+    page.n_datasets = n_rows + n_failed  # type: ignore[assignment]
+
+
+@dataclass
+class _Page:
+    """A page with entries in the buffer."""
+
+    query: Any
+    pending: int = 0
+    n_failed: int = 0
+
+
+class IngestCoalescer:
+    """Fill the ingest requests with the entries of consecutive pages."""
+
+    def __init__(
+        self,
+        ig: GlobusIngest,
+        max_bytes: int,
+        *,
+        max_age: float = CoalesceConfig.MAX_AGE,
+        metatype: Literal["files", "datasets"] = "files",
+        dry_run: bool = False,
+    ) -> None:
+        self.ig = ig
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.metatype = metatype
+        self.dry_run = dry_run
+
+        self.n_flushed = 0
+        self.n_rejected = 0
+
+        self._buffer: list[tuple[int, dict[str, Any]]] = []
+        self._size = 0
+        self._oldest = 0.0
+        self._pages: dict[int, _Page] = {}
+
+        self._logger = (
+            provenance._instance.get_logger(__name__)
+            if provenance._instance is not None else logging.getLogger()
+        )
+
+    def add(self, current_query: Any, gmeta_list: list[dict[str, Any]]) -> None:  # noqa ANN401
+        """Buffer the entries of a page (of the query table), flushing the full requests."""
+        query_id = current_query.id
+        self._pages[query_id] = _Page(query=current_query, pending=len(gmeta_list))
+        MigrationDB.write(partial(_mark_coalesced, query_id=query_id))
+
+        for gmeta in gmeta_list:
+            gmeta_size = encoded_size(gmeta)
+            if self._buffer and (self._size + gmeta_size) > self.max_bytes:
+                self.flush()
+            if not self._buffer:
+                self._oldest = time.monotonic()
+            self._buffer.append((query_id, gmeta))
+            self._size += gmeta_size
+
+        if self._buffer and time.monotonic() - self._oldest > self.max_age:
+            self.flush()
+        else:
+            self._close_pages()
+
+    def flush(self) -> None:
+        """Submit the buffered entries in one request and record it for their pages."""
+        if not self._buffer:
+            return
+
+        ig = self.ig
+        self.n_flushed += 1
+        self._logger.debug(f"Flushing {len(self._buffer)} entries of {self._size} bytes")
+
+        ig._submitted = False
+        if self.dry_run:
+            ig._response_data = {}
+            ig._submissions = []
+            ig._rejected = {}
+            ig._unchanged = set()
+            ig._submitted = True
+        else:
+            ig.ingest(
+                {
+                    GlobusCV.INGEST_TYPE.value: GlobusCV.GMETALIST.value,
+                    GlobusCV.INGEST_DATA.value: {
+                        GlobusCV.GMETA.value: [gmeta for _, gmeta in self._buffer],
+                    }
+                }
+            )
+        submitted = ig._submitted
+        response_data = ig._response_data
+        submissions = ig._submissions
+        rejected = ig._rejected
+        unchanged = ig._unchanged
+        self.n_rejected += len(rejected)
+
+        by_page: dict[int, list[dict[str, Any]]] = {}
+        for query_id, gmeta in self._buffer:
+            by_page.setdefault(query_id, []).append(gmeta)
+        self._buffer = []
+        self._size = 0
+
+        # the request is recorded for every page, prov_collect resets the submissions
+        for query_id, entries in by_page.items():
+            page = self._pages[query_id]
+            ig._submitted = submitted
+            ig._response_data = response_data
+            ig._submissions = list(submissions)
+            ig._rejected = rejected
+            ig._unchanged = unchanged
+            ig.prov_collect(
+                [g[GlobusCV.CONTENT.value] for g in entries],
+                review=False,
+                current_query=page.query,
+                metatype=self.metatype,
+                batch_num=self.n_flushed,
+            )
+            page.pending -= len(entries)
+            if not submitted:
+                page.n_failed += 1
+
+        self._close_pages()
+
+    def close(self) -> None:
+        """Flush the buffer at the end of the stream and close its pages."""
+        self.flush()
+        self._close_pages()
+
+    def _close_pages(self) -> None:
+        """Close the flushed pages, in the order of the pages."""
+        for query_id in list(self._pages):
+            page = self._pages[query_id]
+            if page.pending > 0:
+                break
+            MigrationDB.write(partial(_close_page, query_id=query_id, n_failed=page.n_failed))
+            del self._pages[query_id]
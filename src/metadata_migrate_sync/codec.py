@@ -0,0 +1,65 @@
+"""JSON codec of the package.
+
+orjson (the optional dependency, pip install .[orjson]) is used when it is
+installed, the stdlib json otherwise (or with METADATA_JSON_CODEC=json):
+
+- loads decodes with orjson, to the same objects as json.loads.
+- dumps, encoded_size and dumpb encode with json. The strings in the
+  database (query_str, ingest_response, ...), the fingerprints and the
+  ingest sizes must not change with the installed packages, and orjson
+  differs from json.dumps in the separators, the ASCII escapes, the floats
+  and NaN (written as null). Checking or fixing its output costs more than
+  the stdlib C encoder (see scripts/bench_codec.py).
+"""
+import json
+import os
+from collections.abc import Callable
+from typing import Any
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None  # type: ignore[assignment]
+
+
+class CodecConfig:
+    """config class for the json codec."""
+
+    BACKEND = os.environ.get("METADATA_JSON_CODEC", "orjson" if orjson is not None else "json")
+
+
+def _use_orjson() -> bool:
+    return orjson is not None and CodecConfig.BACKEND == "orjson"
+
+
+def dumps(
+    obj: Any,  # noqa ANN401
+    *,
+    compact: bool = False,
+    sort_keys: bool = False,
+    default: Callable[[Any], Any] | None = None,
+) -> str:
+    """Encode as json.dumps, with the separators (",", ":") if compact."""
+    separators = (",", ":") if compact else None
+    return json.dumps(obj, separators=separators, sort_keys=sort_keys, default=default)
+
+
+def encoded_size(obj: Any) -> int:  # noqa ANN401
+    """Get len(json.dumps(obj)), the size of a document in an ingest request."""
+    return len(json.dumps(obj))
+
+
+def dumpb(obj: Any) -> bytes:  # noqa ANN401
+    """Encode compactly to UTF-8 bytes, for the data read back with loads only."""
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def loads(data: str | bytes) -> Any:  # noqa ANN401
+    """Decode a json document, to the same objects as json.loads."""
+    if _use_orjson():
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # NaN, Infinity and the integers above 64 bits are json only
+            pass
+    return json.loads(data)
@@ -0,0 +1,140 @@
+"""Run contexts to drive several pipelines in one process.
+
+The database (MigrationDB) and the provenance are process-wide singletons,
+reached from deep inside the query, ingest and convert code. A bound
+RunContext takes their place for the current thread: MigrationDB(...) and
+provenance(...) fill the context instead of the singletons, and
+MigrationDB.get_session, provenance._instance and provenance.get_logger
+return the ones of the context. So the pipeline functions run unchanged in
+their own contexts, concurrently, while sharing the globus clients.
+"""
+import contextvars
+import logging
+import threading
+from collections.abc import Callable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, TypeVar
+
+LOG_FORMAT = "%(asctime)s - %(funcName)s - %(levelname)s - %(message)s"
+
+T = TypeVar("T")
+
+_current: contextvars.ContextVar["RunContext | None"] = contextvars.ContextVar(
+    "run_context", default=None
+)
+
+
+class RunContext:
+    """The database, provenance and logger of one pipeline run."""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.db: Any | None = None     # MigrationDB of the run
+        self._prov: Any | None = None  # provenance of the run
+        self._logger: logging.Logger | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def prov(self) -> Any | None:  # noqa ANN401
+        """The provenance of the run."""
+        return self._prov
+
+    @prov.setter
+    def prov(self, value: Any | None) -> None:  # noqa ANN401
+        with self._lock:
+            self._prov = value
+            # the logger follows the log file of the provenance
+            self._close_logger()
+
+    @property
+    def logger(self) -> logging.Logger:
+        """A logger writing to the log file of the run only."""
+        with self._lock:
+            if self._logger is None:
+                log_file = self._prov.log_file if self._prov is not None else f"{self.name}.log"
+                handler = logging.FileHandler(log_file)
+                handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+                logger = logging.getLogger(f"{__package__}.run.{self.name}")
+                logger.setLevel(logging.DEBUG)
+                logger.propagate = False
+                logger.handlers = [handler]
+                self._logger = logger
+            return self._logger
+
+    def _close_logger(self) -> None:
+        if self._logger is not None:
+            for handler in self._logger.handlers:
+                handler.close()
+            self._logger.handlers = []
+            self._logger = None
+
+    @contextmanager
+    def bind(self) -> Iterator["RunContext"]:
+        """Make this the context of the current thread."""
+        token = _current.set(self)
+        try:
+            yield self
+        finally:
+            _current.reset(token)
+
+    def run(self, fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:  # noqa ANN401
+        """Call a function in this context."""
+        with self.bind():
+            return fn(*args, **kwargs)
+
+    def close(self) -> None:
+        """Release the database engine and the log file of the run."""
+        with self._lock:
+            self._close_logger()
+        if self.db is not None:
+            self.db._engine.dispose()
+
+
+def current_context() -> RunContext | None:
+    """Get the context bound to the current thread, if any."""
+    return _current.get()
+
+
+def in_current_context(fn: Callable[..., T]) -> Callable[..., T]:
+    """Carry the context of the caller into a function run by another thread.
+
+    A new thread does not inherit the context, so the targets of the threads
+    and pools started inside a pipeline are wrapped with this.
+    """
+    ctx = _current.get()
+    if ctx is None:
+        return fn
+
+    def _run(*args: Any, **kwargs: Any) -> T:  # noqa ANN401
+        return ctx.run(fn, *args, **kwargs)
+
+    return _run
+
+
+def run_in_contexts(
+    jobs: dict[str, Callable[[], Any]],
+    max_workers: int | None = None,
+) -> dict[str, Any]:
+    """Run every job in its own context, concurrently in one thread pool.
+
+    The result of a job is its return value, or the exception it raised, so a
+    failed job does not stop the others.
+    """
+    results: dict[str, Any] = {}
+    with ThreadPoolExecutor(max_workers=max_workers or len(jobs) or 1) as executor:
+        futures = {}
+        for name, job in jobs.items():
+            ctx = RunContext(name)
+            futures[name] = (ctx, executor.submit(ctx.run, job))
+
+        for name, (ctx, future) in futures.items():
+            try:
+                results[name] = future.result()
+            except (Exception, SystemExit) as e:  # noqa BLE001
+                # the pipelines stop with sys.exit on the bad settings
+                results[name] = e
+            finally:
+                ctx.close()
+    return results
@@ -1,6 +1,7 @@
 """Document conversion module."""
 import datetime
 import re
+from functools import lru_cache
 from typing import Any, Literal
 
 from metadata_migrate_sync.esgf_index_schema.schema_solr import DatasetDocs, FileDocs
@@ -11,6 +12,30 @@ from metadata_migrate_sync.provenance import provenance
 _DOMAIN_PATTERN = re.compile(r'(?<=://)([^/:]+)(:\d+)?(/|$)')
 _UUID_PATTERN = re.compile(r'(?<=globus:)[^/]+(?=/)')  # Matches UUID only
 
+# source and target data nodes of the replication
+DN_MAPPINGS = {
+    "llnl": ["esgf-data1.llnl.gov", "esgf-data2.llnl.gov", "aims3.llnl.gov"],
+    "anl": ["eagle.alcf.anl.gov"],
+    "nersc": ["esgf-data.nersc.gov"],
+    "ornl": ["esgf-node.ornl.gov"],
+    "iap": ["esg.lasg.ac.cn"],
+    "newiap": ["esg.iap.ac.cn"]
+}
+
+GLOBUS_IDS = {
+    "ornl": "dea29ae8-bb92-4c63-bdbc-260522c92fe8"
+}
+
+# the documents kept from a source, as solr filter queries. They are the
+# server side version of the checks in convert_to_esgf_1_5 (keep both in sync),
+# which keep the documents without the field. Each is its own fq, so solr
+# expands the wildcards once into the filter cache, not on every page.
+SOURCE_FILTER_QUERIES = {
+    "ornl": ['(data_node:(*.llnl.gov* OR *.anl.gov* OR "esgf-node.ornl.gov") OR (*:* -data_node:*))'],
+    "llnl": ['(*:* -source_id:"E3SM-2-1")'],
+}
+
+
 def convert_to_esgf_1_5(
     solr_doc: FileDocs | DatasetDocs | dict[str, Any],
     metatype: Literal["datasets", "files"]
@@ -49,7 +74,7 @@ def _process_urls(
     data_node: str,
     globus_uuid: str,
 ) -> list[str]:
-
+    """Regex version of the url rewriting (the reference of UrlRewriter)."""
     new_uuid = globus_uuid
 
     new_urls = []
@@ -76,6 +101,103 @@ def _process_urls(
     else:
         return new_urls
 
+class UrlRewriter:
+    """Rewrite the urls of a file to a target data node and globus endpoint.
+
+    It does the same as _process_urls, the prefixes of the rewritten urls are
+    built once per target. A url is parsed by plain string operations, the
+    regex patterns are the fallback for the unusual ones (several schemes,
+    a port without a path, ...).
+    """
+
+    def __init__(self, data_node: str, globus_uuid: str):
+        self.data_node = data_node
+        self.globus_uuid = globus_uuid
+
+        self.has_globus = globus_uuid != "None"
+
+        self._domain = f"{data_node}/"
+        self._globus_prefix = f"globus:{globus_uuid}"
+        self._fileserver = f"https://{data_node}/thredds/fileServer"
+        self._opendap = f"https://{data_node}/thredds/dodsC"
+        self._gridftp = f"gsiftp://{data_node}"
+        self._globus_url_head = f"https://app.globus.org/file-manager?origin_id={globus_uuid}"
+
+    def _replace_domain_regex(self, url: str) -> str:
+        return _DOMAIN_PATTERN.sub(
+            lambda m: self.data_node + m.group(2) + '/' if m.group(2) else self.data_node + '/', url
+        )
+
+    def _replace_domain(self, url: str) -> str:
+        start = url.find("://") + 3
+        if url.find("://", start) != -1:
+            return self._replace_domain_regex(url)
+
+        end = url.find("/", start)
+        host = url[start:end] if end != -1 else url[start:]
+        if ":" in host:
+            host, _, port = host.partition(":")
+            if not port.isdecimal():
+                return self._replace_domain_regex(url)
+            host_port = f"{self.data_node}:{port}/"
+        else:
+            host_port = self._domain
+        if not host:
+            return url
+
+        return url[:start] + host_port + (url[end + 1:] if end != -1 else "")
+
+    def _replace_uuid(self, url: str) -> tuple[str, str]:
+        """Replace the endpoint of a globus url, return it with its core path."""
+        slash = url.find("/", 7)
+        if slash > 7 and url.count("globus:") == 1 and "|Globus|Globus" not in url[:slash]:
+            tail = url[slash:]
+            return self._globus_prefix + tail, tail.split("|Globus|Globus", 1)[0]
+
+        new_url = _UUID_PATTERN.sub(self.globus_uuid, url)
+        return new_url, "/" + new_url.split("globus:")[1].split("|Globus|Globus")[0].split('/', 1)[1]
+
+    def rewrite(self, urls: list[str]) -> list[str]:
+        """Rewrite the urls, with the thredds alternates built from the globus url."""
+        new_urls = []
+        urlg = None
+        core_path = ""
+        has_thredds = False
+        for url in urls:
+            new_url = self._replace_domain(url) if "://" in url else url
+            if self.has_globus and new_url.startswith("globus:"):
+                new_url, core_path = self._replace_uuid(new_url)
+                urlg = new_url
+            has_thredds = has_thredds or "thredds" in new_url
+
+            new_urls.append(new_url)
+
+        if urlg is not None and not has_thredds:
+            return [
+                f"{self._fileserver}{core_path}|application/netcdf|HTTPServer",
+                f"{self._opendap}{core_path}.html|application/opendap-html|OPENDAP",
+                f"{self._gridftp}{core_path}|application/gridftp|GridFTP",
+                urlg,
+            ]
+        return new_urls
+
+    def dataset_id(self, dataset_id: str | list[str]) -> str:
+        """Move a dataset id (some documents have it as a list) to the data node."""
+        if isinstance(dataset_id, list):
+            dataset_id = dataset_id[0]
+        return f"{dataset_id.split('|', 1)[0]}|{self.data_node}"
+
+    def globus_url(self, globus_urls: list[str]) -> list[str]:
+        """Point the globus file manager url to the globus endpoint."""
+        return [self._globus_url_head + "&" + globus_urls[0].split("&")[1]]
+
+
+@lru_cache(maxsize=32)
+def get_url_rewriter(data_node: str, globus_uuid: str) -> UrlRewriter:
+    """Get the url rewriter of a target, built once."""
+    return UrlRewriter(data_node, globus_uuid)
+
+
 def replicate_gmeta(
     gmeta: dict[str, Any],
     metatype: Literal["Dataset", "File"],
@@ -104,20 +226,6 @@ def replicate_gmeta(
     if target_data_node not in ("ornl", "newiap"):
         raise ValueError(f"Unsupported target_data_node: {target_data_node}")
 
-    # Define source and target mappings
-    DN_MAPPINGS = {
-        "llnl": ["esgf-data1.llnl.gov", "esgf-data2.llnl.gov", "aims3.llnl.gov"],
-        "anl": ["eagle.alcf.anl.gov"],
-        "nersc": ["esgf-data.nersc.gov"],
-        "ornl": ["esgf-node.ornl.gov"],
-        "iap": ["esg.lasg.ac.cn"],
-        "newiap": ["esg.iap.ac.cn"]
-    }
-
-    GLOBUS_IDS = {
-        "ornl": "dea29ae8-bb92-4c63-bdbc-260522c92fe8"
-    }
-
     if source_data_node == "iap":  # now globus link in url
         has_globus=False
         is_replica=False
@@ -129,6 +237,8 @@ def replicate_gmeta(
     if has_globus:
         tgt_globus_id = GLOBUS_IDS[target_data_node]
 
+    rewriter = get_url_rewriter(tgt_dn_list[0], tgt_globus_id)
+
     if metatype == "File":
         try:
             # id, subject, data_node, url
@@ -137,12 +247,9 @@ def replicate_gmeta(
             gmeta["entries"][0]["content"]["id"] = gmeta["subject"]
             gmeta["entries"][0]["content"]["data_node"] = tgt_dn_list[0]
 
-            newurl = _process_urls(
-                gmeta["entries"][0]["content"]["url"],
-                tgt_dn_list[0],
-                tgt_globus_id,
+            gmeta["entries"][0]["content"]["url"] = rewriter.rewrite(
+                gmeta["entries"][0]["content"]["url"]
             )
-            gmeta["entries"][0]["content"]["url"] = newurl
 
             if is_replica:
                 gmeta["entries"][0]["content"]["replica"] = True
@@ -150,13 +257,9 @@ def replicate_gmeta(
             #dataset_id
             if "dataset_id" in gmeta["entries"][0]["content"]:
                 #mxu some dataset_id is list in some doc!!!
-                temp_dataset_id = gmeta["entries"][0]["content"]["dataset_id"]
-
-                if isinstance(temp_dataset_id, list):
-                    dataset_parts = temp_dataset_id[0].split('|')
-                else:
-                    dataset_parts = temp_dataset_id.split('|')
-                gmeta["entries"][0]["content"]["dataset_id"] = f"{dataset_parts[0]}|{tgt_dn_list[0]}"
+                gmeta["entries"][0]["content"]["dataset_id"] = rewriter.dataset_id(
+                    gmeta["entries"][0]["content"]["dataset_id"]
+                )
 
             # update timestamp
             curtime = datetime.datetime.now(datetime.timezone.utc)
@@ -185,10 +288,9 @@ def replicate_gmeta(
 
             # edge case
             if "globus_url" in gmeta["entries"][0]["content"]:
-                globus_url = gmeta["entries"][0]["content"]["globus_url"][0]
-                globus_url_head=f"https://app.globus.org/file-manager?origin_id={tgt_globus_id}"
-                new_globus_url=globus_url_head+"&"+globus_url.split("&")[1]
-                gmeta["entries"][0]["content"]["globus_url"] = [new_globus_url]
+                gmeta["entries"][0]["content"]["globus_url"] = rewriter.globus_url(
+                    gmeta["entries"][0]["content"]["globus_url"]
+                )
 
         except KeyError as e:
             raise ValueError(f"Missing required field in gmeta: {e}")
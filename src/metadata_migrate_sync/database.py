@@ -1,18 +1,29 @@
 """Sqlite database for index migrationa and sync."""
 
+import hashlib
+import os
 import pathlib
+import zlib
+from collections.abc import Callable
 from datetime import datetime
 from typing import Any, ClassVar, Optional
 
 from sqlalchemy import (
     Column,
     DateTime,
+    Float,
     ForeignKey,
     Integer,
+    LargeBinary,
     Numeric,
     String,
+    UniqueConstraint,
     create_engine,
+    inspect,
+    text,
 )
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import (
     DeclarativeBase,
     Session,
@@ -20,11 +31,26 @@ from sqlalchemy.orm import (
     sessionmaker,
 )
 
+from metadata_migrate_sync.context import current_context
 from metadata_migrate_sync.globus import GlobusClient
+from metadata_migrate_sync.prov_writer import ProvWriter, ProvWriterConfig
 from metadata_migrate_sync.provenance import provenance
 from metadata_migrate_sync.solr import SolrIndexes
 
 
+class StorageConfig:
+    """config class for the storage of the provenance rows.
+
+    full: the files rows hold the index ids and the comma-joined urls,
+    compact: the files rows reference the indexes by their integer key and
+    hold the urls compressed, hashed: only the count and hash of the urls.
+    The ingest responses are trimmed to the task id and status out of full.
+    """
+
+    MODE = os.environ.get("METADATA_DB_STORAGE", "full")
+    RESPONSE_KEYS = ("task_id", "acknowledged", "success")
+
+
 # Create a base class for models
 class Base(DeclarativeBase):
     """The base class for the migration database"""
@@ -44,6 +70,18 @@ class Index(Base):
     ingest = relationship("Ingest", back_populates="index")
 
 
+class QueryTemplate(Base):
+    """The query template table class, the query of the pages without their parameters."""
+    __tablename__ = "query_template"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    digest = Column(String, nullable=False, unique=True)
+    filters_digest = Column(String)
+    template = Column(String, nullable=False)
+
+    query = relationship("Query", back_populates="template")
+
+
 class Query(Base):
     """The query table class."""
     __tablename__ = "query"
@@ -55,7 +93,10 @@ class Query(Base):
     index_id = Column(String, ForeignKey("index.index_id"))
     index = relationship("Index", back_populates="query")
 
-    query_str = Column(String, nullable=False)
+    query_str = Column(String, nullable=False)  # the per-page parameters with a template
+    template_id = Column(Integer, ForeignKey("query_template.id"))
+    template = relationship("QueryTemplate", back_populates="query")
+    id_chunk = Column(String)   # the digest of the ids of the match_any filter out of the template
 
     query_type = Column(String)
     query_time = Column(Numeric)
@@ -76,6 +117,9 @@ class Query(Base):
     cursorMark_next = Column(String) # noqa N815
     n_failed = Column(Integer, default=0)
     doc_size = Column(Integer)
+    spool_file = Column(String)
+    partition = Column(String)   # the partition of a partitioned scan
+    coalesced = Column(Integer, default=0)  # ingested with the entries of the next pages
 
 
 # success and n_failed are updated in the check code
@@ -116,6 +160,7 @@ class Datasets(Base):
     target_index = Column(String)
     uri = Column(String)
     success = Column(Integer)
+    error = Column(String)      # the rejection of a skipped document
 
 
 class Files(Base):
@@ -131,14 +176,247 @@ class Files(Base):
     target_index = Column(String)
     uri = Column(String)
     success = Column(Integer)
+    error = Column(String)      # the rejection of a skipped document
+
+
+class FilesCompact(Base):
+    """The file table class of the compact storage (see StorageConfig)."""
+    __tablename__ = "files_compact"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    pages = Column(Integer, ForeignKey("query.pages"))
+    files_id = Column(String)
+    size = Column(Integer)
+    source_key = Column(Integer, ForeignKey("index.id"))
+    target_key = Column(Integer, ForeignKey("index.id"))
+    n_urls = Column(Integer)
+    uri_hash = Column(String)
+    uri_z = Column(LargeBinary)     # the zlib of the comma-joined urls, not in the hashed mode
+    success = Column(Integer)
+    error = Column(String)
+
+
+# the files of both storages, for the sql readers (db_query); uri is null in the compact rows
+FILES_VIEW = """
+CREATE VIEW IF NOT EXISTS files_all AS
+SELECT id, pages, files_id, size, source_index, target_index, uri, success, error
+FROM files
+UNION ALL
+SELECT c.id, c.pages, c.files_id, c.size, s.index_id, t.index_id, NULL, c.success, c.error
+FROM files_compact c
+LEFT JOIN "index" s ON c.source_key = s.id
+LEFT JOIN "index" t ON c.target_key = t.id
+"""
+
+
+def compact_uri(uri: str, keep: bool = True) -> dict[str, Any]:
+    """Get the url columns of a compact files row from the comma-joined urls."""
+    return {
+        "n_urls": len(uri.split(",")) if uri and uri != "NoURL" else 0,
+        "uri_hash": hashlib.blake2b(uri.encode("utf-8"), digest_size=8).hexdigest(),
+        "uri_z": zlib.compress(uri.encode("utf-8")) if keep else None,
+    }
+
+
+def index_key(session: Session, index_id: str | None) -> int | None:
+    """Get the integer key of an index id, adding the unknown ones to the index table."""
+    if index_id is None:
+        return None
+    key = session.query(Index.id).filter(Index.index_id == index_id).scalar()
+    if key is None:
+        index = Index(index_id=index_id, index_name=index_id, index_type="unknown")
+        session.add(index)
+        session.flush()
+        key = index.id
+    return key
+
+
+class PageSummary(Base):
+    """The page summary table class, the counts of the files/datasets rows of a page."""
+    __tablename__ = "page_summary"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    pages = Column(Integer, ForeignKey("query.pages"), unique=True)
+    day = Column(String)        # the UTC day of the first rows of the page
+    n_docs = Column(Integer, default=0)
+    n_submitted = Column(Integer, default=0)    # success 0
+    n_skipped = Column(Integer, default=0)      # success -9
+    n_unchanged = Column(Integer, default=0)    # success 2
+    n_other = Column(Integer, default=0)
+    bytes = Column(Integer, default=0)
+    n_ingests = Column(Integer, default=0)
+    query_time = Column(Float, default=0)
+
+
+class DaySummary(Base):
+    """The day summary table class, the sums of the page summaries of a day."""
+    __tablename__ = "day_summary"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    day = Column(String, unique=True)
+    n_pages = Column(Integer, default=0)
+    n_docs = Column(Integer, default=0)
+    n_submitted = Column(Integer, default=0)
+    n_skipped = Column(Integer, default=0)
+    n_unchanged = Column(Integer, default=0)
+    n_other = Column(Integer, default=0)
+    bytes = Column(Integer, default=0)
+    n_ingests = Column(Integer, default=0)
+    query_time = Column(Float, default=0)
+    first_at = Column(DateTime)
+    last_at = Column(DateTime)
+
+
+class DeleteChunk(Base):
+    """The deletion chunk table class."""
+    __tablename__ = "delete_chunk"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    chunk_no = Column(Integer)
+    digest = Column(String, nullable=False, unique=True)
+    index_id = Column(String)
+    n_subjects = Column(Integer)
+    first_subject = Column(String)
+    last_subject = Column(String)
+    task_id = Column(String)
+    delete_response = Column(String)
+    delete_datetime = Column(DateTime, default=datetime.utcnow)
+    submitted = Column(Integer, default=0)
+
+
+class ShardProgress(Base):
+    """The snapshot shard loading progress table class."""
+    __tablename__ = "shard_progress"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    shard = Column(String, nullable=False, unique=True)
+    sha256 = Column(String)
+    lines_done = Column(Integer, default=0)
+    n_ingested = Column(Integer, default=0)
+    n_skipped = Column(Integer, default=0)
+    completed = Column(Integer, default=0)
+    updated = Column(DateTime, default=datetime.utcnow)
+
+
+class ScanPartition(Base):
+    """The partition table class, the split of a partitioned scan kept for its restart."""
+    __tablename__ = "scan_partition"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    partition = Column(String, nullable=False, unique=True)     # the key of the pages in the query table
+    partition_by = Column(String, nullable=False)
+    filter = Column(String, nullable=False)
+    created = Column(DateTime, default=datetime.utcnow)
+
+
+class Fingerprint(Base):
+    """The content fingerprint table class (one per target index)."""
+    __tablename__ = "fingerprint"
+    __table_args__ = (UniqueConstraint("target_index", "subject"),)
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    target_index = Column(String, nullable=False)
+    subject = Column(String, nullable=False)
+    digest = Column(String, nullable=False)
+    task_id = Column(String)
+    updated = Column(DateTime, default=datetime.utcnow)
+
+
+class SnapshotSubject(Base):
+    """The subject snapshot table class, the subjects of a staged index synced to a target."""
+    __tablename__ = "snapshot_subject"
+    __table_args__ = (UniqueConstraint("source_index", "subject"),)
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    source_index = Column(String, nullable=False)
+    subject = Column(String, nullable=False)
+    bucket = Column(String, nullable=False, index=True)    # the _timestamp bucket of the subject
+    updated = Column(DateTime, default=datetime.utcnow)
+
+
+class SnapshotBucket(Base):
+    """The subject snapshot bucket table class, the count of a bucket at its last check."""
+    __tablename__ = "snapshot_bucket"
+    __table_args__ = (UniqueConstraint("source_index", "bucket"),)
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    source_index = Column(String, nullable=False)
+    bucket = Column(String, nullable=False)
+    n_subjects = Column(Integer, default=0)
+    checked = Column(DateTime)
+
+
+class Transfer(Base):
+    """The transfer table class, one row per submitted batch of files."""
+    __tablename__ = "transfer"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    batch_n = Column(Integer)
+    digest = Column(String, nullable=False, unique=True)
+    label = Column(String)
+    source_ep = Column(String)
+    target_ep = Column(String)
+    n_files = Column(Integer)
+    first_path = Column(String)
+    last_path = Column(String)
+    submission_id = Column(String)
+    task_id = Column(String)
+    status = Column(String)     # ACTIVE, INACTIVE, SUCCEEDED or FAILED
+    transfer_response = Column(String)
+    transfer_datetime = Column(DateTime, default=datetime.utcnow)
+    updated = Column(DateTime, default=datetime.utcnow)
+    submitted = Column(Integer, default=0)
+
+
+class WorkUnit(Base):
+    """The work queue table class, one row per unit of a distributed migration."""
+    __tablename__ = "work_unit"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    kind = Column(String, nullable=False)   # migrate, replica or revise
+    label = Column(String)      # the time slice or the pages of the id chunk
+    spec = Column(String, nullable=False)   # the json arguments of the pipeline
+    status = Column(String, default="pending")  # pending, leased, done or failed
+    worker = Column(String)
+    lease_expires = Column(DateTime)
+    heartbeat_at = Column(DateTime)
+    attempts = Column(Integer, default=0)
+    result = Column(String)     # the json result (the database of the unit) or the last error
+    updated = Column(DateTime, default=datetime.utcnow)
+
+
+def _add_missing_columns(engine: Engine) -> None:
+    """Add the columns introduced after a database file was created.
+
+    create_all does not alter existing tables, so resuming from an older
+    database would fail on the new (nullable) columns.
+    """
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {col["name"] for col in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                col_type = column.type.compile(dialect=engine.dialect)
+                conn.execute(
+                    text(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {col_type}')
+                )
 
 
 class MigrationDB:
-    """it is a singleton class."""
+    """it is a singleton class, or one instance per bound RunContext."""
 
     _instance: ClassVar[Optional["MigrationDB"]] = None
     initialized: bool
     def __new__(cls, *args:Any, **kwargs:Any) -> "MigrationDB":  # noqa D102
+        ctx = current_context()
+        if ctx is not None:
+            if ctx.db is None:
+                ctx.db = super().__new__(cls)
+                ctx.db.initialized = False
+            return ctx.db
+
         if not cls._instance:
             cls._instance = super().__new__(cls)
             cls._instance.initialized = False
@@ -148,17 +426,27 @@ class MigrationDB:
     def __init__(self, db_filename: str | pathlib.Path, insert_index: bool):
         if not self.initialized:
 
+            # the records of the previous database are committed first
+            self._close_writer()
+
             self._DATABASE_URL = f"sqlite:///{db_filename}"
             self._engine = create_engine(self._DATABASE_URL, echo=False)
             Base.metadata.create_all(self._engine)
 
             logger = provenance.get_logger(__name__)
 
+            try:
+                _add_missing_columns(self._engine)
+                with self._engine.begin() as conn:
+                    conn.execute(text(FILES_VIEW))
+            except OperationalError as e:
+                logger.warning(f"cannot add the new columns to {db_filename}: {e}")
+
 
             logger.info("this is the only initalization in database")
 
+            self.DBsession = sessionmaker(bind=self._engine)
             if insert_index:
-                self.DBsession = sessionmaker(bind=self._engine)
                 with self.DBsession() as session:
 
                     if session.query(Index).count() > 0:
@@ -194,10 +482,63 @@ class MigrationDB:
                         session.commit()
     @classmethod
     def get_session(cls) -> sessionmaker[Session]:
-        """Get the database session."""
-        if cls._instance is not None or (not hasattr(cls._instance, "DBsession")):
-            cls._instance.DBsession = sessionmaker(bind=cls._instance._engine)
-        else:
+        """Get the database session (of the bound RunContext if any)."""
+        ctx = current_context()
+        instance = ctx.db if ctx is not None else cls._instance
+        if instance is None:
+            raise ValueError("database is not initialized")
+
+        return instance.DBsession
+
+    @classmethod
+    def _current(cls) -> "MigrationDB":
+        ctx = current_context()
+        instance = ctx.db if ctx is not None else cls._instance
+        if instance is None:
             raise ValueError("database is not initialized")
+        return instance
 
-        return cls._instance.DBsession
+    def _close_writer(self) -> None:
+        writer = getattr(self, "_writer", None)
+        self._writer = None
+        if writer is not None:
+            writer.close()
+
+    @classmethod
+    def start_writer(
+        cls,
+        group_size: int = ProvWriterConfig.GROUP_SIZE,
+        group_ms: int = ProvWriterConfig.GROUP_MS,
+    ) -> None:
+        """Write the provenance records behind the pipeline (see prov_writer)."""
+        instance = cls._current()
+        if getattr(instance, "_writer", None) is None:
+            instance._writer = ProvWriter(
+                instance.DBsession, group_size, group_ms, logger=provenance.get_logger(__name__)
+            )
+
+    @classmethod
+    def stop_writer(cls) -> None:
+        """Commit the queued records and stop the writer."""
+        cls._current()._close_writer()
+
+    @classmethod
+    def write(cls, record: Callable[[Session], None]) -> None:
+        """Run a record in a transaction, in the writer if it is started."""
+        instance = cls._current()
+        writer = getattr(instance, "_writer", None)
+        if writer is not None:
+            writer.submit(record)
+            return
+
+        with instance.DBsession() as session, session.begin():
+            record(session)
+
+    @classmethod
+    def barrier(cls) -> None:
+        """Wait until the queued records are committed (no-op without the writer)."""
+        ctx = current_context()
+        instance = ctx.db if ctx is not None else cls._instance
+        writer = getattr(instance, "_writer", None)
+        if writer is not None:
+            writer.barrier()
@@ -1,6 +1,41 @@
 import sqlite3
 import os
 import json
+from collections.abc import Iterator
+
+
+def iter_skipped(
+    db_file_path: str,
+    meta: str,
+) -> Iterator[tuple[str, str]]:
+    """
+    Yield the (id, date_range) of the skipped documents, read row by row
+    """
+    db_uri = f"file:{db_file_path}?mode=ro"
+    with sqlite3.connect(db_uri, uri=True) as connection:
+        cursor = connection.cursor()
+
+        # the files of the compact storage are in the files_all view too
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'view' AND name = 'files_all'")
+        files_table = "files_all" if cursor.fetchone() else "files"
+
+        if meta == "Dataset":
+            query = """
+            SELECT d.datasets_id, q.date_range
+            FROM datasets d
+            JOIN query q ON d.pages = q.pages
+            WHERE d.success = -9
+            """
+        else:
+            query = f"""
+            SELECT f.files_id, q.date_range
+            FROM {files_table} f
+            JOIN query q ON f.pages = q.pages
+            WHERE f.success = -9
+            """  # noqa: S608
+
+        yield from cursor.execute(query)
+
 
 def query_files_table_context(
     db_file_path: str, 
@@ -14,38 +49,7 @@ def query_files_table_context(
         return []
 
     try:
-        db_uri = f"file:{db_file_path}?mode=ro"
-        with sqlite3.connect(db_uri, uri=True) as connection:
-            cursor = connection.cursor()
-
-            if meta == "Dataset":
-                query = """
-                SELECT f.datasets_id, q.date_range
-                FROM files f
-                JOIN query q ON f.pages = q.id
-                WHERE f.success = -9
-                """
-                #cursor.execute("SELECT datasets_id FROM datasets WHERE success = -9")
-            else:
-                query = """
-                SELECT f.files_id, q.date_range
-                FROM files f
-                JOIN query q ON f.pages = q.id
-                WHERE f.success = -9
-                """
-                #cursor.execute("SELECT files_id FROM files WHERE success = -9")
-
-            # Execute the query
-            cursor.execute(query)
-            # Fetch all results
-            results = cursor.fetchall()
-        
-            return results
-            # Get all files_id values in one line
-            #-files_ids = [row[0] for row in cursor.fetchall()]
-
-            #-print(f"Found {len(files_ids)} records where success = -9")
-            #-return files_ids
+        return list(iter_skipped(db_file_path, meta))
 
     except sqlite3.Error as e:
         print(f"SQLite error: {e}")
@@ -53,4 +57,3 @@ def query_files_table_context(
     except Exception as e:
         print(f"Error: {e}")
         return []
-
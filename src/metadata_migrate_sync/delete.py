@@ -1,15 +1,23 @@
-
-
-import math
+"""Delete documents (subjects) from globus indexes."""
+import gzip
+import hashlib
+import logging
 import pathlib
 import sys
+from collections.abc import Callable, Generator, Iterable, Iterator
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from datetime import datetime
+from itertools import islice
 from typing import Any, Literal
+from uuid import UUID
 
+import ijson
+from globus_sdk import GlobusAPIError, SearchClient
 from pydantic import validate_call
 from tqdm import tqdm
 
-from metadata_migrate_sync.database import MigrationDB
+from metadata_migrate_sync.codec import dumps, loads
+from metadata_migrate_sync.database import DeleteChunk, MigrationDB
 from metadata_migrate_sync.globus import GlobusClient
 from metadata_migrate_sync.ingest import GlobusIngest
 from metadata_migrate_sync.project import ProjectReadOnly, ProjectReadWrite
@@ -17,6 +25,13 @@ from metadata_migrate_sync.provenance import provenance
 from metadata_migrate_sync.query import GlobusQuery
 
 
+class DeleteConfig:
+    """config class for deletion."""
+
+    MAX_SUBJECTS = 2000     # subjects in one batch_delete_by_subject call
+    MAX_WORKERS = 4
+
+
 def _get_subjects(page: dict[str, Any]) -> list[str]:
 
     subjects_list=[]
@@ -25,6 +40,167 @@ def _get_subjects(page: dict[str, Any]) -> list[str]:
     return subjects_list
 
 
+def _subject_of(item: str | dict[str, Any], project: str | None) -> str:
+    """Get the subject of a json item (subject string or gmeta entry)."""
+    if isinstance(item, str):
+        return item
+
+    if project is not None and item.get("entries"):
+        project_in_doc = item["entries"][0]["content"].get("project")
+        if project_in_doc is not None and project_in_doc != [project]:
+            raise ValueError(
+                f"the project of the document {project_in_doc}, but the project {project} is provided"
+            )
+    return item["subject"]
+
+
+def iter_subjects_file(
+    file_path: str | pathlib.Path,
+    project: str | None = None,
+) -> Generator[str, None, None]:
+    """Stream the subjects from a json or ndjson file.
+
+    The json file is a saved globus page ({"gmeta": [...]}) or a list of
+    subjects/gmeta entries. The ndjson (.ndjson, .jsonl, optionally gzipped)
+    has one subject string or gmeta entry per line.
+    """
+    path = pathlib.Path(file_path)
+    suffixes = path.suffixes
+    opener = gzip.open if suffixes and suffixes[-1] == ".gz" else open
+
+    if ".ndjson" in suffixes or ".jsonl" in suffixes:
+        with opener(path, "rt", encoding="utf-8") as fh:
+            for line in fh:
+                if line.strip():
+                    yield _subject_of(loads(line), project)
+        return
+
+    with opener(path, "rb") as fh:
+        first = fh.read(1)
+        while first.isspace():
+            first = fh.read(1)
+        fh.seek(0)
+        prefix = "item" if first == b"[" else "gmeta.item"
+        for item in ijson.items(fh, prefix):
+            yield _subject_of(item, project)
+
+
+def iter_subjects_query(gq: GlobusQuery) -> Generator[str, None, None]:
+    """Stream the subjects from a globus query."""
+    for page in gq.run():
+        if len(page) == 0:
+            break
+        yield from _get_subjects(page)
+
+
+def _chunked(subjects: Iterable[str], size: int) -> Iterator[list[str]]:
+    it = iter(subjects)
+    while chunk := list(islice(it, size)):
+        yield chunk
+
+
+def _chunk_digest(chunk: list[str]) -> str:
+    return hashlib.sha256("\n".join(chunk).encode("utf-8")).hexdigest()
+
+
+def _delete_chunk(
+    sc: SearchClient,
+    index_id: str | UUID,
+    chunk: list[str],
+) -> dict[str, Any]:
+    """Delete a chunk of subjects, the 429 is retried by the rate limiter."""
+    return sc.batch_delete_by_subject(index_id, subjects=chunk).data
+
+
+def batch_delete_subjects(
+    sc: SearchClient,
+    index_id: str | UUID,
+    subjects: Iterable[str],
+    *,
+    chunk_size: int = DeleteConfig.MAX_SUBJECTS,
+    max_workers: int = DeleteConfig.MAX_WORKERS,
+    dry_run: bool = False,
+    on_deleted: Callable[[list[str], dict[str, Any]], None] | None = None,
+) -> dict[str, int]:
+    """Delete the streamed subjects in chunks with a bounded number of concurrent calls.
+
+    Every submitted chunk is recorded in the delete_chunk table by the digest of
+    its subjects, so an interrupted deletion skips the confirmed chunks on resume.
+    With dry_run the chunks are only logged and counted (dry_run_chunks).
+    on_deleted is called with the subjects and the response of each deleted chunk.
+    """
+    logger = provenance.get_logger(__name__)
+    DBsession = MigrationDB.get_session()
+
+    with DBsession() as session:
+        done = {digest for (digest,) in session.query(DeleteChunk.digest).filter_by(submitted=1)}
+
+    counts = {
+        "chunks": 0, "subjects": 0, "skipped_chunks": 0, "failed_chunks": 0,
+        "dry_run_chunks": 0, "dry_run_subjects": 0,
+    }
+
+    def _record(chunk_no: int, digest: str, chunk: list[str], data: dict[str, Any] | None) -> None:
+        with DBsession() as session, session.begin():
+            session.merge(DeleteChunk(
+                id=session.query(DeleteChunk.id).filter_by(digest=digest).scalar(),
+                chunk_no=chunk_no,
+                digest=digest,
+                index_id=str(index_id),
+                n_subjects=len(chunk),
+                first_subject=chunk[0],
+                last_subject=chunk[-1],
+                task_id=data.get("task_id") if data else None,
+                delete_response=dumps(data) if data else None,
+                submitted=1 if data else 0,
+            ))
+
+    def _collect(futures: dict[Future[dict[str, Any]], tuple[int, str, list[str]]], block: bool) -> None:
+        finished, _ = wait(futures, return_when=FIRST_COMPLETED) if block else (
+            [f for f in futures if f.done()], None)
+        for fut in finished:
+            chunk_no, digest, chunk = futures.pop(fut)
+            try:
+                data = fut.result()
+            except GlobusAPIError as e:
+                logger.error(f"failed to delete the chunk {chunk_no}: {e}")
+                counts["failed_chunks"] += 1
+                _record(chunk_no, digest, chunk, None)
+                continue
+            counts["chunks"] += 1
+            counts["subjects"] += len(chunk)
+            _record(chunk_no, digest, chunk, data)
+            if on_deleted is not None:
+                on_deleted(chunk, data)
+            logger.info(f"deleted the chunk {chunk_no} ({len(chunk)}) task {data.get('task_id')}")
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures: dict[Future[dict[str, Any]], tuple[int, str, list[str]]] = {}
+        for chunk_no, chunk in enumerate(_chunked(subjects, chunk_size), start=1):
+            digest = _chunk_digest(chunk)
+            if digest in done:
+                counts["skipped_chunks"] += 1
+                continue
+
+            if dry_run:
+                logger.info(f"dry run, the chunk {chunk_no} ({len(chunk)}) from {chunk[0]} to {chunk[-1]}")
+                counts["dry_run_chunks"] += 1
+                counts["dry_run_subjects"] += len(chunk)
+                continue
+
+            while len(futures) >= max_workers:
+                _collect(futures, block=True)
+
+            futures[executor.submit(_delete_chunk, sc, index_id, chunk)] = (chunk_no, digest, chunk)
+            _collect(futures, block=False)
+
+        while futures:
+            _collect(futures, block=True)
+
+    logger.info(f"deletion finished {counts}")
+    return counts
+
+
 @validate_call
 def metadata_delete_llnl(
     *,
@@ -32,7 +208,8 @@ def metadata_delete_llnl(
     project: ProjectReadOnly | ProjectReadWrite,
     production: bool,
     dryrun: bool,
-) -> None:
+    max_workers: int = DeleteConfig.MAX_WORKERS,
+) -> dict[str, int]:
 
     globus_client, globus_index = GlobusClient.get_client_index_names(globus_epname, project.value)
 
@@ -131,67 +308,47 @@ def metadata_delete_llnl(
         paginator="scroll",
     )
 
-    # ingest
+    # provenance of the deleted subjects, as the files of an ingest
     ig = GlobusIngest(
         end_point=prov.ingest_index_id,
         ep_name=globus_epname,
         project=project,
     )
 
+    def _prov_collect(chunk: list[str], data: dict[str, Any]) -> None:
+        ig._response_data = data
+        ig._submitted = True
+        ig.prov_collect(
+            [{"id": subject} for subject in chunk],
+            review=False,
+            current_query=None,
+            metatype="files",
+        )
+
     sc = GlobusClient().get_client(globus_epname).search_client
 
     logger.info("instantiate query classes")
-    with tqdm(
-         gq.run(),
-         desc="Processing",
-         unit="page",
-         colour="blue",
-         bar_format="{l_bar}{bar:50}{r_bar}",
-         ncols=100,
-         ascii=" ░▒▓█",
-     ) as pbar:
-
-         for page_num, page in enumerate(pbar):
-             if not pbar.total and hasattr(gq, "_numFound") and gq._numFound:
-                 pbar.total = math.ceil(gq._numFound / gq.query["limit"])
-
-             if len(page) == 0:
-                 logger.info(f"Empty page {page_num}. stop deleting!")
-                 break
-
-
-             del_subjects_list=_get_subjects(page)
-
-             if len(del_subjects_list) == 0:
-                 continue
-
-             ig._submitted = False
-
-             if dryrun:
-                 ig._submitted = True
-                 print (page)
-                 print (del_subjects_list)
-             else:
-                 response = sc.batch_delete_by_subject(
-                     _globus_index_id,
-                     subjects=del_subjects_list,
-                 )
-                 ig._response_data = response.data
-                 ig._submitted = True
-
-             ig.prov_collect(
-                [
-                    gmeta["entries"][0]["content"]
-                    for gmeta in page["gmeta"]
-                ],
-                review=False,
-                current_query=gq._current_query,
-                metatype="files",
-             )
-
-             if not production and (maxpage is not None) and page_num >= maxpage:
-                 break
+
+    subjects = iter_subjects_query(gq)
+    if not production and maxpage is not None:
+        subjects = islice(subjects, (maxpage + 1) * search_dict["limit"])
+
+    counts = batch_delete_subjects(
+        sc,
+        _globus_index_id,
+        tqdm(subjects, desc="Deleting", unit="subject", colour="blue", ncols=100),
+        chunk_size=search_dict["limit"],
+        max_workers=max_workers,
+        dry_run=dryrun,
+        on_deleted=_prov_collect,
+    )
 
     current_timestr = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     logger.info(f"Deletion stop at {current_timestr}")
-    logger.info(f"Processed total pages: {page_num}")
+    logger.info(f"Deleted total subjects: {counts['subjects']} in {counts['chunks']} chunks")
+    if dryrun:
+        logger.info(
+            f"Dry run total subjects: {counts['dry_run_subjects']} in {counts['dry_run_chunks']} chunks"
+        )
+
+    return counts
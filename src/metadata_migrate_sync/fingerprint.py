@@ -0,0 +1,140 @@
+"""Content fingerprints of the documents written to a target index.
+
+The fingerprint is a stable hash of a gmeta entry without the volatile
+fields, so a document re-read in an overlapping sync window can be dropped
+from the ingest when the target already holds the same content.
+
+The fingerprints of a submitted ingest task are staged, and stored only
+when the task tracker finds the task succeeded. The staged fingerprints of
+a failed task, or of a task still pending at the end of the run, are
+dropped, so these documents are submitted again by the next sync.
+"""
+import hashlib
+import pathlib
+import threading
+from datetime import datetime
+from typing import Any
+
+from sqlalchemy import create_engine, delete, select
+from sqlalchemy.dialects.sqlite import insert
+
+from metadata_migrate_sync.codec import dumps
+from metadata_migrate_sync.database import Fingerprint
+
+# fields changing without a change of the document itself
+VOLATILE_FIELDS = frozenset({"_timestamp", "_version_", "score", "skip_ingest", "skip_unchanged"})
+
+
+class FingerprintConfig:
+    """config class for fingerprint store."""
+
+    LOOKUP_CHUNK = 500
+
+
+def content_fingerprint(gmeta: dict[str, Any]) -> str:
+    """Get the stable hash of a gmeta entry without the volatile fields."""
+    content = {k: v for k, v in gmeta["content"].items() if k not in VOLATILE_FIELDS}
+    stable = {
+        "id": gmeta.get("id"),
+        "visible_to": gmeta.get("visible_to"),
+        "content": content,
+    }
+    encoded = dumps(stable, compact=True, sort_keys=True, default=str)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+class FingerprintStore:
+    """Fingerprints of the subjects in a target index.
+
+    It is kept in its own sqlite file, which outlives the per-day sync databases.
+    """
+
+    def __init__(self, db_filename: str | pathlib.Path, target_index: str):
+        self.target_index = str(target_index)
+        self._engine = create_engine(f"sqlite:///{db_filename}", echo=False)
+        Fingerprint.metadata.create_all(self._engine, tables=[Fingerprint.__table__])
+
+        # the (subject, digest) of the submitted tasks not known to have succeeded
+        self._staged: dict[str, list[tuple[str, str]]] = {}
+        self._lock = threading.Lock()
+
+    def lookup(self, subjects: list[str]) -> dict[str, str]:
+        """Get the stored digests of the subjects."""
+        digests: dict[str, str] = {}
+        with self._engine.connect() as conn:
+            for i in range(0, len(subjects), FingerprintConfig.LOOKUP_CHUNK):
+                stmt = select(Fingerprint.subject, Fingerprint.digest).where(
+                    Fingerprint.target_index == self.target_index,
+                    Fingerprint.subject.in_(subjects[i:i + FingerprintConfig.LOOKUP_CHUNK]),
+                )
+                digests.update({subject: digest for subject, digest in conn.execute(stmt)})
+        return digests
+
+    def filter_unchanged(
+        self, gmeta_list: list[dict[str, Any]]
+    ) -> tuple[list[dict[str, Any]], list[dict[str, Any]]]:
+        """Split the gmeta entries into the changed and the unchanged ones."""
+        stored = self.lookup([g["subject"] for g in gmeta_list])
+
+        changed = []
+        unchanged = []
+        for g in gmeta_list:
+            if stored.get(g["subject"]) == content_fingerprint(g):
+                unchanged.append(g)
+            else:
+                changed.append(g)
+        return changed, unchanged
+
+    def record(self, gmeta_list: list[dict[str, Any]], task_id: str | None = None) -> None:
+        """Store the digests of the gmeta entries known to be in the target."""
+        self._store([(g["subject"], content_fingerprint(g)) for g in gmeta_list], task_id)
+
+    def stage(self, gmeta_list: list[dict[str, Any]], task_id: str) -> None:
+        """Keep the digests of the entries of a submitted task until the task succeeds."""
+        digests = [(g["subject"], content_fingerprint(g)) for g in gmeta_list]
+        with self._lock:
+            self._staged.setdefault(task_id, []).extend(digests)
+
+    def commit_task(self, task_id: str) -> None:
+        """Store the staged digests of a succeeded ingest task."""
+        with self._lock:
+            digests = self._staged.pop(task_id, [])
+        self._store(digests, task_id)
+
+    def _store(self, digests: list[tuple[str, str]], task_id: str | None) -> None:
+        if not digests:
+            return
+
+        now = datetime.utcnow()
+        rows = [
+            {
+                "target_index": self.target_index,
+                "subject": subject,
+                "digest": digest,
+                "task_id": task_id,
+                "updated": now,
+            }
+            for subject, digest in digests
+        ]
+        with self._engine.begin() as conn:
+            for i in range(0, len(rows), FingerprintConfig.LOOKUP_CHUNK):
+                stmt = insert(Fingerprint).values(rows[i:i + FingerprintConfig.LOOKUP_CHUNK])
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=["target_index", "subject"],
+                    set_={
+                        "digest": stmt.excluded.digest,
+                        "task_id": stmt.excluded.task_id,
+                        "updated": stmt.excluded.updated,
+                    },
+                )
+                conn.execute(stmt)
+
+    def forget_task(self, task_id: str) -> None:
+        """Drop the digests of the entries of a failed ingest task, to submit them again."""
+        with self._lock:
+            self._staged.pop(task_id, None)
+        with self._engine.begin() as conn:
+            conn.execute(delete(Fingerprint).where(
+                Fingerprint.target_index == self.target_index,
+                Fingerprint.task_id == task_id,
+            ))
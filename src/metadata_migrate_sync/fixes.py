@@ -4,19 +4,24 @@ import math
 import pathlib
 import sys
 from datetime import datetime
-from typing import Literal
+from functools import partial
+from typing import Any, Literal
 
 from pydantic import validate_call
+from sqlalchemy.orm import Session
 from tqdm import tqdm
 
+from metadata_migrate_sync.coalesce import CoalesceConfig, IngestCoalescer
+from metadata_migrate_sync.codec import dumps, loads
 from metadata_migrate_sync.convert import fix_dtype_gmeta
-from metadata_migrate_sync.database import MigrationDB, Query
+from metadata_migrate_sync.database import Ingest, MigrationDB, Query, ScanPartition
 from metadata_migrate_sync.globus import GlobusClient, GlobusCV
 from metadata_migrate_sync.gmeta import ModifiedGmetaGenerator
 from metadata_migrate_sync.ingest import GlobusIngest
+from metadata_migrate_sync.partition import facet_partitions, facet_values, histogram_partitions
 from metadata_migrate_sync.project import ProjectReadOnly, ProjectReadWrite
 from metadata_migrate_sync.provenance import provenance
-from metadata_migrate_sync.query import GlobusQuery
+from metadata_migrate_sync.query import GlobusQuery, PartitionedGlobusQuery, partition_key
 from metadata_migrate_sync.sync import _process_batches
 
 
@@ -26,6 +31,39 @@ class FixesConfig:
     PROD_MAX_INGEST_SIZE = 10 * 1000 * 1000 - 1000  # 10MB with buffer
     TEST_MAX_INGEST_SIZE = 20000
     TEST_MAX_PAGES = 2
+    EARLIEST_TIMESTAMP = datetime(2000, 1, 1)
+
+
+def _record_n_batch(session: Session, query_id: int, n_failed: int) -> None:
+    """Set the number of the ingest rows of a page, a failed submission is missing."""
+    prepage = session.get(Query, query_id)
+    if prepage is not None:
+        n_rows = session.query(Ingest).filter(Ingest.pages == prepage.pages).count()
+        prepage.n_datasets = n_rows + n_failed  # type: ignore[assignment]
+    else:
+        raise ValueError("cannot find the previous page in the query table")
+
+
+def _stored_partitions(partition_by: str) -> list[dict[str, Any]]:
+    """Get the partitions of the previous run, to resume every partition on its own."""
+    with MigrationDB.get_session()() as session:
+        rows = (
+            session.query(ScanPartition)
+            .filter(ScanPartition.partition_by == partition_by)
+            .order_by(ScanPartition.id)
+            .all()
+        )
+        return [loads(row.filter) for row in rows]
+
+
+def _store_partitions(partition_by: str, split: list[dict[str, Any]]) -> None:
+    """Keep the partitions of the first run, their boundaries are not computed again."""
+    with MigrationDB.get_session()() as session, session.begin():
+        session.add_all(
+            ScanPartition(partition=partition_key(p), partition_by=partition_by, filter=dumps(p))
+            for p in split
+        )
+
 
 @validate_call
 def metadata_fixes(
@@ -34,9 +72,20 @@ def metadata_fixes(
     project: ProjectReadWrite | ProjectReadOnly,
     production: bool,
     start_time: datetime | None = None,
-    dry_run: bool = True
+    dry_run: bool = True,
+    partitions: int | None = None,
+    partition_by: str = "_timestamp",
+    coalesce: bool = False,
+    max_age: float = CoalesceConfig.MAX_AGE,
 ) -> None:
-    """Sync the metadata between two Globus Indexes."""
+    """Sync the metadata between two Globus Indexes.
+
+    With partitions, the index is scrolled in disjoint partitions concurrently,
+    split by the _timestamp histogram or by the values of the partition_by field.
+    The split of the first run is kept in the database and reused on restart.
+    With coalesce, the fixed entries of consecutive pages fill the ingest
+    requests up to the size limit, or for max_age seconds.
+    """
 
     globus_client, globus_index = GlobusClient.get_client_index_names(globus_epname, project.value)
 
@@ -72,6 +121,7 @@ def metadata_fixes(
 
     # database
     _ = MigrationDB(prov.db_file, True)
+    MigrationDB.start_writer()
     logger.info(f"initialized the sqlite database at {prov.db_file}")
 
     # query generator
@@ -96,15 +146,51 @@ def metadata_fixes(
         search_dict["limit"] = 2
         maxpage = 2
 
-    gq = GlobusQuery(
-        end_point=prov.source_index_id,
-        ep_type="globus",
-        ep_name=globus_epname,
-        project=project,
-        query=search_dict,
-        generator=True,
-        paginator="scroll",
-    )
+    gq: GlobusQuery | PartitionedGlobusQuery
+    split: list[dict[str, Any]] = []
+    if partitions:
+        split = _stored_partitions(partition_by)
+        if split:
+            logger.info(f"resume the {len(split)} partitions of the previous run")
+
+    if partitions and not split:
+        sc = GlobusClient.get_client(globus_epname).search_client
+        if partition_by == "_timestamp":
+            split = histogram_partitions(
+                sc,
+                prov.source_index_id,
+                search_dict["filters"],
+                FixesConfig.EARLIEST_TIMESTAMP,
+                # the fixed documents get a new _timestamp after now, out of all the ranges
+                datetime.utcnow(),
+                partitions,
+            )
+        else:
+            values = facet_values(sc, prov.source_index_id, search_dict["filters"], partition_by)
+            split = facet_partitions(partition_by, [value for value, _ in values])
+
+        _store_partitions(partition_by, split)
+        logger.info(f"scroll {len(split)} partitions by {partition_by}")
+
+    if split:
+        gq = PartitionedGlobusQuery(
+            end_point=prov.source_index_id,
+            ep_type="globus",
+            ep_name=globus_epname,
+            project=project,
+            query=search_dict,
+            partitions=split,
+        )
+    else:
+        gq = GlobusQuery(
+            end_point=prov.source_index_id,
+            ep_type="globus",
+            ep_name=globus_epname,
+            project=project,
+            query=search_dict,
+            generator=True,
+            paginator="scroll",
+        )
 
     # ingest
     ig = GlobusIngest(
@@ -113,6 +199,16 @@ def metadata_fixes(
         project=project,
     )
 
+    coalescer = None
+    if coalesce:
+        coalescer = IngestCoalescer(
+            ig,
+            FixesConfig.PROD_MAX_INGEST_SIZE if production else FixesConfig.TEST_MAX_INGEST_SIZE,
+            max_age=max_age,
+            dry_run=dry_run,
+        )
+        logger.info("coalesce the ingest entries of consecutive pages")
+
     logger.info("instantiate query and ingest classes")
 
     for step in ["normal"]:
@@ -137,8 +233,8 @@ def metadata_fixes(
         ) as pbar:
 
             for page_num, page in enumerate(pbar):
-                if not pbar.total and hasattr(gq, "_numFound") and gq._numFound:
-                    pbar.total = math.ceil(gq._numFound / gq.query["limit"])
+                if not pbar.total and hasattr(gq, "_num_found") and gq._num_found:
+                    pbar.total = math.ceil(gq._num_found / gq.query["limit"])
 
                 if len(page) == 0:
                     logger.info(f"Empty page {page_num}. stop fixes!")
@@ -180,6 +276,16 @@ def metadata_fixes(
                     skip_size = len(gmeta_ingest_skipped[GlobusCV.INGEST_DATA.value][GlobusCV.GMETA.value])
                     logger.info(f"Skipped {skip_size}")
 
+                if coalescer is not None:
+                    # the page is closed after its entries are ingested, with the next pages
+                    coalescer.add(
+                        gq._current_query, gmeta_ingest[GlobusCV.INGEST_DATA.value][GlobusCV.GMETA.value]
+                    )
+
+                    if not production and (maxpage is not None) and page_num > maxpage:
+                        break
+                    continue
+
                 if len(gmeta_ingest[GlobusCV.INGEST_DATA.value][GlobusCV.GMETA.value]) == 0:
                     continue
 
@@ -190,6 +296,7 @@ def metadata_fixes(
                 else:
                     batches = _process_batches(gmeta_list, FixesConfig.TEST_MAX_INGEST_SIZE)
 
+                n_failed = 0
                 for n_batch, batch in enumerate(batches, start=1):
 
                     gq._n_batch = n_batch
@@ -207,6 +314,8 @@ def metadata_fixes(
                                 }
                             }
                         )
+                    if not ig._submitted:
+                        n_failed += 1
 
                     ig.prov_collect(
                         [g[GlobusCV.CONTENT.value] for g in batch],
@@ -216,21 +325,22 @@ def metadata_fixes(
                         batch_num=gq._n_batch,
                     )
 
-                # update the n_batch in the query table
-                DBsession = MigrationDB.get_session()
-                with DBsession() as session, session.begin():
-                    prepage = session.query(Query).order_by(Query.id.desc()).first()
-                    if prepage is not None:
-                        prepage.n_datasets = gq._n_batch  # type: ignore[assignment]
-                        gq._n_batch = 0
-                    else:
-                        raise ValueError("cannot find the previous page in the query table")
+                # update the n_batch in the query table, after the ingest rows of the page
+                # (the page of this batch, not the last page of the other partitions)
+                MigrationDB.write(
+                    partial(_record_n_batch, query_id=gq._current_query.id, n_failed=n_failed)
+                )
+                gq._n_batch = 0
 
                 logger.info(f"Batch {gq._n_batch} ingested successfully for the page{page_num}")
 
                 if not production and (maxpage is not None) and page_num > maxpage:
                     break
 
+        if coalescer is not None:
+            coalescer.close()
+            logger.info(f"Coalesced ingest requests: {coalescer.n_flushed}")
+
         # set the marker of the end of this query/search
         #-DBsession = MigrationDB.get_session()
         #-with DBsession() as session, session.begin():
@@ -241,6 +351,8 @@ def metadata_fixes(
         #-        raise ValueError("cannot find the previous page in the query table")
 
 
+    MigrationDB.stop_writer()
+
     current_timestr = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     logger.info(f"Fixes stop at {current_timestr}")
     logger.info(f"Processed total pages: {page_num}")
@@ -1,6 +1,7 @@
 """Globus index handlers and CVs and methods."""
 import pathlib
 import os
+import threading
 from enum import Enum
 from typing import Any, Literal
 from uuid import UUID
@@ -22,6 +23,7 @@ from pydantic import BaseModel, ConfigDict, field_validator
 from metadata_migrate_sync.esgf_index_schema.schema_solr import DatasetDocs, FileDocs
 from metadata_migrate_sync.project import ProjectReadWrite
 from metadata_migrate_sync.provenance import provenance
+from metadata_migrate_sync.ratelimit import install
 
 
 class GlobusCV(str, Enum):
@@ -209,6 +211,7 @@ class GlobusClient:
     """
 
     globus_clients: dict[str, ClientModel] = {}
+    _client_lock = threading.Lock()
 
     _client_test = {
         "app_client_id": "fe862e63-f3bb-457a-9662-995832bb692f",
@@ -363,31 +366,34 @@ class GlobusClient:
                 #client_prod_all["search_client"] = get_authorized_confidentialapp_client(
                 #    client_prod_all["app_client_id"],
                 #)
-                client_prod_all["search_client"] = cls.get_authorizor(
+                client_prod_all["search_client"] = install(cls.get_authorizor(
                     client_prod_all["app_client_id"],
                     client_prod_all["token_name"],
-                )
+                ))
 
 
             return ClientModel(**client_prod_all)
 
 
         else:
-            if cls.globus_clients[client_name].search_client is None:
-                logger.info(f"no search client and request for the client {client_name}")
-
-                #-cls.globus_clients[client_name].search_client = get_authorized_search_client(
-                #-    cls.globus_clients[client_name].app_client_id,
-                #-    cls.globus_clients[client_name].token_name,
-                #-)
-                #cls.globus_clients[client_name].search_client = get_authorized_confidentialapp_client(
-                #    cls.globus_clients[client_name].app_client_id,
-                #)
-
-                cls.globus_clients[client_name].search_client = cls.get_authorizor(
-                    cls.globus_clients[client_name].app_client_id,
-                    cls.globus_clients[client_name].token_name,
-                )
+            # the pipelines of one process share the authorized clients
+            with cls._client_lock:
+                if cls.globus_clients[client_name].search_client is None:
+                    logger.info(f"no search client and request for the client {client_name}")
+
+                    #-cls.globus_clients[client_name].search_client = get_authorized_search_client(
+                    #-    cls.globus_clients[client_name].app_client_id,
+                    #-    cls.globus_clients[client_name].token_name,
+                    #-)
+                    #cls.globus_clients[client_name].search_client = get_authorized_confidentialapp_client(
+                    #    cls.globus_clients[client_name].app_client_id,
+                    #)
+
+                    # all the requests of the client share the process-wide rate limits
+                    cls.globus_clients[client_name].search_client = install(cls.get_authorizor(
+                        cls.globus_clients[client_name].app_client_id,
+                        cls.globus_clients[client_name].token_name,
+                    ))
             logger.info(f"return the search client with the name {name}.")
 
             return cls.globus_clients[client_name]
@@ -1,14 +1,16 @@
 """process the globus gmeta data class"""
 
+import logging
 from abc import ABC, abstractmethod
 from collections.abc import Callable
+from concurrent.futures import ProcessPoolExecutor
 from typing import Any
 
-from metadata_migrate_sync.lite_model import enforced_field, enforced_field_relax, enforced_field_extend
 from pydantic import ValidationError
-from metadata_migrate_sync.provenance import provenance
 
-import logging
+from metadata_migrate_sync.codec import dumpb, loads
+from metadata_migrate_sync.lite_model import enforced_field, enforced_field_extend, enforced_field_relax
+from metadata_migrate_sync.provenance import provenance
 
 logger = logging.getLogger()
 
@@ -73,20 +75,110 @@ class StandardGmetaGenerator(GmetaGenerator):
         return entries
 
 
+class GmetaConfig:
+    """config class for the gmeta generation."""
+
+    MIN_ENTRIES_PER_WORKER = 200   # smaller pages are not worth the transfer
+
+
+# the generator of a pool worker, set once by the pool initializer
+_worker_generator: "ModifiedGmetaGenerator | None" = None
+
+
+def _init_worker(
+    modifier: Callable[[dict[str, Any]], dict[str, Any]],
+    modifier_kwargs: dict[str, Any],
+) -> None:
+    global _worker_generator
+    _worker_generator = ModifiedGmetaGenerator(modifier, **modifier_kwargs)
+
+
+def _generate_in_worker(entries_json: bytes) -> bytes:
+    """Generate a slice of a page, the slice and the result are passed as json bytes."""
+    gmeta_ingest, gmeta_skipped = _worker_generator.generate({"gmeta": loads(entries_json)})
+    return dumpb([
+        gmeta_ingest["ingest_data"]["gmeta"],
+        gmeta_skipped["ingest_data"]["gmeta"],
+    ])
+
+
 class ModifiedGmetaGenerator(GmetaGenerator):
-    """Concrete implementation for modified GMeta generation."""
+    """Concrete implementation for modified GMeta generation.
+
+    With processes the entries of a page are modified in a process pool. The
+    modifier and its kwargs go to the workers once at the pool startup, the
+    slices of the page are passed as json bytes instead of pickled objects.
+    The pool should be closed with close() (or a with block).
+
+    In this process the modifier works on the entries of the page, as with
+    the baseline generator, so the page is modified in place. In the pool the
+    workers modify json copies and the entries of the page are left as is.
+    """
 
     def __init__(self,
         modifier: Callable[[dict[str, Any]], dict[str, Any]],
+        processes: int | None = None,
         **modifier_kwargs
     ):
         self.modifier = modifier
         self.modifier_kwargs = modifier_kwargs
+        self.processes = processes
+        self._pool: ProcessPoolExecutor | None = None
 
     def process_entry(self, entries: list[dict[str, Any]]) -> list[dict[str, Any]]:
         """Apply modifier function to each entry."""
         return [self.modifier(entry, **self.modifier_kwargs) for entry in entries]
 
+    def generate(self, gdoc: dict[str, Any]) -> tuple[dict[str, Any], dict[str, Any]]:
+        """Generate in the process pool, in this process for the small pages."""
+        entries = gdoc["gmeta"]
+        n_workers = min(
+            self.processes or 1,
+            len(entries) // GmetaConfig.MIN_ENTRIES_PER_WORKER,
+        )
+        if n_workers < 2:
+            return super().generate(gdoc)
+
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.processes,
+                initializer=_init_worker,
+                initargs=(self.modifier, self.modifier_kwargs),
+            )
+
+        size = -(-len(entries) // n_workers)
+        slices = [
+            dumpb(entries[i:i + size])
+            for i in range(0, len(entries), size)
+        ]
+
+        gmeta_entries: list[dict[str, Any]] = []
+        gmeta_entries_skipped: list[dict[str, Any]] = []
+        # map keeps the order of the slices
+        for result in self._pool.map(_generate_in_worker, slices):
+            ingested, skipped = loads(result)
+            gmeta_entries.extend(ingested)
+            gmeta_entries_skipped.extend(skipped)
+
+        return (
+            {"ingest_type": "GMetaList", "ingest_data": {"gmeta": gmeta_entries}},
+            {"ingest_type": "GMetaList", "ingest_data": {"gmeta": gmeta_entries_skipped}}
+        )
+
+    def close(self) -> None:
+        """Shut down the process pool."""
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def __enter__(self) -> "ModifiedGmetaGenerator":
+        """Use the generator in a with block, its pool is started on demand."""
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        """Shut down the process pool."""
+        self.close()
+
 
 # Original function remains unchanged
 def generate_gmeta_list_globus(gdoc: dict[str, Any]) -> tuple[dict[str, Any], dict[str, Any]]:
@@ -1,21 +1,66 @@
 """Ingest module."""
-import json
+import logging
 from datetime import datetime
 from typing import Any, Literal
 from uuid import UUID
 
-from globus_sdk import SearchClient
+from globus_sdk import GlobusAPIError, SearchClient
 from pydantic import (
     BaseModel,
     validate_call,
 )
-from sqlalchemy.orm import object_session
-
-from metadata_migrate_sync.database import Datasets, Files, Ingest, MigrationDB, Query
+from sqlalchemy.orm import Session
+
+from metadata_migrate_sync.codec import dumps
+from metadata_migrate_sync.database import (
+    Datasets,
+    Files,
+    FilesCompact,
+    Ingest,
+    MigrationDB,
+    Query,
+    StorageConfig,
+    compact_uri,
+    index_key,
+)
 from metadata_migrate_sync.globus import GlobusClient, GlobusIngestModel
 from metadata_migrate_sync.gmeta import StandardGmetaGenerator
 from metadata_migrate_sync.project import ProjectReadOnly, ProjectReadWrite
 from metadata_migrate_sync.provenance import provenance
+from metadata_migrate_sync.summary import add_page_rows
+
+
+class IngestConfig:
+    """config class for the ingestion."""
+
+    BISECT_STATUS = (400, 413)  # a batch rejected with these is split in halves
+    MAX_REJECTED = 100          # stop the bisection above this many rejected documents
+    MAX_REJECTED_FIRST = 3      # the first documents rejected with one error, before any accepted one,
+                                # make a rejected request (not rejected documents)
+
+
+def _doc_success(
+    doc: dict[str, Any],
+    rejected: dict[str, str] | None = None,
+    unchanged: set[str] | None = None,
+) -> int:
+    """Get the success code of a document in the files/datasets tabs.
+
+    0: submitted, -9: skipped (failed validation or rejected by the index),
+    2: not submitted as the target holds the same content
+    """
+    if "skip_ingest" in doc or (rejected and doc.get("id") in rejected):
+        return -9
+    if unchanged and doc.get("id") in unchanged:
+        return 2
+    return 0
+
+
+def _stored_response(data: dict[str, Any]) -> str:
+    """Get the ingest response stored in the ingest table, trimmed out of the full storage."""
+    if StorageConfig.MODE != "full":
+        data = {k: data[k] for k in StorageConfig.RESPONSE_KEYS if k in data}
+    return dumps(data)
 
 
 class BaseIngest(BaseModel):
@@ -32,10 +77,43 @@ class GlobusIngest(BaseIngest):
 
     _submitted: bool = False
     _response_data: dict[Any, Any] = {}
+    _fingerprints: Any | None = None
+    # the subjects dropped from the last ingest as the target holds the same content
+    _unchanged: set[str] = set()
+    _tracker: Any | None = None
+    # the submissions (response, number of entries) of a bisected batch
+    _submissions: list[tuple[dict[str, Any], int]] = []
+    # the subjects rejected alone by the index, with their errors
+    _rejected: dict[str, str] = {}
+
+    def use_fingerprints(self, store: Any) -> None:  # noqa ANN401
+        """Drop the entries whose fingerprint is unchanged in the target before ingest.
+
+        The fingerprints are stored when the tracker finds their task
+        succeeded, so the fingerprints need a tracker (use_tracker).
+        """
+        self._fingerprints = store
+        self._wire_fingerprints()
+
+    def use_tracker(self, tracker: Any) -> None:  # noqa ANN401
+        """Track the submitted tasks and hold the submission while too many are pending."""
+        self._tracker = tracker
+        self._wire_fingerprints()
+
+    def _wire_fingerprints(self) -> None:
+        """Store the fingerprints of the succeeded tasks, drop those of the failed ones."""
+        if self._fingerprints is not None and self._tracker is not None:
+            self._tracker.on_succeeded(self._fingerprints.commit_task)
+            self._tracker.on_failed(self._fingerprints.forget_task)
 
     # from globus2solr
-    def ingest(self, gingest: dict[str, Any]) -> None:
-        """Ingest documents to a globus index using globus search client."""
+    def ingest(self, gingest: dict[str, Any]) -> set[str]:
+        """Ingest documents to a globus index using globus search client.
+
+        The subjects not submitted as their fingerprint is unchanged in the
+        target are returned (and recorded with success 2 by prov_collect),
+        the entries of gingest are not modified.
+        """
         logger = provenance._instance.get_logger(__name__)
 
         current_timestr = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -43,6 +121,25 @@ class GlobusIngest(BaseIngest):
 
         GlobusIngestModel.model_validate(gingest)
 
+        self._unchanged = set()
+        self._submissions = []
+        self._rejected = {}
+        if self._fingerprints is not None:
+            changed, unchanged = self._fingerprints.filter_unchanged(
+                gingest["ingest_data"]["gmeta"]
+            )
+            self._unchanged = {g["subject"] for g in unchanged}
+
+            if len(unchanged) > 0:
+                logger.info(f"drop {len(unchanged)} unchanged entries from the ingest")
+
+            if len(changed) == 0:
+                self._response_data = {}
+                self._submitted = True
+                return self._unchanged
+
+            gingest = {**gingest, "ingest_data": {"gmeta": changed}}
+
         gc = GlobusClient.get_client(name=self.ep_name)
         sc = gc.search_client
 
@@ -55,21 +152,120 @@ class GlobusIngest(BaseIngest):
             logger.error("end_point is not consistent with ep_name")
             raise ValueError("end_point is not consistent with ep_name")
 
-        if isinstance(sc, SearchClient):
-            response = sc.ingest(_globus_index_id, gingest)
-        else:
+        if not isinstance(sc, SearchClient):
             logger.error("not a search client")
             raise ValueError("not a search client")
 
-        self._response_data = response.data
+        submissions: list[tuple[dict[str, Any], list[dict[str, Any]]]] = []
+        try:
+            self._ingest_bisect(sc, _globus_index_id, gingest, logger, submissions)
+        except GlobusAPIError:
+            if submissions:
+                self._record_partial(submissions, logger)
+            raise
+
+        if len(submissions) == 0:
+            # every entry is rejected, they are recorded as skipped
+            self._response_data = {}
+            self._submitted = True
+            return self._unchanged
+
+        self._response_data = submissions[0][0]
+        if len(submissions) > 1:
+            self._submissions = [(data, len(gmeta)) for data, gmeta in submissions]
 
-        if response.data["acknowledged"] and response.data["success"]:
+        if all(data["acknowledged"] and data["success"] for data, _ in submissions):
             self._submitted = True
 
+            if self._fingerprints is not None:
+                # stored by the tracker when the task succeeds
+                for data, gmeta in submissions:
+                    if data.get("task_id"):
+                        self._fingerprints.stage(gmeta, task_id=data["task_id"])
+
             current_timestr = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             logger.info("the ingestion submitted successfully at " + current_timestr)
         else:
             logger.info("the ingestion submission failed at " + current_timestr)
+        return self._unchanged
+
+    def _ingest_bisect(
+        self,
+        sc: SearchClient,
+        index_id: str | UUID,
+        gingest: dict[str, Any],
+        logger: logging.Logger,
+        accepted: list[tuple[dict[str, Any], list[dict[str, Any]]]],
+    ) -> None:
+        """Submit the entries, splitting the batch in halves on a size or validation rejection.
+
+        The recursion ends at the accepted batches, appended to accepted as
+        (response, entries) when they are submitted, or at the single entries
+        rejected, which are kept in _rejected.
+        """
+        gmeta = gingest["ingest_data"]["gmeta"]
+        try:
+            if self._tracker is not None:
+                self._tracker.wait_for_capacity()
+            response = sc.ingest(index_id, gingest)
+            accepted.append((response.data, gmeta))
+            return
+        except GlobusAPIError as e:
+            if e.http_status not in IngestConfig.BISECT_STATUS:
+                raise
+            error = f"{e.http_status} {e.code}: {e.message}"
+
+            if len(gmeta) == 1:
+                subject = gmeta[0]["subject"]
+                logger.error(f"the index rejected the document {subject}: {error}")
+                self._rejected[subject] = error
+                if len(self._rejected) > IngestConfig.MAX_REJECTED:
+                    # not caused by the documents, stop splitting
+                    raise
+                if (
+                    not accepted
+                    and len(self._rejected) >= IngestConfig.MAX_REJECTED_FIRST
+                    and len(set(self._rejected.values())) == 1
+                ):
+                    # every document gets the same error, the request is rejected
+                    raise
+                return
+
+            logger.warning(f"the index rejected a batch of {len(gmeta)} ({error}), split it")
+            half = len(gmeta) // 2
+            for part in (gmeta[:half], gmeta[half:]):
+                part_ingest = {**gingest, "ingest_data": {"gmeta": part}}
+                self._ingest_bisect(sc, index_id, part_ingest, logger, accepted)
+
+    def _record_partial(
+        self,
+        accepted: list[tuple[dict[str, Any], list[dict[str, Any]]]],
+        logger: logging.Logger,
+    ) -> None:
+        """Record the tasks submitted for a batch before its ingestion is stopped by an error."""
+        task_ids = [data.get("task_id") for data, _ in accepted]
+        logger.error(f"the ingestion of the batch stopped after the submitted tasks {task_ids}")
+
+        target_index = str(self.end_point)
+        submissions = [(data.get("task_id"), _stored_response(data), len(gmeta)) for data, gmeta in accepted]
+
+        def _record(session: Session) -> None:
+            last_query = session.query(Query).order_by(Query.id.desc()).first()
+            for task_id, ingest_response, n_entries in submissions:
+                session.add(Ingest(
+                    n_ingested=n_entries,
+                    index_id=target_index,
+                    task_id=task_id,
+                    ingest_response=ingest_response,
+                    query=last_query,
+                    submitted=1,
+                ))
+
+        MigrationDB.write(_record)
+
+        if self._tracker is not None:
+            for task_id in task_ids:
+                self._tracker.track(task_id)
 
     def prov_collect(
         self,
@@ -97,47 +293,106 @@ class GlobusIngest(BaseIngest):
             logger.info(
                 "the succuss record in datasets/files tabs will be updated by check_ingest"
             )
-            DBsession = MigrationDB.get_session()
-            with DBsession() as session:
-                current_ingest: Ingest = session.query(Ingest).filter_by(
-                    pages=current_query.pages
-                ).first()
+            task_id = self._response_data.get("task_id")
+            ingest_response = _stored_response(self._response_data)
+            pages = current_query.pages
+
+            def _review_record(session: Session) -> None:
+                current_ingest: Ingest = session.query(Ingest).filter_by(pages=pages).first()
 
                 # for batched ingestion, it will be array. how to do?
 
-                current_ingest.task_id = self._response_data.get("task_id")
-                current_ingest.ingest_response = json.dumps(self._response_data)
+                current_ingest.task_id = task_id
+                current_ingest.ingest_response = ingest_response
                 current_ingest.submitted = current_ingest.submitted + 1
 
+            MigrationDB.write(_review_record)
+
+            if self._tracker is not None:
+                self._tracker.track(task_id)
+            self._submissions = []
+            self._rejected = {}
+            self._unchanged = set()
             return
 
         # write to db
 
         logger.info("ingest sumbmitted, so add the files/datasets to the tabs")
 
-        DBsession = MigrationDB.get_session()
-        with DBsession() as session:
-
-            # check if current_query associated with the session
-            if object_session(current_query) is None:
-                last_query = session.query(Query).order_by(Query.id.desc()).first()
+        # the row values are taken now, the record may be written behind the pipeline
+        query_id = (
+            current_query.id
+            if isinstance(current_query, Query) and current_query.id is not None else None
+        )
+        target_index = str(self.end_point)
+        rejected = self._rejected
+        unchanged = self._unchanged
+        rows = [
+            {
+                "id": doc.get("id"),
+                "size": (doc.get("size") if "size" in doc else -1),
+                "uri": ",".join(doc.get("url")) if "url" in doc else "NoURL",
+                "success": _doc_success(doc, rejected, unchanged),
+                "error": rejected.get(doc.get("id")) if rejected else None,
+            }
+            for doc in docs
+        ]
+
+        # one ingest row per submission (task), a bisected batch has several
+        if self._submissions:
+            submissions = [
+                (data.get("task_id"), _stored_response(data), n_entries)
+                for data, n_entries in self._submissions
+            ]
+        elif self._response_data:
+            submissions = [
+                (self._response_data.get("task_id"), _stored_response(self._response_data), len(rows))
+            ]
+        else:
+            submissions = [("skip", "skip", len(rows))]
+        self._submissions = []
+        self._rejected = {}
+        self._unchanged = set()
+        storage = StorageConfig.MODE
+
+        def _record(session: Session) -> None:
+            # the query row of the page, or the last one for a query not from the database
+            if query_id is not None:
+                last_query = session.get(Query, query_id)
             else:
-                last_query = current_query
+                last_query = session.query(Query).order_by(Query.id.desc()).first()
+
+            if storage != "full":
+                source_key = index_key(session, last_query.index_id if last_query else None)
+                target_key = index_key(session, target_index)
 
             n_datasets = 0
             n_files = 0
-            for doc in docs:
+            for row in rows:
+
+                if (metatype == "files" or metatype == "File") and storage != "full":
+                    session.add(FilesCompact(
+                        pages=last_query.pages if last_query else None,
+                        files_id=row["id"],
+                        size=row["size"],
+                        source_key=source_key,
+                        target_key=target_key,
+                        success=row["success"],
+                        error=row["error"],
+                        **compact_uri(row["uri"], keep=storage == "compact"),
+                    ))
+                    n_files += 1
 
-                if metatype == "files" or metatype == "File":
-                    urls = ",".join(doc.get("url")) if "url" in doc else "NoURL"
+                elif metatype == "files" or metatype == "File":
                     files_obj = Files(
                         query=last_query,
                         source_index=last_query.index_id if last_query else 0,
-                        target_index=str(self.end_point),
-                        files_id=doc.get("id"),
-                        size=(doc.get("size") if "size" in doc else -1),
-                        uri=urls,
-                        success=-9 if "skip_ingest" in doc else 0,
+                        target_index=target_index,
+                        files_id=row["id"],
+                        size=row["size"],
+                        uri=row["uri"],
+                        success=row["success"],
+                        error=row["error"],
                     )
                     n_files += 1
 
@@ -148,33 +403,41 @@ class GlobusIngest(BaseIngest):
                     datasets_obj = Datasets(
                         query=last_query,
                         source_index=last_query.index_id if last_query else 0,
-                        target_index=str(self.end_point),
-                        datasets_id=doc.get("id"),
-                        success=-9 if "skip_ingest" in doc else 0,
+                        target_index=target_index,
+                        datasets_id=row["id"],
+                        success=row["success"],
+                        error=row["error"],
                     )
                     session.add(datasets_obj)
                     n_datasets += 1
 
-            if self._response_data:
-                task_id = self._response_data.get("task_id")
-                ingest_response = json.dumps(self._response_data)
-            else:
-                task_id = "skip"
-                ingest_response = "skip"
-
-            ingest_obj = Ingest(
-                n_ingested=len(docs),
-                n_datasets=n_datasets if batch_num == -1 or n_datasets > 0 else batch_num,
-                n_files=n_files,
-                index_id=str(self.end_point),
-                task_id=task_id,
-                ingest_response=ingest_response,
-                query=last_query,
-                submitted=1,
-            )
-
-            session.add(ingest_obj)
-            session.commit()
+            for task_id, ingest_response, n_entries in submissions:
+                # the counts of a bisected batch are the ones of its submissions
+                n_ingested = n_entries if len(submissions) > 1 else len(rows)
+                n_sub_files = n_ingested if n_files > 0 else 0
+                n_sub_datasets = n_ingested if n_datasets > 0 else 0
+
+                ingest_obj = Ingest(
+                    n_ingested=n_ingested,
+                    n_datasets=n_sub_datasets if batch_num == -1 or n_sub_datasets > 0 else batch_num,
+                    n_files=n_sub_files,
+                    index_id=target_index,
+                    task_id=task_id,
+                    ingest_response=ingest_response,
+                    query=last_query,
+                    submitted=1,
+                )
+
+                session.add(ingest_obj)
+
+            # the summaries are updated in the transaction of the rows
+            add_page_rows(session, last_query, rows, len(submissions), datetime.utcnow())
+
+        MigrationDB.write(_record)
+
+        if self._tracker is not None:
+            for task_id, _, _ in submissions:
+                self._tracker.track(task_id)
         logger.info("add records to the files/datasets to the tabs successfully")
 
 
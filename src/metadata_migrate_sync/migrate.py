@@ -4,19 +4,125 @@ import logging
 import math
 import pathlib
 import sys
+from contextlib import nullcontext
 from datetime import datetime
-from typing import Literal
+from typing import Any, Literal
 
 from pydantic import validate_call
+from requests.exceptions import RequestException
 from tqdm import tqdm
 
-from metadata_migrate_sync.database import MigrationDB
+from metadata_migrate_sync.convert import SOURCE_FILTER_QUERIES
+from metadata_migrate_sync.database import Ingest, MigrationDB, Query
 from metadata_migrate_sync.globus import GlobusClient
 from metadata_migrate_sync.ingest import GlobusIngest, generate_gmeta_list
 from metadata_migrate_sync.project import ProjectReadOnly, ProjectReadWrite
 from metadata_migrate_sync.provenance import provenance
 from metadata_migrate_sync.query import SolrQuery, params_search
 from metadata_migrate_sync.solr import SolrIndexes
+from metadata_migrate_sync.spool import PageSpool
+from metadata_migrate_sync.task_tracker import IngestTaskTracker, TrackerConfig
+
+
+def _ingest_spooled(
+    spool: PageSpool,
+    pages: int,
+    ig: GlobusIngest,
+    metatype: Literal["files", "datasets"],
+    review: bool,
+    current_query: Any,  # noqa ANN401
+) -> bool:
+    """Ingest a page from the spool, False if the page is not spooled."""
+    logger = provenance.get_logger(__name__)
+
+    spooled = spool.get(pages)
+    if spooled is None:
+        return False
+
+    logger.info(f"ingest the page {pages} from the spool")
+
+    ig._submitted = False
+    if len(spooled["gmeta_ingest"]["ingest_data"]["gmeta"]) > 0:
+        ig.ingest(spooled["gmeta_ingest"])
+    else:
+        ig._response_data = {}
+        ig._submitted = True
+
+    ig.prov_collect(
+        spooled["new_page"],
+        review=review,
+        current_query=current_query,
+        metatype=metatype,
+    )
+    return True
+
+
+def _review_from_spool(
+    spool: PageSpool,
+    ig: GlobusIngest,
+    metatype: Literal["files", "datasets"],
+) -> None:
+    """Re-ingest the pages with failed ingest tasks from the spool.
+
+    Only the tasks known to have FAILED (n_failed, set by the task tracker or
+    check_task --update) are re-ingested, not the pending ones.
+    """
+    logger = provenance.get_logger(__name__)
+
+    DBsession = MigrationDB.get_session()
+    with DBsession() as session:
+        not_succeeded = session.query(Ingest.pages).filter(Ingest.succeeded == 0)
+        failed_pages = not_succeeded.filter(Ingest.n_failed > 0).distinct()
+        failed_queries = session.query(Query).filter(Query.pages.in_(failed_pages)).all()
+        n_pending = not_succeeded.filter(
+            (Ingest.n_failed.is_(None)) | (Ingest.n_failed == 0), Ingest.task_id != "skip"
+        ).count()
+
+    if n_pending > 0:
+        logger.warning(f"{n_pending} ingest tasks are not checked, check them with check_task --update")
+
+    n_missing = 0
+    for query in failed_queries:
+        if not _ingest_spooled(spool, query.pages, ig, metatype, True, query):
+            n_missing += 1
+            logger.warning(f"the page {query.pages} is not in the spool, it needs a re-query")
+
+    logger.info(f"re-ingested {len(failed_queries) - n_missing} pages from the spool")
+    if n_missing > 0:
+        logger.warning(f"{n_missing} failed pages are not spooled")
+
+
+def _count_pushdown_skipped(
+    end_point: str,
+    search_dict: dict[str, Any],
+    pushdown: list[str],
+) -> tuple[int, int]:
+    """Count the documents matched by the query and those the pushdown filters remove.
+
+    One rows=0 request with a facet query on the pushdown filters.
+    """
+    base_fq = [fq for fq in search_dict["fq"] if fq not in pushdown]
+    facet_query = " AND ".join(pushdown)
+
+    params = {
+        "q": search_dict["q"],
+        "fq": base_fq,
+        "rows": 0,
+        "wt": "json",
+        "facet": "true",
+        "facet.query": facet_query,
+    }
+    if "shards" in search_dict:
+        params["shards"] = search_dict["shards"]
+
+    result = SolrQuery._make_request(end_point, params)
+    if not result:
+        return 0, 0
+
+    response_json, _, _ = result
+    total = response_json["response"]["numFound"]
+    kept = response_json["facet_counts"]["facet_queries"][facet_query]
+    return total, total - kept
 
 
 @validate_call
@@ -28,12 +134,41 @@ def metadata_migrate(
     project: ProjectReadOnly | ProjectReadWrite,
     production: bool,
     final: bool,
+    spool_dir: str | None = None,
+    spool_max_mb: int = 2048,
+    review: bool = False,
+    export: bool = False,
+    export_fields: list[str] | None = None,
+    track_tasks: bool = False,
+    max_pending: int = TrackerConfig.MAX_PENDING,
+    time_slice: str | None = None,
+    output_path: str | None = None,
 ) -> None:
-    """Migrate metadata/documents from solr indexes to the globus indexes."""
+    """Migrate metadata/documents from solr indexes to the globus indexes.
+
+    With a spool directory, the converted pages are kept on disk, so the
+    restarted page and the review mode (re-ingest failed pages) do not query
+    the solr index again.
+
+    With export (read-only projects only) the documents are streamed from the
+    solr /export handler instead of the cursorMark pagination. The export only
+    returns the fields with docValues, so export_fields must list them.
+
+    With track_tasks, the ingest tasks are checked during the run and the
+    ingestion pauses while too many tasks are pending in the target.
+
+    A time slice (a solr _timestamp fq, see workqueue) restricts the query to
+    the slice, and the log, provenance and database files are written in
+    output_path, so the units of a distributed migration run side by side.
+    """
     # setup the provenance
 
     client_name, index_name = GlobusClient.get_client_index_names(target_epname, project.value)
 
+    file_base = f"migration_{source_epname}_{target_epname}_{project.value}_{metatype}"
+    if output_path is not None:
+        file_base = f"{output_path}/{file_base}"
+
     prov = provenance(
         task_name="migrate",
         source_index_id=SolrIndexes.indexes[source_epname].index_id,
@@ -44,9 +179,9 @@ def metadata_migrate(
         ingest_index_type="globus",
         ingest_index_name=target_epname,
         ingest_index_schema="ESGF1.5",
-        log_file=f"migration_{source_epname}_{target_epname}_{project.value}_{metatype}.log",
-        prov_file=f"migration_{source_epname}_{target_epname}_{project.value}_{metatype}.json",
-        db_file=f"migration_{source_epname}_{target_epname}_{project.value}_{metatype}.sqlite",
+        log_file=f"{file_base}.log",
+        prov_file=f"{file_base}.json",
+        db_file=f"{file_base}.sqlite",
         type_query=metatype.capitalize(),
         cmd_line=" ".join(sys.argv),
     )
@@ -63,8 +198,19 @@ def metadata_migrate(
 
     # database
     _ = MigrationDB(prov.db_file, True)
+    MigrationDB.start_writer()
     logger.info(f"initialed the sqllite database at {prov.db_file}")
 
+    if export and project not in ProjectReadOnly:
+        print (f"the export mode is for the read-only projects, not {project.value}")
+        logger.error(f"the export mode is for the read-only projects, not {project.value}")
+        sys.exit()
+
+    if export and not export_fields:
+        print ("the export mode needs the list of the docValues fields (--export-fields)")
+        logger.error("the export mode needs the list of the docValues fields")
+        sys.exit()
+
     # query generator
     # for ReadWirte projects, need a cut-off date.
     if project in ProjectReadWrite:
@@ -145,14 +291,43 @@ def metadata_migrate(
         if target_epname != "test":
             logger.warning("test run generaly does not ingest to production indexes")
 
+    if time_slice is not None:
+        search_dict["fq"] = [search_dict["fq"], time_slice]
+
+    # skip the documents on the server instead of dropping them after the transfer
+    # convert_to_esgf_1_5 still checks them
+    pushdown = SOURCE_FILTER_QUERIES.get(source_epname, [])
+    if pushdown:
+        search_dict["fq"] = [
+            *(search_dict["fq"] if isinstance(search_dict["fq"], list) else [search_dict["fq"]]),
+            *pushdown,
+        ]
+
+    if export:
+        search_dict["fl"] = ",".join(export_fields)
+
     logger.info("finish the query setting")
 
+    if pushdown:
+        try:
+            n_total, n_skipped = _count_pushdown_skipped(
+                f"{prov.source_index_id}/{prov.source_index_type}/{metatype}/select",
+                search_dict,
+                pushdown,
+            )
+            logger.info(
+                f"the filters {pushdown} skip {n_skipped} of {n_total} documents on the server"
+            )
+        except (KeyError, RequestException) as e:
+            logger.warning(f"cannot count the documents skipped by the filters {pushdown}: {e}")
+
     sq = SolrQuery(
         end_point=f"{prov.source_index_id}/{prov.source_index_type}/{metatype}/select",
         ep_type=prov.source_index_type,
         ep_name=source_epname,
         project=project,
         query=search_dict,
+        export=export,
     )
 
     # ingest
@@ -162,17 +337,57 @@ def metadata_migrate(
         project=project,
     )
 
+    tracker = None
+    if track_tasks:
+        tracker = IngestTaskTracker(
+            GlobusClient.get_client(target_epname).search_client, max_pending=max_pending
+        )
+        ig.use_tracker(tracker)
+        logger.info(f"track the ingest tasks, pause above {max_pending} pending tasks")
+
     logger.info("instantiate query and ingest classes")
 
+    spool = None
+    if spool_dir is not None:
+        spool = PageSpool(spool_dir, max_bytes=spool_max_mb * 1024 * 1024)
+        logger.info(f"spool the converted pages at {spool_dir}")
+
+    if review:
+        if spool is None:
+            logger.error("the review mode needs the spool directory")
+            sys.exit()
+        with tracker or nullcontext():
+            _review_from_spool(spool, ig, metatype)
+        MigrationDB.stop_writer()
+        logging.shutdown()
+        prov.successful = True
+        pathlib.Path(prov.prov_file).write_text(prov.model_dump_json(indent=2))
+        return
+
     # set the initial cursormark
     sq.get_cursormark(review=False)
     logger.info("find the cursormark at " + sq.query["cursorMark"])
 
+    # replay the restarted page from the spool instead of re-query
+    if spool is not None and sq._restart and sq._current_query is not None:
+        last_query = sq._current_query
+        if _ingest_spooled(spool, last_query.pages, ig, metatype, False, last_query):
+            if last_query.cursorMark_next == last_query.cursorMark:
+                logger.info("the spooled page is the last page, nothing left to migrate")
+                MigrationDB.stop_writer()
+                logging.shutdown()
+                prov.successful = True
+                pathlib.Path(prov.prov_file).write_text(prov.model_dump_json(indent=2))
+                return
+            sq.query["cursorMark"] = last_query.cursorMark_next
+            sq._restart = False
+            logger.info("move the cursormark to " + sq.query["cursorMark"])
+
     current_timestr = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     logger.info("query-ingest start at " + current_timestr)
 
     n = 0
-    with tqdm(
+    with tracker or nullcontext(), tqdm(
         sq.run(),
         desc="Processing",
         unit="page",
@@ -183,8 +398,8 @@ def metadata_migrate(
     ) as pbar:
 
         for page in pbar:
-            if not pbar.total and hasattr(sq, "_numFound") and sq._numFound:
-                pbar.total = math.ceil(sq._numFound / search_dict["rows"])
+            if not pbar.total and hasattr(sq, "_num_found") and sq._num_found:
+                pbar.total = math.ceil(sq._num_found / search_dict["rows"])
 
             if len(page) == 0:
                 logger.info(f"no data in this page {n}. stop the ingestion")
@@ -194,6 +409,13 @@ def metadata_migrate(
             ig._submitted = False
             gmeta_ingest, new_page = generate_gmeta_list(page, metatype)
 
+            if spool is not None and sq._current_query is not None:
+                spool_file = spool.put(
+                    sq._current_query.pages,
+                    {"gmeta_ingest": gmeta_ingest, "new_page": new_page},
+                )
+                spool.link(sq._current_query.pages, spool_file)
+
             if len(gmeta_ingest["ingest_data"]["gmeta"]) > 0:
                 ig.ingest(gmeta_ingest)
             else:
@@ -214,6 +436,7 @@ def metadata_migrate(
     logger.info("query-ingest stop at " + current_timestr)
     logger.info(f"Processing total pages {n}")
     # clean up
+    MigrationDB.stop_writer()
     logging.shutdown()
     prov.successful = True
     pathlib.Path(prov.prov_file).write_text(prov.model_dump_json(indent=2))
@@ -0,0 +1,177 @@
+"""Split the documents of a globus index into disjoint partitions.
+
+A partition is a globus filter added to the base query. The partitions of one
+split are disjoint and together cover the base query, so they can be scrolled
+concurrently.
+"""
+from datetime import datetime, timedelta, timezone
+from typing import Any
+from uuid import UUID
+
+from globus_sdk import SearchClient
+
+
+class PartitionConfig:
+    """config class for partitions."""
+
+    FACET_SIZE = 100   # the maximum number of facet values as partitions
+    RESOLUTION = timedelta(milliseconds=1)
+
+
+def format_timestamp(dt: datetime) -> str:
+    """Format a datetime as the globus _timestamp, an aware datetime in UTC."""
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc)
+    return dt.strftime("%Y-%m-%dT%H:%M:%S.") + f"{dt.microsecond // 1000:03d}Z"
+
+
+def timestamp_partitions(
+    start: datetime,
+    end: datetime,
+    n_partitions: int,
+) -> list[dict[str, Any]]:
+    """Split [start, end] into the _timestamp range filters.
+
+    The range filter is inclusive at both sides, so a partition stops one
+    resolution step before the start of the next one.
+    """
+    if end <= start:
+        raise ValueError(f"the end time {end} is not after the start time {start}")
+
+    step = (end - start) / max(n_partitions, 1)
+    step = max(step, PartitionConfig.RESOLUTION)
+
+    boundaries = []
+    current = start
+    while current < end:
+        boundaries.append(current)
+        current = current + step
+        current = current - timedelta(microseconds=current.microsecond % 1000)
+    boundaries.append(end + PartitionConfig.RESOLUTION)
+
+    return _range_partitions(boundaries)
+
+
+def _range_partitions(boundaries: list[datetime]) -> list[dict[str, Any]]:
+    """Turn the sorted boundaries into the inclusive _timestamp range filters."""
+    return [
+        {
+            "type": "range",
+            "field_name": "_timestamp",
+            "values": [{
+                "from": format_timestamp(lower),
+                "to": format_timestamp(upper - PartitionConfig.RESOLUTION),
+            }],
+        }
+        for lower, upper in zip(boundaries[:-1], boundaries[1:])
+    ]
+
+
+def histogram_partitions(
+    sc: SearchClient,
+    index_id: str | UUID,
+    filters: list[dict[str, Any]],
+    start: datetime,
+    end: datetime,
+    n_partitions: int,
+    interval: str = "month",
+) -> list[dict[str, Any]]:
+    """Split [start, end] into the _timestamp ranges of about equal counts.
+
+    The counts come from a date_histogram facet, and the contiguous buckets
+    are grouped until a group holds its share of the documents. The uneven
+    ingestion history of an index makes the equal time ranges of
+    timestamp_partitions very unbalanced.
+    """
+    # the bucket values are naive in UTC
+    start, end = (
+        dt.astimezone(timezone.utc).replace(tzinfo=None) if dt.tzinfo is not None else dt
+        for dt in (start, end)
+    )
+    if end <= start:
+        raise ValueError(f"the end time {end} is not after the start time {start}")
+
+    response = sc.post_search(
+        index_id,
+        {
+            "q": "*",
+            "filters": filters,
+            "limit": 0,
+            "facets": [{
+                "name": "_timestamp",
+                "type": "date_histogram",
+                "field_name": "_timestamp",
+                "date_interval": interval,
+                "histogram_range": {
+                    "low": format_timestamp(start),
+                    "high": format_timestamp(end),
+                },
+            }],
+        },
+    )
+    buckets = [
+        (datetime.strptime(b["value"][:19], "%Y-%m-%dT%H:%M:%S"), b["count"])
+        for b in response.data["facet_results"][0]["buckets"]
+    ]
+    total = sum(count for _, count in buckets)
+    if total == 0:
+        return timestamp_partitions(start, end, 1)
+
+    share = total / max(n_partitions, 1)
+    boundaries = [start]
+    accumulated = 0
+    for value, count in buckets:
+        if value > boundaries[-1] and accumulated >= share * (len(boundaries)):
+            boundaries.append(value)
+        accumulated += count
+    boundaries = [b for b in boundaries if b <= end]
+    boundaries.append(end + PartitionConfig.RESOLUTION)
+
+    return _range_partitions(boundaries)
+
+
+def facet_values(
+    sc: SearchClient,
+    index_id: str | UUID,
+    filters: list[dict[str, Any]],
+    field_name: str,
+    size: int = PartitionConfig.FACET_SIZE,
+) -> list[tuple[str, int]]:
+    """Get the values of a field with their counts from a terms facet."""
+    response = sc.post_search(
+        index_id,
+        {
+            "q": "*",
+            "filters": filters,
+            "limit": 0,
+            "facets": [{
+                "name": field_name,
+                "type": "terms",
+                "field_name": field_name,
+                "size": size,
+            }],
+        },
+    )
+    buckets = response.data["facet_results"][0]["buckets"]
+    return [(b["value"], b["count"]) for b in buckets]
+
+
+def facet_partitions(field_name: str, values: list[str]) -> list[dict[str, Any]]:
+    """Split by the values of a field, with a catch-all partition for the others.
+
+    The catch-all takes the documents with values beyond the facet size or
+    without the field. A multi-valued field would put a document in several
+    partitions, so only single-valued fields should be used.
+    """
+    if not values:
+        return []
+
+    partitions: list[dict[str, Any]] = [
+        {"type": "match_any", "field_name": field_name, "values": [value]}
+        for value in values
+    ]
+    partitions.append({
+        "type": "not",
+        "filter": {"type": "match_any", "field_name": field_name, "values": list(values)},
+    })
+    return partitions
@@ -0,0 +1,126 @@
+"""Write-behind writer of the provenance records.
+
+The provenance rows of a page (files, datasets and ingest) are queued and a
+dedicated thread commits them in groups of GROUP_SIZE records, or after
+GROUP_MS milliseconds, so the sqlite transactions leave the fetch-ingest path
+of the pipeline. The records commit in the queued order, so a crash keeps a
+prefix of them. The query row of the next page, which marks the cursor of the
+previous page complete for get_offset_marker, is only written after barrier(),
+so a restart sees either all the rows of a page or restarts the page.
+"""
+import logging
+import queue
+import threading
+import time
+from collections.abc import Callable
+
+from sqlalchemy.orm import Session, sessionmaker
+
+Record = Callable[[Session], None]
+
+# a barrier in the queue commits the current group at once
+_FLUSH = object()
+_STOP = object()
+
+
+class ProvWriterConfig:
+    """config class for the provenance writer."""
+
+    GROUP_SIZE = 500        # records committed in one transaction
+    GROUP_MS = 200          # the longest wait of a record before its commit
+
+
+class ProvWriter:
+    """Commit the queued provenance records in groups in a thread."""
+
+    def __init__(
+        self,
+        session_factory: sessionmaker[Session],
+        group_size: int = ProvWriterConfig.GROUP_SIZE,
+        group_ms: int = ProvWriterConfig.GROUP_MS,
+        logger: logging.Logger | None = None,
+    ) -> None:
+        self._session_factory = session_factory
+        self.group_size = group_size
+        self.group_ms = group_ms
+        self._logger = logger or logging.getLogger(__name__)
+
+        self._queue: queue.Queue[object] = queue.Queue()
+        self._cond = threading.Condition()
+        self._submitted = 0
+        self._committed = 0
+        self._error: BaseException | None = None
+
+        self._thread = threading.Thread(target=self._loop, name="prov-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, record: Record) -> None:
+        """Queue a record to be run in a writer transaction."""
+        self._raise_error()
+        with self._cond:
+            self._submitted += 1
+        self._queue.put(record)
+
+    def barrier(self) -> None:
+        """Wait until all the records submitted so far are committed."""
+        with self._cond:
+            target = self._submitted
+            if self._committed >= target:
+                self._raise_error()
+                return
+        self._queue.put(_FLUSH)
+        with self._cond:
+            while self._committed < target and self._error is None:
+                self._cond.wait()
+        self._raise_error()
+
+    def close(self) -> None:
+        """Commit the queued records and stop the thread."""
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+        self._raise_error()
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            raise RuntimeError("the provenance writer failed") from self._error
+
+    def _loop(self) -> None:
+        stop = False
+        while not stop:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            if item is _FLUSH:
+                continue
+
+            group = [item]
+            deadline = time.monotonic() + self.group_ms / 1000
+            while len(group) < self.group_size:
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                if item is _FLUSH:
+                    break
+                group.append(item)
+
+            self._commit(group)
+
+    def _commit(self, group: list[Record]) -> None:
+        if self._error is None:
+            try:
+                with self._session_factory() as session, session.begin():
+                    for record in group:
+                        record(session)
+            except Exception as e:  # noqa BLE001
+                # the records are lost, the pipeline stops at its next submit or barrier
+                self._logger.error(f"cannot commit {len(group)} provenance records: {e}")
+                self._error = e
+
+        with self._cond:
+            self._committed += len(group)
+            self._cond.notify_all()
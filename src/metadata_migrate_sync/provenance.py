@@ -12,11 +12,29 @@ from uuid import UUID
 from pydantic import AnyUrl, BaseModel
 from pydantic._internal._model_construction import ModelMetaclass
 
+from metadata_migrate_sync.context import LOG_FORMAT, current_context
+
 
 class SingletonMeta(ModelMetaclass):
-    """Metaclass to enforce singleton behavior while preserving Pydantic's functionality."""
+    """Metaclass to enforce singleton behavior while preserving Pydantic's functionality.
+
+    Within a bound RunContext, the instance is the one of the context.
+    """
 
-    _instance = None
+    _singleton = None
+
+    @property
+    def _instance(cls) -> Any:  # noqa ANN401
+        ctx = current_context()
+        return ctx.prov if ctx is not None else cls._singleton
+
+    @_instance.setter
+    def _instance(cls, value: Any) -> None:  # noqa ANN401
+        ctx = current_context()
+        if ctx is not None:
+            ctx.prov = value
+        else:
+            cls._singleton = value
 
     def __call__(cls, *args: Any, **kwargs: Any):  # noqa ANN204 D102
         if not cls._instance:
@@ -30,7 +48,7 @@ class provenance(BaseModel, metaclass=SingletonMeta):
     it is a singleton instance
     """
 
-    task_name: Literal["migrate", "ingest", "sync", "replica", "delete", "revise", "fixes"]
+    task_name: Literal["migrate", "ingest", "sync", "replica", "delete", "revise", "fixes", "export", "load"]
     source_index_id: str | UUID | AnyUrl
     source_index_type: Literal["solr", "globus"]
     source_index_name: Literal["ornl", "anl", "llnl", "stage", "test", "test_1", "public", "backup"]
@@ -64,13 +82,17 @@ class provenance(BaseModel, metaclass=SingletonMeta):
     @classmethod
     def get_logger(cls, name:str) -> logging.Logger:
         """Get a logger handler."""
+        ctx = current_context()
+        if ctx is not None:
+            return ctx.logger
+
         log_filename = "test.log" if cls._instance is None else cls._instance.log_file
 
         logging_config = {
             "version": 1,
             "formatters": {
                 "standard": {
-                    "format": "%(asctime)s - %(funcName)s - %(levelname)s - %(message)s",
+                    "format": LOG_FORMAT,
                 },
             },
             "handlers": {
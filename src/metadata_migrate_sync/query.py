@@ -1,25 +1,87 @@
 """query for solr and globus both."""
 
-import json
+import csv
+import hashlib
+import io
 import logging
+import queue
 import sys
+import threading
 import time
 from collections.abc import Generator
+from itertools import islice
 from typing import Any, Literal
 from uuid import UUID
 
+import ijson
 import requests
 from globus_sdk import GlobusAPIError, SearchQueryV1
 from globus_sdk._missing import MISSING
 from pydantic import AnyUrl, BaseModel
 from requests.adapters import HTTPAdapter
 from requests.exceptions import ConnectionError, RequestException, RetryError
+from sqlalchemy import func
+from sqlalchemy.orm import Session
 from urllib3 import Retry
 
-from metadata_migrate_sync.database import Files, Index, Ingest, MigrationDB, Query
+from metadata_migrate_sync.codec import dumps, encoded_size, loads
+from metadata_migrate_sync.context import in_current_context
+from metadata_migrate_sync.database import (
+    Datasets,
+    Files,
+    FilesCompact,
+    Index,
+    Ingest,
+    MigrationDB,
+    Query,
+    QueryTemplate,
+)
 from metadata_migrate_sync.globus import GlobusClient
 from metadata_migrate_sync.project import ProjectReadOnly, ProjectReadWrite
 from metadata_migrate_sync.provenance import provenance
+from metadata_migrate_sync.summary import drop_pages
+
+# serializes the provenance writes of the concurrent scrolls
+_DB_LOCK = threading.RLock()
+
+
+class TemplateConfig:
+    """config class for the query templates."""
+
+    PAGE_KEYS = ("offset", "marker")   # the per-page parameters, out of the template
+    MAX_VALUES = 100    # a match_any filter with more values is the id chunk of the page
+
+
+def _digest(obj: Any) -> str:  # noqa ANN401
+    return hashlib.sha256(dumps(obj, compact=True, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def partition_key(partition: dict[str, Any]) -> str:
+    """Get the stable key of a partition filter, the partition of its pages in the query table."""
+    return _digest(partition)[:16]
+
+
+def query_template(query: dict[str, Any]) -> tuple[dict[str, Any], dict[str, Any], str | None]:
+    """Split a globus query into its template, per-page parameters and id chunk digest.
+
+    The values of the large match_any filters (the ids of replica and revise)
+    are left out of the template, the page only keeps their digest.
+    """
+    params = {k: query[k] for k in TemplateConfig.PAGE_KEYS if k in query}
+    template = {k: v for k, v in query.items() if k not in TemplateConfig.PAGE_KEYS}
+
+    chunk = []
+    if "filters" in query:
+        filters = []
+        for f in query["filters"]:
+            if f.get("type") == "match_any" and len(f.get("values", [])) > TemplateConfig.MAX_VALUES:
+                chunk.append(f["values"])
+                f = {**f, "values": []}
+            filters.append(f)
+        template["filters"] = filters
+
+    return template, params, _digest(chunk) if chunk else None
+
 
 params_search = {
     "sort": "id asc",
@@ -39,10 +101,22 @@ class BaseQuery(BaseModel):
 
 
 class SolrQuery(BaseQuery):
-    """query solr index."""
+    """query solr index.
+
+    With export the whole sorted result is streamed from the /export handler
+    in one request and cut into pages of query["rows"] documents. The
+    cursorMark of a page is then the id of its last document, a restart
+    exports the ids after it again. The export needs an explicit query["fl"]
+    of fields with docValues, they are checked against the schema first.
+
+    With id_only only the ids are fetched (pages of {"id": ...}), with
+    query["wt"] = "csv" they are paged by the id instead of the cursorMark.
+    """
 
     query: dict[str, Any]
     skip_prov: bool = False
+    export: bool = False
+    id_only: bool = False
 
     _restart: bool = False
     _review: bool = False
@@ -79,6 +153,7 @@ class SolrQuery(BaseQuery):
         else:
             # determine the cursorMark
 
+            MigrationDB.barrier()
             DBsession = MigrationDB.get_session()
             with DBsession() as session:
 
@@ -122,6 +197,21 @@ class SolrQuery(BaseQuery):
 
                             logger.info("The query should not happened")
 
+    @staticmethod
+    def _http_session() -> requests.Session:
+        """Get a http session with the retry logic."""
+        retry_strategy = Retry(
+            total=3,
+            backoff_factor=0.5,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=["GET"],
+        )
+        adapter = HTTPAdapter(max_retries=retry_strategy)
+        http = requests.Session()
+        http.mount("https://", adapter)
+        http.mount("http://", adapter)
+        return http
+
     @staticmethod
     def _make_request(
         url: str,
@@ -143,16 +233,7 @@ class SolrQuery(BaseQuery):
         """
         logger = provenance.get_logger(__name__)
 
-        retry_strategy = Retry(
-            total=3,
-            backoff_factor=0.5,
-            status_forcelist=(429, 500, 502, 503, 504),
-            allowed_methods=["GET"],
-        )
-        adapter = HTTPAdapter(max_retries=retry_strategy)
-        http = requests.Session()
-        http.mount("https://", adapter)
-        http.mount("http://", adapter)
+        http = SolrQuery._http_session()
 
         try:
             response = http.get(url, params=params)
@@ -185,6 +266,16 @@ class SolrQuery(BaseQuery):
         """
         logger = provenance.get_logger(__name__)
 
+        if self.export and not self._review:
+            yield from self._run_export()
+            return
+
+        if self.id_only:
+            self.query["fl"] = "id"
+            if self.query.get("wt") == "csv":
+                yield from self._run_ids_csv()
+                return
+
         while True:
 
             result = self._make_request(self.end_point, self.query)
@@ -195,7 +286,7 @@ class SolrQuery(BaseQuery):
             response_json, response_time, response_url = result
             if self.skip_prov:
                 logger.info("skip the provenance and database update for solr query")
-                self._numFound = response_json.get("response").get("numFound")
+                self._num_found = response_json.get("response").get("numFound")
             else:
                 self.prov_collect(response_url, response_time, response_json)
 
@@ -218,6 +309,142 @@ class SolrQuery(BaseQuery):
             else:
                 self.query["cursorMark"] = response_json.get("nextCursorMark")
 
+    @staticmethod
+    def _id_after_fq(last_id: str) -> str:
+        """Get the filter query of the ids after last_id."""
+        escaped = last_id.replace("\\", "\\\\").replace('"', '\\"')
+        return f'id:{{"{escaped}" TO *]'
+
+    def _run_ids_csv(self) -> Generator[Any, None, None]:
+        """Page the ids in csv by the last id of the previous page."""
+        logger = provenance.get_logger(__name__)
+
+        fq = self.query.get("fq", [])
+        fq = list(fq) if isinstance(fq, list) else [fq]
+        params = {
+            "q": self.query["q"],
+            "fq": fq,
+            "fl": "id",
+            "sort": "id asc",
+            "rows": self.query.get("rows", 1500),
+            "wt": "csv",
+            "csv.header": "false",
+        }
+        if "shards" in self.query:
+            params["shards"] = self.query["shards"]
+
+        result = self._make_request(self.end_point, {**params, "rows": 0, "wt": "json", "csv.header": None})
+        self._num_found = result[0]["response"]["numFound"] if result else None
+
+        http = self._http_session()
+        last_id = None
+        while True:
+            page_fq = fq if last_id is None else [*fq, self._id_after_fq(last_id)]
+            response = http.get(self.end_point, params={**params, "fq": page_fq})
+            response.raise_for_status()
+
+            page = [{"id": row[0]} for row in csv.reader(io.StringIO(response.text)) if row]
+            if page:
+                yield page
+            if len(page) < params["rows"]:
+                logger.info("Reached the last page.")
+                break
+            last_id = page[-1]["id"]
+
+    def _export_params(self) -> dict[str, Any]:
+        """Get the /export parameters, starting after the id in the cursorMark."""
+        if "shards" in self.query:
+            raise ValueError("the export mode does not support the shards")
+
+        fl = self.query.get("fl")
+        if not fl or fl == "*":
+            raise ValueError("the export mode needs the list of the docValues fields in fl")
+
+        fq = self.query.get("fq", [])
+        fq = list(fq) if isinstance(fq, list) else [fq]
+
+        last_id = self.query.get("cursorMark", "*")
+        if last_id != "*":
+            fq.append(self._id_after_fq(last_id))
+
+        return {
+            "q": self.query["q"],
+            "fq": fq,
+            "sort": "id asc",
+            "fl": fl,
+        }
+
+    def _check_export_fields(self, fields: list[str]) -> None:
+        """Check the exported fields have docValues in the schema.
+
+        Without the schema API, the fields are checked against the fields of
+        a /select document, which shows the missing fields but not docValues.
+        """
+        logger = provenance.get_logger(__name__)
+
+        core_url = self.end_point.rsplit("/select", 1)[0]
+        try:
+            result = self._make_request(f"{core_url}/schema/fields", {"showDefaults": "true", "wt": "json"})
+            schema = {f["name"]: f for f in result[0]["fields"]}
+        except (RequestException, KeyError, TypeError) as e:
+            logger.warning(f"cannot read the schema of {core_url}, check the fields against /select: {e}")
+            params = {"q": self.query["q"], "fq": self.query.get("fq", []), "rows": 1, "wt": "json"}
+            result = self._make_request(self.end_point, params)
+            docs = result[0]["response"]["docs"] if result else []
+            missing = [f for f in fields if docs and f not in docs[0]]
+            if missing:
+                raise ValueError(f"the export fields {missing} are not in the documents of {self.end_point}")
+            return
+
+        missing = [f for f in fields if f not in schema]
+        no_doc_values = [f for f in fields if f in schema and not schema[f].get("docValues")]
+        if missing or no_doc_values:
+            raise ValueError(
+                f"the export fields need docValues, missing: {missing}, without docValues: {no_doc_values}"
+            )
+
+    def _run_export(self) -> Generator[Any, None, None]:
+        """Stream the documents from the /export handler in pages."""
+        logger = provenance.get_logger(__name__)
+
+        rows = self.query.get("rows", 1500)
+        params = self._export_params()
+        self._check_export_fields([f.strip() for f in params["fl"].split(",")])
+
+        # the total for the progress, /export gives it only after the stream
+        result = self._make_request(self.end_point, {**params, "rows": 0, "wt": "json", "sort": None})
+        num_found = result[0]["response"]["numFound"] if result else None
+
+        export_url = self.end_point.rsplit("/select", 1)[0] + "/export"
+        logger.info(f"export {num_found} documents from {export_url} after {self.query.get('cursorMark')}")
+
+        http = self._http_session()
+        with http.get(export_url, params=params, stream=True) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            docs = ijson.items(response.raw, "response.docs.item", use_float=True)
+
+            start = time.time()
+            while page := list(islice(docs, rows)):
+                elapsed_time = time.time() - start
+
+                next_cursor = page[-1]["id"]
+                if self.skip_prov:
+                    self._num_found = num_found
+                else:
+                    self.prov_collect(
+                        response.url,
+                        elapsed_time,
+                        {"response": {"numFound": num_found, "docs": page}, "nextCursorMark": next_cursor},
+                    )
+
+                yield page
+
+                self.query["cursorMark"] = next_cursor
+                start = time.time()
+
+        logger.info("Reached the end of the export.")
+
     def prov_collect(
         self,
         req_url: str,
@@ -225,7 +452,10 @@ class SolrQuery(BaseQuery):
         response: dict[Any, Any],
     ) -> None:
         """Collect prov and db."""
-        self._numFound = response.get("response").get("numFound")
+        self._num_found = response.get("response").get("numFound")
+
+        # the rows of the previous page are committed before its cursor is passed
+        MigrationDB.barrier()
 
         DBsession = MigrationDB.get_session()
         with DBsession() as session:
@@ -248,6 +478,12 @@ class SolrQuery(BaseQuery):
                 )
                 prepage = session.query(Query).order_by(Query.id.desc()).first()
 
+                # fq is a string or a list of filter queries
+                fq = self.query.get("fq")
+                if isinstance(fq, list):
+                    fq_timestamp = [f for f in fq if f.startswith("_timestamp")]
+                    fq = fq_timestamp[0] if fq_timestamp else " AND ".join(fq)
+
                 query_obj = Query(
                     project=self.project,
                     project_type=(
@@ -258,9 +494,7 @@ class SolrQuery(BaseQuery):
                     query_str=req_url.split("?")[1],
                     query_type="solr",
                     query_time=req_time,
-                    date_range=(
-                        "[* To *]" if not self.query.get("fq") else self.query.get("fq")
-                    ),
+                    date_range=fq if fq else "[* To *]",
                     numFound=response.get("response").get("numFound"),
                     n_datasets=(
                         0
@@ -278,7 +512,7 @@ class SolrQuery(BaseQuery):
                     cursorMark_next=response.get("nextCursorMark"),
                     n_failed=0,
                     index=ind,
-                    doc_size = len(json.dumps(response.get("response").get("docs"))),
+                    doc_size = encoded_size(response.get("response").get("docs")),
                 )
 
                 session.add(query_obj)
@@ -294,6 +528,8 @@ class GlobusQuery(BaseQuery):
     generator: bool = False
     paginator: Literal["post", "scroll"]
     skip_prov: bool = False
+    ids_only: bool = False
+    partition: str | None = None
 
     _current_query: Any | None = None
     _total_returned: int = 0
@@ -302,6 +538,89 @@ class GlobusQuery(BaseQuery):
 
     _n_batch: int = 0
 
+    def _last_query(self, session: Session) -> Query | None:
+        """Get the last query row (of the partition)."""
+        query = session.query(Query)
+        if self.partition is not None:
+            query = query.filter(Query.partition == self.partition)
+        return query.order_by(Query.id.desc()).first()
+
+    @staticmethod
+    def _page_complete(page: Query) -> bool:
+        """Check all the ingest rows of a page are recorded and submitted."""
+        ingests = [ing for ing in page.ingest if ing.pages == page.pages]
+        return (
+            len(ingests) > 0
+            and page.n_datasets != 0
+            and len(ingests) == page.n_datasets
+            and all(ing.submitted != 0 for ing in ingests)
+        )
+
+    def _coalesced_restart_page(self, session: Session, last_query: Query, logger: logging.Logger) -> Query:
+        """Get the page to restart from, before the unclosed coalesced pages.
+
+        The ingest coalescer submits the entries of consecutive pages together
+        and closes the pages in order, so the unclosed pages before an
+        incomplete last page are queried again too. The rows of the pages
+        after the earliest one are deleted, it becomes the last page.
+        """
+        if self._page_complete(last_query):
+            return last_query
+
+        previous = session.query(Query).filter(Query.id < last_query.id)
+        if self.partition is not None:
+            previous = previous.filter(Query.partition == self.partition)
+
+        restart_page = last_query
+        for page in previous.order_by(Query.id.desc()).all():
+            if not page.coalesced or self._page_complete(page):
+                break
+            restart_page = page
+
+        if restart_page is last_query:
+            return last_query
+
+        later = session.query(Query.pages).filter(Query.id > restart_page.id)
+        if self.partition is not None:
+            later = later.filter(Query.partition == self.partition)
+        later_pages = [p for (p,) in later.all()]
+
+        drop_pages(session, later_pages)
+        for table in (Ingest, Files, FilesCompact, Datasets):
+            session.query(table).filter(table.pages.in_(later_pages)).delete(synchronize_session=False)
+        session.query(Query).filter(Query.pages.in_(later_pages)).delete(synchronize_session=False)
+        session.commit()
+
+        logger.info(
+            f"Delete {len(later_pages)} unclosed coalesced pages after the page {restart_page.pages}"
+        )
+        return session.get(Query, restart_page.id)
+
+    def _same_filters(self, last_query: Query) -> bool:
+        """Check the filters of a page are the ones of this query, by their digests."""
+        if last_query.template is None:
+            return loads(last_query.query_str)["filters"] == self.query["filters"]
+
+        template, _, id_chunk = query_template({"filters": self.query["filters"]})
+        return (
+            last_query.template.filters_digest == _digest(template["filters"])
+            and last_query.id_chunk == id_chunk
+        )
+
+    @staticmethod
+    def _get_template(session: Session, template: dict[str, Any]) -> QueryTemplate:
+        """Get the row of a query template, added at its first page."""
+        digest = _digest(template)
+        template_row = session.query(QueryTemplate).filter(QueryTemplate.digest == digest).first()
+        if template_row is None:
+            template_row = QueryTemplate(
+                digest=digest,
+                filters_digest=_digest(template.get("filters", [])),
+                template=dumps(template),
+            )
+            session.add(template_row)
+        return template_row
+
     def get_offset_marker(self, review:bool = False) -> None:
         """Find the offset or marker of previous synchronization."""
         logger = provenance._instance.get_logger(__name__)
@@ -311,16 +630,13 @@ class GlobusQuery(BaseQuery):
 
         else:
             # determine the offset
+            MigrationDB.barrier()
             DBsession = MigrationDB.get_session()
             with DBsession() as session:
 
-                last_query = session.query(Query).order_by(Query.id.desc()).first()
-
+                last_query = self._last_query(session)
 
-                if last_query:
-                    query_dict= json.loads(last_query.query_str)
-
-                if last_query is None or query_dict["filters"] != self.query["filters"]:  # new start
+                if last_query is None or not self._same_filters(last_query):  # new start
                     self._current_query = None
 
                     if self.paginator == "scroll":
@@ -333,6 +649,7 @@ class GlobusQuery(BaseQuery):
                     logger.info("The query is a new start")
                 else:
 
+                    last_query = self._coalesced_restart_page(session, last_query, logger)
                     self._current_query = last_query
                     ingest_obj = last_query.ingest
 
@@ -368,6 +685,10 @@ class GlobusQuery(BaseQuery):
                             deleted_count = session.query(Files)  \
                                 .filter(Files.pages == last_query.pages)\
                                 .delete(synchronize_session=False)
+                            deleted_count += session.query(FilesCompact)  \
+                                .filter(FilesCompact.pages == last_query.pages)\
+                                .delete(synchronize_session=False)
+                            drop_pages(session, [last_query.pages])
 
                             logger.info(f"Delete failed file records {deleted_count}")
 
@@ -402,6 +723,10 @@ class GlobusQuery(BaseQuery):
                                 deleted_count = session.query(Files)  \
                                     .filter(Files.pages == last_query.pages)\
                                     .delete(synchronize_session=False)
+                                deleted_count += session.query(FilesCompact)  \
+                                    .filter(FilesCompact.pages == last_query.pages)\
+                                    .delete(synchronize_session=False)
+                                drop_pages(session, [last_query.pages])
 
                                 logger.info(f"Delete failed file records {deleted_count}")
 
@@ -429,6 +754,15 @@ class GlobusQuery(BaseQuery):
                                 )
 
 
+    def _keep_ids(self, entries: dict[str, Any]) -> dict[str, Any]:
+        """Drop the content of the documents in the ids_only mode."""
+        if not self.ids_only:
+            return entries
+        return {
+            **entries,
+            "gmeta": [{"subject": g["subject"]} for g in entries.get("gmeta", [])],
+        }
+
     def run(self) -> Generator[Any, None, None] | dict[Any, Any]:
         """Query the globus index in a pagination way."""
         logger = (
@@ -475,14 +809,15 @@ class GlobusQuery(BaseQuery):
                     elapsed_time = time.time() - start
                     start = time.time()
 
-                    entries = batch.data
+                    entries = self._keep_ids(batch.data)
                     total_returned += len(entries)
                     self._total_returned = total_returned
 
                     if self.skip_prov:
                         logger.info("skip the provenance and database update")
                     else:
-                        self.prov_collect(entries, elapsed_time, sq)
+                        with _DB_LOCK:
+                            self.prov_collect(entries, elapsed_time, sq)
                     yield entries
             except Exception as e:
                 logger.error(e)
@@ -494,38 +829,28 @@ class GlobusQuery(BaseQuery):
         if self.paginator == "post":
 
             offset = self.query["offset"]
-            max_retries = 3
             #sq.add_sort(self.query.get("sort_field"), order=self.query.get("sort"))
             # "sort": [{"field_name": "path.to.date", "order": "asc"}],
             sq["sort"] = [{"field_name": self.query.get("sort_field"), "order":self.query.get("sort")}]
             while True:
-                retries = 0
-                r = None
-                while retries < max_retries:
-                    try:
-
-                        #sq.set_query("*").set_limit(page_size).set_offset(offset)
-                        sq["q"] = "*"
-                        sq["limit"]= page_size
-                        sq["offset"] = offset
-
-                        start = time.time()
-                        r = sc.post_search(_globus_index_id, sq)
-                        elapsed_time = time.time() - start
-                        break
-
-                    except GlobusAPIError as e:
-                        if e.http_status == 429:  # Rate limited
-                            retries += 1
-                            time.sleep(2 ** retries)  # Exponential backoff
-                            continue
-                        logger.error(f"Error happened in globus query: {e}")
-                        raise  # Re-raise other errors
+                #sq.set_query("*").set_limit(page_size).set_offset(offset)
+                sq["q"] = "*"
+                sq["limit"]= page_size
+                sq["offset"] = offset
+
+                # the 429 is retried by the rate limiter of the search client
+                try:
+                    start = time.time()
+                    r = sc.post_search(_globus_index_id, sq)
+                    elapsed_time = time.time() - start
+                except GlobusAPIError as e:
+                    logger.error(f"Error happened in globus query: {e}")
+                    raise
 
                 if not r or not r["gmeta"]:
                     break
 
-                entries = r.data
+                entries = self._keep_ids(r.data)
                 total_returned += len(entries)
                 self._total_returned = total_returned
 
@@ -537,7 +862,8 @@ class GlobusQuery(BaseQuery):
                 if self.skip_prov:
                     logger.info("skip the provenance and database update")
                 else:
-                    self.prov_collect(entries, elapsed_time, sq)
+                    with _DB_LOCK:
+                        self.prov_collect(entries, elapsed_time, sq)
 
                 yield entries
 
@@ -553,13 +879,16 @@ class GlobusQuery(BaseQuery):
     ) -> None:
         """Collect provenance and update database from a globus query."""
         logger = provenance._instance.get_logger(__name__)
-        self._numFound = entries.get("total")
+        self._num_found = entries.get("total")
 
 
         if not entries:
             logger.warning("No entries provided for provenance collection")
             return
 
+        # the rows of the previous page are committed before its cursor is passed
+        MigrationDB.barrier()
+
         DBsession = MigrationDB.get_session()
         with DBsession() as session:
 
@@ -567,11 +896,12 @@ class GlobusQuery(BaseQuery):
                 pass
 
             elif self._restart:
-                prepage = session.query(Query).order_by(Query.id.desc()).first()
+                prepage = self._last_query(session)
                 prepage.n_failed = prepage.n_failed + 1
                 prepage.query_time = req_time
                 session.commit()
                 self._restart = False
+                self._current_query = self._last_query(session)
 
             else:
 
@@ -581,18 +911,21 @@ class GlobusQuery(BaseQuery):
                     .filter(Index.index_name == my_index_name)
                     .first()
                 )
-                prepage = session.query(Query).order_by(Query.id.desc()).first()
+                # the pages are numbered over all the partitions
+                last_pages = session.query(func.max(Query.pages)).scalar()
 
                 date_range = "[{'from':'*', 'to':'*'}]"
                 for f in self.query["filters"]:
                     if f["field_name"] == "_timestamp":
-                        date_range = json.dumps(f["values"])
+                        date_range = dumps(f["values"])
 
                 cleaned_sq = {
                     k: v
                     for k, v in sq.items()
                     if v is not MISSING
                 }
+                # the page keeps the template once and its own parameters
+                template, params, id_chunk = query_template(cleaned_sq)
 
                 query_obj = Query(
                     project=self.project,
@@ -602,14 +935,16 @@ class GlobusQuery(BaseQuery):
                         else "readwrite"
                     ),
                     #query_str=json.dumps(sq.__dict__["data"]),
-                    query_str=json.dumps(cleaned_sq),
+                    query_str=dumps(params),
+                    template=self._get_template(session, template),
+                    id_chunk=id_chunk,
                     query_type="globus",
                     query_time=req_time,
                     date_range=date_range,
                     numFound=entries.get("total"),
                     n_datasets=0,             #store the n_batch in the sync mode
                     n_files=len(entries.get("gmeta")),
-                    pages=prepage.pages + 1 if prepage is not None else 1,
+                    pages=last_pages + 1 if last_pages is not None else 1,
                     rows=self.query.get("limit"),
                     cursorMark=self.query.get("premarker") if "marker" in entries else str(
                         self.query.get("offset")),
@@ -617,15 +952,126 @@ class GlobusQuery(BaseQuery):
                         self.query.get("offset")+self.query.get("limit")),
                     n_failed=0,
                     index=ind,
-                    doc_size = len(json.dumps(entries)),
+                    doc_size = encoded_size(entries),
+                    partition=self.partition,
                 )
 
                 session.add(query_obj)
                 session.commit()
-                curpage = session.query(Query).order_by(Query.id.desc()).first()
+                curpage = self._last_query(session)
                 self._current_query = curpage
 
                 if "marker" in entries:
                     self.query["premarker"] = entries.get("marker")
 
             logger.info("Sucessfully update query table in the database")
+
+
+class PartitionedGlobusQuery(BaseQuery):
+    """Scroll a globus index in disjoint partitions concurrently.
+
+    Every partition filter (see the partition module) is added to the query
+    filters of its own GlobusQuery, which records its marker in the query
+    table with the key of the partition (the digest of its filter), so
+    get_offset_marker resumes every partition on its own. The pages of all the partitions are merged into one
+    stream. A partition fetches its next page while the other partitions'
+    pages are consumed, but not before its own page is consumed, so a restart
+    never skips a page that was fetched and not ingested.
+    """
+
+    query: dict[Any, Any]
+    partitions: list[dict[str, Any]]
+    skip_prov: bool = False
+    ids_only: bool = False
+
+    _queries: list[GlobusQuery] = []
+    _current_query: Any | None = None
+    _num_found: int | None = None
+    _n_batch: int = 0
+
+    def model_post_init(self, __context: Any) -> None:  # noqa ANN401
+        """Create the query of every partition."""
+        self._queries = [
+            GlobusQuery(
+                end_point=self.end_point,
+                ep_type=self.ep_type,
+                ep_name=self.ep_name,
+                project=self.project,
+                query={**self.query, "filters": [*self.query["filters"], partition]},
+                generator=True,
+                paginator="scroll",
+                skip_prov=self.skip_prov,
+                ids_only=self.ids_only,
+                partition=partition_key(partition),
+            )
+            for partition in self.partitions
+        ]
+
+    def get_offset_marker(self, review: bool = False) -> None:
+        """Find the marker of every partition."""
+        for gq in self._queries:
+            gq.get_offset_marker(review=review)
+
+    def _scroll(
+        self,
+        n: int,
+        pages: "queue.Queue[tuple[int, Any, Any, BaseException | None]]",
+        resume: threading.Event,
+        stop: threading.Event,
+    ) -> None:
+        """Scroll a partition, waiting for its page to be consumed before the next one."""
+        gq = self._queries[n]
+        try:
+            for page in gq.run():
+                pages.put((n, page, gq._current_query, None))
+                resume.wait()
+                resume.clear()
+                if stop.is_set():
+                    return
+        except BaseException as e:  # noqa BLE001
+            pages.put((n, None, None, e))
+            return
+        pages.put((n, None, None, None))
+
+    def run(self) -> Generator[Any, None, None]:
+        """Merge the pages of the concurrent partition scrolls."""
+        pages: queue.Queue[tuple[int, Any, Any, BaseException | None]] = queue.Queue()
+        resume = [threading.Event() for _ in self._queries]
+        stop = threading.Event()
+        totals: dict[int, int] = {}
+
+        threads = [
+            threading.Thread(
+                target=in_current_context(self._scroll), args=(n, pages, resume[n], stop), daemon=True
+            )
+            for n in range(len(self._queries))
+        ]
+        for t in threads:
+            t.start()
+
+        active = len(threads)
+        last = None
+        try:
+            while active > 0:
+                if last is not None:
+                    resume[last].set()
+                    last = None
+
+                n, page, current_query, error = pages.get()
+                if error is not None:
+                    raise error
+                if page is None:
+                    active -= 1
+                    continue
+
+                if page.get("total") is not None:
+                    totals[n] = page["total"]
+                    self._num_found = sum(totals.values())
+
+                self._current_query = current_query
+                last = n
+                yield page
+        finally:
+            stop.set()
+            for event in resume:
+                event.set()
@@ -0,0 +1,207 @@
+"""Process-wide rate limiting of the Globus search API calls.
+
+Every request of a search client goes through the limiter of its API class
+(search, ingest or task). A limiter is a token bucket for the request rate and
+a concurrency limit for the requests in flight, and both are adjusted with
+AIMD: they grow additively while the responses are fast and successful, and
+they are cut multiplicatively on 429 or on a latency above the target. The
+limiters are shared by all the clients and threads of the process, so the
+concurrent pipelines back off together instead of retrying on their own.
+"""
+import logging
+import threading
+import time
+from collections.abc import Callable
+from typing import Any, Literal
+
+from globus_sdk import GlobusAPIError, SearchClient
+
+from metadata_migrate_sync.provenance import provenance
+
+ApiClass = Literal["search", "ingest", "task"]
+
+
+class RateLimitConfig:
+    """config class for the rate limits."""
+
+    # the starting and maximum request rates (per second)
+    RATES: dict[str, float] = {"search": 10.0, "ingest": 2.0, "task": 5.0}
+    MIN_RATE = 0.1
+    # the maximum requests in flight
+    CONCURRENCY: dict[str, int] = {"search": 8, "ingest": 4, "task": 4}
+    # a slower response than this counts as congestion (seconds)
+    LATENCY_TARGET: dict[str, float] = {"search": 10.0, "ingest": 30.0, "task": 5.0}
+
+    RATE_INCREASE = 0.1     # added to the rate on every fast success
+    DECREASE = 0.5          # the rate and concurrency factor on 429
+    LATENCY_DECREASE = 0.8  # the concurrency factor on a slow response
+    MAX_RETRIES = 6
+    MAX_SLEEP = 60.0
+
+
+def _logger() -> logging.Logger:
+    return (
+        provenance._instance.get_logger(__name__)
+        if provenance._instance is not None else logging.getLogger()
+    )
+
+
+class AdaptiveLimiter:
+    """A token bucket with an AIMD rate and concurrency limit."""
+
+    def __init__(self, name: str, rate: float, concurrency: int, latency_target: float) -> None:
+        self.name = name
+        self.max_rate = rate
+        self.max_concurrency = concurrency
+        self.latency_target = latency_target
+
+        self.rate = rate
+        self.concurrency = float(concurrency)
+        self.in_flight = 0
+
+        self._tokens = 1.0
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._cond = threading.Condition()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(
+            max(self.rate, 1.0),
+            self._tokens + (now - self._updated) * self.rate,
+        )
+        self._updated = now
+
+    def acquire(self) -> None:
+        """Wait for a token and a free slot."""
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self._blocked_until - now
+                if wait <= 0 and self._tokens < 1.0:
+                    wait = (1.0 - self._tokens) / self.rate
+                if wait <= 0 and self.in_flight < int(self.concurrency):
+                    self._tokens -= 1.0
+                    self.in_flight += 1
+                    return
+                # a released slot notifies, a missing token times out
+                self._cond.wait(timeout=wait if wait > 0 else None)
+
+    def release(self, latency: float | None = None, throttled: bool = False) -> None:
+        """Free the slot and adjust the limits to the outcome of the request."""
+        with self._cond:
+            self.in_flight -= 1
+            if throttled:
+                self.rate = max(RateLimitConfig.MIN_RATE, self.rate * RateLimitConfig.DECREASE)
+                self.concurrency = max(1.0, self.concurrency * RateLimitConfig.DECREASE)
+            elif latency is not None and latency > self.latency_target:
+                self.concurrency = max(1.0, self.concurrency * RateLimitConfig.LATENCY_DECREASE)
+            elif latency is not None:
+                self.rate = min(self.max_rate, self.rate + RateLimitConfig.RATE_INCREASE)
+                self.concurrency = min(
+                    float(self.max_concurrency), self.concurrency + 1.0 / self.concurrency
+                )
+            self._cond.notify_all()
+
+    def block(self, seconds: float) -> None:
+        """Hold all the requests of this class, e.g. for a Retry-After."""
+        with self._cond:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+
+_LIMITERS: dict[str, AdaptiveLimiter] = {}
+_LIMITERS_LOCK = threading.Lock()
+
+
+def get_limiter(api_class: ApiClass) -> AdaptiveLimiter:
+    """Get the process-wide limiter of an API class."""
+    with _LIMITERS_LOCK:
+        if api_class not in _LIMITERS:
+            _LIMITERS[api_class] = AdaptiveLimiter(
+                api_class,
+                RateLimitConfig.RATES[api_class],
+                RateLimitConfig.CONCURRENCY[api_class],
+                RateLimitConfig.LATENCY_TARGET[api_class],
+            )
+        return _LIMITERS[api_class]
+
+
+def reset_limiters() -> None:
+    """Drop the limiters, e.g. after changing the config."""
+    with _LIMITERS_LOCK:
+        _LIMITERS.clear()
+
+
+def api_class_of(method: str, path: str) -> ApiClass:
+    """Classify a search API request by its path."""
+    if "/task" in path:
+        return "task"
+    if method.upper() != "GET" and ("/ingest" in path or "/batch_delete" in path or "/subject" in path):
+        return "ingest"
+    return "search"
+
+
+def _retry_after(e: GlobusAPIError, attempt: int) -> float:
+    """Get the wait of a 429 from the Retry-After header, or back off exponentially."""
+    header = e.headers.get("Retry-After") if e.headers else None
+    try:
+        wait = float(header) if header is not None else 2.0 ** attempt
+    except ValueError:
+        wait = 2.0 ** attempt
+    return min(wait, RateLimitConfig.MAX_SLEEP)
+
+
+def limited(request: Callable[..., Any]) -> Callable[..., Any]:
+    """Wrap the request method of a client with the limiters."""
+
+    def _request(method: str, path: str, *args: Any, **kwargs: Any) -> Any:  # noqa ANN401
+        limiter = get_limiter(api_class_of(method, path))
+        attempt = 0
+        while True:
+            limiter.acquire()
+            start = time.monotonic()
+            try:
+                response = request(method, path, *args, **kwargs)
+            except GlobusAPIError as e:
+                if e.http_status != 429:
+                    limiter.release()
+                    raise
+                limiter.release(throttled=True)
+                attempt += 1
+                if attempt > RateLimitConfig.MAX_RETRIES:
+                    raise
+                wait = _retry_after(e, attempt)
+                _logger().info(
+                    f"{limiter.name} rate limited, retry {attempt} in {wait:.1f}s "
+                    f"at {limiter.rate:.2f}/s and {int(limiter.concurrency)} in flight"
+                )
+                limiter.block(wait)
+                continue
+            except BaseException:
+                limiter.release()
+                raise
+            limiter.release(latency=time.monotonic() - start)
+            return response
+
+    _request.__wrapped__ = request  # type: ignore[attr-defined]
+    return _request
+
+
+def install(sc: SearchClient) -> SearchClient:
+    """Route the requests of a search client through the limiters (once).
+
+    The retries of 429 by the sdk transport are turned off, so the limiters
+    see every 429 and slow down all the callers.
+    """
+    if getattr(sc.request, "__wrapped__", None) is not None:
+        return sc
+
+    retry_config = sc.retry_config
+    retry_config.retry_after_status_codes = tuple(
+        c for c in retry_config.retry_after_status_codes if c != 429
+    )
+    retry_config.transient_error_status_codes = tuple(
+        c for c in retry_config.transient_error_status_codes if c != 429
+    )
+    sc.request = limited(sc.request)  # type: ignore[method-assign]
+    return sc
@@ -27,12 +27,18 @@ def metadata_replica(*,
     dst_data_node: str=Literal["ornl", "newiap"],
     page_start: int = 0,
     per_page: int = 2000,   #XXXXXX make sure it is less than 10000 the limit of post query
+    page_end: int | None = None,
     has_globus: bool = True,
     is_replica: bool = True,
     dry_run: bool = False,
     output_path: str = './',
+    processes: int | None = None,
 ) -> None:
-    """metadata replication."""
+    """metadata replication.
+
+    The pages page_start + 1 to page_end (all the pages without it) of the
+    json ids are replicated, an id chunk of a distributed run is a page range.
+    """
 
 
     if dry_run:
@@ -79,6 +85,7 @@ def metadata_replica(*,
 
     # database
     _ = MigrationDB(prov.db_file, True)
+    MigrationDB.start_writer()
     logger.info(f"initialized the sqlite database at {prov.db_file}")
 
     query_dict = {
@@ -126,7 +133,18 @@ def metadata_replica(*,
 
     page = page_start
 
-    with tqdm(
+    gm =  ModifiedGmetaGenerator(
+        modifier = replicate_gmeta,
+        processes = processes,
+        metatype = meta,
+        source_data_node = src_data_node,
+        target_data_node = dst_data_node,
+        has_globus = has_globus,
+        is_replica = is_replica,
+    )
+
+    failed = False
+    with gm, tqdm(
         desc="Processing pages",
         initial=page_start,
         unit="page",
@@ -137,6 +155,8 @@ def metadata_replica(*,
     ) as pbar:
         while True:
             page = page + 1
+            if page_end is not None and page > page_end:
+                break
             try:
                 result = paginate_json(
                     replica_json,
@@ -155,14 +175,6 @@ def metadata_replica(*,
 
                     if dry_run:
                         print("gpage", gpage)
-                    gm =  ModifiedGmetaGenerator(
-                        modifier = replicate_gmeta,
-                        metatype = meta,
-                        source_data_node = src_data_node,
-                        target_data_node = dst_data_node,
-                        has_globus = has_globus,
-                        is_replica = is_replica,
-                    )
 
                     gm_list, gm_list_skip = gm.generate(gpage)
 
@@ -222,5 +234,15 @@ def metadata_replica(*,
                 pbar.set_description(f"Processing page {page}")
 
             except Exception as e:
+                # the pages are read until an empty one, an exception is a failed page
                 print (f"No more page left {e}")
+                logger.error(f"the page {page} failed: {e!r}")
+                failed = True
                 break
+
+    MigrationDB.stop_writer()
+
+    # a unit of the work queue is done only with the successful provenance
+    if not failed:
+        prov.successful = True
+        pathlib.Path(prov.prov_file).write_text(prov.model_dump_json(indent=2))
@@ -29,8 +29,14 @@ def metadata_revise(
     is_fix: bool=False,
     page_start: int = 0,
     per_page: int = 2000, # XXXXX
+    page_end: int | None = None,
+    output_path: str = "./",
 ) -> None:
-    """metadata revision"""
+    """metadata revision
+
+    The pages page_start + 1 to page_end (all the pages without it) of the
+    json ids are revised, an id chunk of a distributed run is a page range.
+    """
 
     client_name, index_name = GlobusClient.get_client_index_names(globus_ep, project.value)
     _globus_index_id = GlobusClient.globus_clients[client_name].indexes[index_name]
@@ -49,9 +55,9 @@ def metadata_revise(
         ingest_index_type="globus",
         ingest_index_name=globus_ep,
         ingest_index_schema="ESGF1.5",
-        log_file=f"{file_base}.log",
-        prov_file=f"{file_base}.json",
-        db_file=f"{file_base}.sqlite",
+        log_file=f"{output_path}/{file_base}.log",
+        prov_file=f"{output_path}/{file_base}.json",
+        db_file=f"{output_path}/{file_base}.sqlite",
         type_query=meta,
         cmd_line=" ".join(sys.argv),
     )
@@ -68,6 +74,7 @@ def metadata_revise(
 
     # database
     _ = MigrationDB(prov.db_file, True)
+    MigrationDB.start_writer()
     logger.info(f"initialized the sqlite database at {prov.db_file}")
 
 
@@ -138,6 +145,7 @@ def metadata_revise(
 
     page = page_start
 
+    failed = False
     with tqdm(
         desc="Processing pages",
         initial=page_start,
@@ -149,6 +157,8 @@ def metadata_revise(
     ) as pbar:
         while True:
             page = page + 1
+            if page_end is not None and page > page_end:
+                break
             try:
                 result = paginate_json(
                     revise_json,
@@ -225,8 +235,17 @@ def metadata_revise(
                 pbar.set_description(f"Processing page {page}")
 
             except Exception as e:
+                # the pages are read until an empty one, an exception is a failed page
                 print (f"No more page left {e}")
+                logger.error(f"the page {page} failed: {e!r}")
+                failed = True
                 break
 
+    MigrationDB.stop_writer()
     logger.info(f"Total Skipped: {total_skipped}")
     logger.info(f"Total Revised: {total_revised}")
+
+    # a unit of the work queue is done only with the successful provenance
+    if not failed:
+        prov.successful = True
+        pathlib.Path(prov.prov_file).write_text(prov.model_dump_json(indent=2))
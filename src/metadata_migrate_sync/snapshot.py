@@ -0,0 +1,466 @@
+"""Snapshot export and load of a globus index with compressed NDJSON shards.
+
+The documents of a project are split into disjoint partitions (see the
+partition module), each partition is scrolled in its own thread and written
+to one shard with a gmeta entry per line. A manifest records the filters,
+counts and checksums of the shards.
+
+The load reads the shards back through the gmeta generators and ingests them
+with concurrent submitters. The progress of every shard is kept in the
+database, so a crashed load resumes at the last acknowledged line.
+"""
+import gzip
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import sys
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
+from datetime import datetime
+from itertools import islice
+from typing import Any, Literal
+
+from globus_sdk import SearchClient
+from pydantic import validate_call
+from tqdm import tqdm
+
+from metadata_migrate_sync.codec import dumps, encoded_size, loads
+from metadata_migrate_sync.context import in_current_context
+from metadata_migrate_sync.convert import fix_dtype_gmeta
+from metadata_migrate_sync.database import MigrationDB, ShardProgress
+from metadata_migrate_sync.globus import GlobusClient, GlobusCV
+from metadata_migrate_sync.gmeta import GmetaGenerator, ModifiedGmetaGenerator, StandardGmetaGenerator
+from metadata_migrate_sync.partition import (
+    facet_partitions,
+    facet_values,
+    format_timestamp,
+    timestamp_partitions,
+)
+from metadata_migrate_sync.project import ProjectReadOnly, ProjectReadWrite
+from metadata_migrate_sync.provenance import provenance
+from metadata_migrate_sync.query import GlobusQuery
+
+
+class ExportConfig:
+    """config class for the snapshot export."""
+
+    PAGE_SIZE = 1000
+    MAX_WORKERS = 4
+    N_PARTITIONS = 16
+    COMPRESS_LEVEL = 6
+    MANIFEST = "manifest.json"
+
+
+class LoadConfig:
+    """config class for the snapshot load."""
+
+    MAX_INGEST_SIZE = 10 * 1000 * 1000 - 1000  # 10MB with buffer
+    CHUNK_LINES = 2000      # lines of a shard converted at once
+    MAX_WORKERS = 4
+
+
+def _sha256_file(path: pathlib.Path) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for block in iter(lambda: fh.read(1024 * 1024), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _export_partition(
+    *,
+    shard_no: int,
+    partition: dict[str, Any] | None,
+    base_filters: list[dict[str, Any]],
+    out_dir: pathlib.Path,
+    globus_epname: str,
+    project: ProjectReadOnly | ProjectReadWrite,
+    index_id: str,
+    page_size: int,
+) -> dict[str, Any]:
+    """Scroll one partition and write it to a gzipped NDJSON shard."""
+    filters = base_filters + ([partition] if partition is not None else [])
+
+    gq = GlobusQuery(
+        end_point=index_id,
+        ep_type="globus",
+        ep_name=globus_epname,
+        project=project,
+        query={"filters": filters, "limit": page_size},
+        generator=True,
+        paginator="scroll",
+        skip_prov=True,
+    )
+
+    shard = out_dir / f"shard_{shard_no:04d}.ndjson.gz"
+    tmp = shard.with_suffix(".tmp")
+
+    count = 0
+    expected = None
+    with gzip.open(tmp, "wt", encoding="utf-8", compresslevel=ExportConfig.COMPRESS_LEVEL) as fh:
+        for page in gq.run():
+            if expected is None:
+                expected = page.get("total")
+            for gmeta in page.get("gmeta", []):
+                fh.write(dumps(gmeta, compact=True))
+                fh.write("\n")
+                count += 1
+    os.replace(tmp, shard)
+
+    return {
+        "shard": shard.name,
+        "filters": filters,
+        "count": count,
+        "expected": expected,
+        "bytes": shard.stat().st_size,
+        "sha256": _sha256_file(shard),
+    }
+
+
+@validate_call
+def metadata_export(
+    *,
+    globus_epname: Literal["test", "test_1", "public", "stage", "backup"],
+    project: ProjectReadOnly | ProjectReadWrite,
+    out_dir: str | pathlib.Path,
+    partition_by: str = "_timestamp",
+    n_partitions: int = ExportConfig.N_PARTITIONS,
+    time_from: datetime,
+    time_to: datetime,
+    max_workers: int = ExportConfig.MAX_WORKERS,
+    page_size: int = ExportConfig.PAGE_SIZE,
+) -> dict[str, Any]:
+    """Export the documents of a project to NDJSON shards with a manifest.
+
+    With partition_by="_timestamp" [time_from, time_to] is cut into
+    n_partitions ranges, otherwise the partitions are the values of the facet
+    field within [time_from, time_to].
+    """
+    client_name, index_name = GlobusClient.get_client_index_names(globus_epname, project.value)
+    index_id = str(GlobusClient.globus_clients[client_name].indexes[index_name])
+
+    out_path = pathlib.Path(out_dir)
+    out_path.mkdir(parents=True, exist_ok=True)
+
+    current_timestr = datetime.now().strftime("%Y-%m-%d")
+    file_base = out_path / f"export_{globus_epname}_{project.value}_{current_timestr}"
+
+    prov = provenance(
+        task_name="export",
+        source_index_id=index_id,
+        source_index_type="globus",
+        source_index_name=globus_epname,
+        source_index_schema="ESGF1.5",
+        ingest_index_id=index_id,
+        ingest_index_type="globus",
+        ingest_index_name=globus_epname,
+        ingest_index_schema="ESGF1.5",
+        log_file=f"{file_base}.log",
+        prov_file=f"{file_base}.json",
+        cmd_line=" ".join(sys.argv),
+    )
+    pathlib.Path(prov.prov_file).write_text(prov.model_dump_json(indent=2))
+
+    logger = (
+        provenance._instance.get_logger(__name__)
+        if provenance._instance is not None else logging.getLogger()
+    )
+
+    project_filter = {"type": "match_all", "field_name": "project", "values": [project.value]}
+    time_filter = {
+        "type": "range",
+        "field_name": "_timestamp",
+        "values": [{"from": format_timestamp(time_from), "to": format_timestamp(time_to)}],
+    }
+
+    # the clients are created once here, not concurrently in the workers
+    sc = GlobusClient.get_client(globus_epname).search_client
+
+    partitions: list[dict[str, Any] | None]
+    if partition_by == "_timestamp":
+        # the partitions replace the overall time range
+        base_filters = [project_filter]
+        partitions = list(timestamp_partitions(time_from, time_to, n_partitions))
+    else:
+        base_filters = [project_filter, time_filter]
+        values = [value for value, _ in facet_values(sc, index_id, base_filters, partition_by)]
+        partitions = list(facet_partitions(partition_by, values)) or [None]
+
+    logger.info(f"export {len(partitions)} partitions by {partition_by} to {out_path}")
+
+    shards = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                in_current_context(_export_partition),
+                shard_no=shard_no,
+                partition=partition,
+                base_filters=base_filters,
+                out_dir=out_path,
+                globus_epname=globus_epname,
+                project=project,
+                index_id=index_id,
+                page_size=page_size,
+            )
+            for shard_no, partition in enumerate(partitions)
+        ]
+        for fut in tqdm(as_completed(futures), total=len(futures), desc="Exporting", unit="shard", ncols=100):
+            shard = fut.result()
+            if shard["expected"] is not None and shard["expected"] != shard["count"]:
+                logger.warning(
+                    f"{shard['shard']} has {shard['count']} documents, but {shard['expected']} expected"
+                )
+            logger.info(f"exported {shard['shard']} with {shard['count']} documents")
+            shards.append(shard)
+
+    shards.sort(key=lambda s: s["shard"])
+    manifest = {
+        "index_id": index_id,
+        "globus_ep": globus_epname,
+        "project": project.value,
+        "partition_by": partition_by,
+        "time_range": {"from": format_timestamp(time_from), "to": format_timestamp(time_to)},
+        "created": datetime.now().isoformat(),
+        "total": sum(s["count"] for s in shards),
+        "shards": shards,
+    }
+    (out_path / ExportConfig.MANIFEST).write_text(json.dumps(manifest, indent=2))
+
+    prov.successful = True
+    pathlib.Path(prov.prov_file).write_text(prov.model_dump_json(indent=2))
+
+    logger.info(f"exported {manifest['total']} documents in {len(shards)} shards")
+    return manifest
+
+
+# the envelope of an ingest document as encoded by the search client
+_INGEST_HEAD = len(json.dumps({
+    GlobusCV.INGEST_TYPE.value: GlobusCV.GMETALIST.value,
+    GlobusCV.INGEST_DATA.value: {GlobusCV.GMETA.value: []},
+}))
+
+
+def _pack_batches(
+    gmeta_list: list[dict[str, Any]],
+    max_size_bytes: int,
+) -> list[list[dict[str, Any]]]:
+    """Pack the gmeta entries into batches by the exact size of the encoded ingest document."""
+    batches = []
+    current_batch: list[dict[str, Any]] = []
+    current_size = _INGEST_HEAD
+
+    for gmeta in gmeta_list:
+        # the separator ", " between the list items
+        gmeta_size = encoded_size(gmeta) + (2 if current_batch else 0)
+        if current_batch and current_size + gmeta_size > max_size_bytes:
+            batches.append(current_batch)
+            current_batch = []
+            current_size = _INGEST_HEAD
+            gmeta_size -= 2
+        current_batch.append(gmeta)
+        current_size += gmeta_size
+
+    if current_batch:
+        batches.append(current_batch)
+
+    return batches
+
+
+def _submit_batch(
+    sc: SearchClient,
+    index_id: str,
+    batch: list[dict[str, Any]],
+) -> dict[str, Any]:
+    """Submit an ingest batch, the 429 is retried by the rate limiter."""
+    response = sc.ingest(
+        index_id,
+        {
+            GlobusCV.INGEST_TYPE.value: GlobusCV.GMETALIST.value,
+            GlobusCV.INGEST_DATA.value: {GlobusCV.GMETA.value: batch},
+        },
+    )
+    if not (response.data["acknowledged"] and response.data["success"]):
+        raise RuntimeError(f"the ingest of {len(batch)} entries is not acknowledged: {response.data}")
+    return response.data
+
+
+def _list_shards(shard_dir: pathlib.Path) -> tuple[list[pathlib.Path], dict[str, str]]:
+    """Get the shards from the manifest (or the directory) with their checksums."""
+    manifest_file = shard_dir / ExportConfig.MANIFEST
+    if manifest_file.exists():
+        manifest = loads(manifest_file.read_text())
+        shards = [shard_dir / s["shard"] for s in manifest["shards"]]
+        return shards, {s["shard"]: s["sha256"] for s in manifest["shards"]}
+
+    shards = sorted(
+        p for p in shard_dir.iterdir()
+        if p.name.endswith((".ndjson", ".ndjson.gz", ".jsonl", ".jsonl.gz"))
+    )
+    return shards, {}
+
+
+def _read_lines(shard: pathlib.Path, skip: int) -> Any:  # noqa ANN401
+    """Yield the line numbers and the gmeta entries of a shard after the first skip lines.
+
+    The line numbers count the blank lines too, as skip does.
+    """
+    opener = gzip.open if shard.suffix == ".gz" else open
+    with opener(shard, "rt", encoding="utf-8") as fh:
+        for line_no, line in enumerate(fh, start=1):
+            if line_no <= skip or not line.strip():
+                continue
+            yield line_no, loads(line)
+
+
+@validate_call
+def metadata_load(
+    *,
+    globus_epname: Literal["test", "test_1", "public", "stage", "backup"],
+    project: ProjectReadOnly | ProjectReadWrite,
+    shard_dir: str | pathlib.Path,
+    fix_dtype: bool = False,
+    max_workers: int = LoadConfig.MAX_WORKERS,
+    max_size_bytes: int = LoadConfig.MAX_INGEST_SIZE,
+    dry_run: bool = False,
+) -> dict[str, int]:
+    """Load the NDJSON shards into a globus index.
+
+    The entries go through the gmeta generator (with the data type fixes if
+    fix_dtype), the entries failing the validation are counted and skipped.
+    A shard not matching the checksum of the manifest is not loaded. The dry
+    run keeps its own provenance and does not move the shard progress.
+    """
+    client_name, index_name = GlobusClient.get_client_index_names(globus_epname, project.value)
+    index_id = str(GlobusClient.globus_clients[client_name].indexes[index_name])
+
+    shard_path = pathlib.Path(shard_dir)
+    shards, checksums = _list_shards(shard_path)
+
+    current_timestr = datetime.now().strftime("%Y-%m-%d")
+    file_base = f"{'LoadDryRun' if dry_run else 'Load'}_{globus_epname}_{project.value}_{shard_path.name}"
+    file_base = f"{file_base}_{current_timestr}"
+
+    prov = provenance(
+        task_name="load",
+        source_index_id=str(shard_path),
+        source_index_type="globus",
+        source_index_name=globus_epname,
+        source_index_schema="ESGF1.5",
+        ingest_index_id=index_id,
+        ingest_index_type="globus",
+        ingest_index_name=globus_epname,
+        ingest_index_schema="ESGF1.5",
+        log_file=f"{file_base}.log",
+        prov_file=f"{file_base}.json",
+        db_file=f"{file_base}.sqlite",
+        cmd_line=" ".join(sys.argv),
+    )
+    pathlib.Path(prov.prov_file).write_text(prov.model_dump_json(indent=2))
+
+    logger = (
+        provenance._instance.get_logger(__name__)
+        if provenance._instance is not None else logging.getLogger()
+    )
+
+    _ = MigrationDB(prov.db_file, False)
+    DBsession = MigrationDB.get_session()
+
+    gm: GmetaGenerator = ModifiedGmetaGenerator(fix_dtype_gmeta) if fix_dtype else StandardGmetaGenerator()
+    sc = GlobusClient.get_client(globus_epname).search_client
+
+    totals = {"n_ingested": 0, "n_skipped": 0, "batches": 0}
+
+    # chunks in the reading order: [shard, end line, last chunk, n_ingested, n_skipped, futures]
+    pending: deque[list[Any]] = deque()
+
+    def _in_flight(futures: list[Future[dict[str, Any]]]) -> list[Future[dict[str, Any]]]:
+        return [f for f in futures + [f for p in pending for f in p[5]] if not f.done()]
+
+    def _advance() -> None:
+        """Move the shard progress over the leading chunks acknowledged completely."""
+        while pending and all(f.done() for f in pending[0][5]):
+            shard_name, lines_end, last, n_ingested, n_skipped, futures = pending.popleft()
+            for fut in futures:
+                fut.result()   # raise the failure of a batch
+            totals["n_ingested"] += n_ingested
+            totals["n_skipped"] += n_skipped
+            if dry_run:
+                continue
+            with DBsession() as session, session.begin():
+                progress = session.query(ShardProgress).filter_by(shard=shard_name).one()
+                progress.lines_done = lines_end
+                progress.n_ingested = progress.n_ingested + n_ingested
+                progress.n_skipped = progress.n_skipped + n_skipped
+                progress.completed = 1 if last else 0
+                progress.updated = datetime.utcnow()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for shard in shards:
+            sha256 = checksums.get(shard.name)
+            if sha256 is not None and _sha256_file(shard) != sha256:
+                logger.error(f"{shard.name} does not match the checksum of the manifest")
+                raise ValueError(f"{shard.name} does not match the checksum of the manifest")
+
+            with DBsession() as session, session.begin():
+                progress = session.query(ShardProgress).filter_by(shard=shard.name).first()
+                if progress is not None and sha256 is not None and progress.sha256 != sha256:
+                    logger.warning(f"{shard.name} is changed since the last load, load it again")
+                    if not dry_run:
+                        session.delete(progress)
+                        session.flush()
+                    progress = None
+                if progress is not None and progress.completed:
+                    logger.info(f"{shard.name} is loaded already")
+                    continue
+                lines_done = progress.lines_done if progress is not None else 0
+                if progress is None and not dry_run:
+                    session.add(ShardProgress(shard=shard.name, sha256=sha256, lines_done=0,
+                                              n_ingested=0, n_skipped=0, completed=0))
+
+            logger.info(f"load {shard.name} from the line {lines_done}")
+
+            entries = _read_lines(shard, lines_done)
+            chunk = list(islice(entries, LoadConfig.CHUNK_LINES))
+            started = bool(chunk)
+            while chunk:
+                next_chunk = list(islice(entries, LoadConfig.CHUNK_LINES))
+                lines_done = chunk[-1][0]
+
+                gmeta_ingest, gmeta_skipped = gm.generate({GlobusCV.GMETA.value: [e for _, e in chunk]})
+                gmeta_list = gmeta_ingest[GlobusCV.INGEST_DATA.value][GlobusCV.GMETA.value]
+                n_skipped = len(gmeta_skipped[GlobusCV.INGEST_DATA.value][GlobusCV.GMETA.value])
+
+                futures = []
+                for batch in _pack_batches(gmeta_list, max_size_bytes):
+                    # bound the batches in flight
+                    while len(in_flight := _in_flight(futures)) >= max_workers:
+                        wait(in_flight, return_when=FIRST_COMPLETED)
+                        _advance()
+                    if dry_run:
+                        done: Future[dict[str, Any]] = Future()
+                        done.set_result({})
+                        futures.append(done)
+                    else:
+                        futures.append(executor.submit(_submit_batch, sc, index_id, batch))
+                    totals["batches"] += 1
+
+                pending.append([shard.name, lines_done, not next_chunk, len(gmeta_list), n_skipped, futures])
+                _advance()
+                chunk = next_chunk
+
+            if not started and not dry_run:
+                # nothing (left) to read in the shard
+                with DBsession() as session, session.begin():
+                    session.query(ShardProgress).filter_by(shard=shard.name).update({"completed": 1})
+
+        while pending:
+            wait(pending[0][5])
+            _advance()
+
+    prov.successful = True
+    pathlib.Path(prov.prov_file).write_text(prov.model_dump_json(indent=2))
+
+    logger.info(f"loaded {len(shards)} shards {totals}")
+    return totals
@@ -0,0 +1,96 @@
+"""Compressed on-disk spool of the converted pages.
+
+A page is written after conversion, keyed by its page number, and linked from
+the corresponding row in the query table. Retries, the review mode and the
+dry-run inspection read the page back instead of querying the source index.
+"""
+import gzip
+import json
+import os
+import pathlib
+from typing import Any
+
+from metadata_migrate_sync.codec import dumpb, loads
+from metadata_migrate_sync.database import MigrationDB, Query
+from metadata_migrate_sync.provenance import provenance
+
+
+class SpoolConfig:
+    """config class for the page spool."""
+
+    DEFAULT_MAX_BYTES = 2 * 1024 * 1024 * 1024  # 2GB
+    COMPRESS_LEVEL = 6
+
+
+class PageSpool:
+    """A size-capped spool of compressed pages with LRU eviction.
+
+    The access time of a page is kept in the file mtime, so the eviction
+    order survives a restart of the program.
+    """
+
+    def __init__(
+        self,
+        spool_dir: str | pathlib.Path,
+        max_bytes: int = SpoolConfig.DEFAULT_MAX_BYTES,
+    ):
+        self.spool_dir = pathlib.Path(spool_dir)
+        self.spool_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+
+    def path(self, pages: int) -> pathlib.Path:
+        """Get the spool file of a page."""
+        return self.spool_dir / f"page_{pages:08d}.json.gz"
+
+    def put(self, pages: int, data: dict[str, Any]) -> str:
+        """Write a page to the spool and evict the least recently used ones."""
+        target = self.path(pages)
+        tmp = target.with_suffix(".tmp")
+        with gzip.open(tmp, "wb", compresslevel=SpoolConfig.COMPRESS_LEVEL) as fh:
+            fh.write(dumpb(data))
+        os.replace(tmp, target)
+
+        self._evict(keep=target)
+        return str(target)
+
+    def get(self, pages: int) -> dict[str, Any] | None:
+        """Read a page from the spool, None if it is not (or no longer) spooled."""
+        target = self.path(pages)
+        try:
+            with gzip.open(target, "rb") as fh:
+                data = loads(fh.read())
+        except (FileNotFoundError, EOFError, gzip.BadGzipFile, json.JSONDecodeError):
+            return None
+
+        # mark as recently used
+        os.utime(target)
+        return data
+
+    def size(self) -> int:
+        """Get the total size of the spooled pages in bytes."""
+        return sum(f.stat().st_size for f in self.spool_dir.glob("page_*.json.gz"))
+
+    def _evict(self, keep: pathlib.Path) -> None:
+        """Remove the least recently used pages until the spool is within the cap."""
+        logger = provenance.get_logger(__name__)
+
+        files = [(f.stat().st_mtime, f.stat().st_size, f) for f in self.spool_dir.glob("page_*.json.gz")]
+        total = sum(size for _, size, _ in files)
+
+        for _, size, f in sorted(files):
+            if total <= self.max_bytes:
+                break
+            if f == keep:
+                continue
+            f.unlink(missing_ok=True)
+            total -= size
+            logger.debug(f"evict the spooled page {f.name}")
+
+    @staticmethod
+    def link(pages: int, spool_file: str | None) -> None:
+        """Link (or unlink with None) the spool file from the query table."""
+        DBsession = MigrationDB.get_session()
+        with DBsession() as session, session.begin():
+            query = session.query(Query).filter_by(pages=pages).first()
+            if query is not None:
+                query.spool_file = spool_file  # type: ignore[assignment]
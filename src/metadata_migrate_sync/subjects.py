@@ -0,0 +1,292 @@
+"""Propagate the deletions of a staged index to its targets.
+
+The sync copies the documents of a _timestamp window, a subject deleted from
+the staged index never reaches the target. The subject snapshot keeps the
+subjects of the staged index synced to a target, in buckets of their
+_timestamp (a month by default), in its own sqlite file.
+
+The sync records the subjects of its pages in the snapshot. A deletion check
+gets the counts of the buckets in the staged index from one date_histogram
+facet, and lists the subjects of the buckets whose count differs from the
+snapshot (plus a few of the least recently checked ones). The subjects of
+the snapshot missing from the listing, and not moved to another bucket, are
+deleted from the target with batch_delete_subjects. So a check costs one
+facet and the listing of the changed buckets, not a compare of the indexes;
+only the first check lists the whole index, to fill the snapshot.
+"""
+import logging
+import pathlib
+from datetime import datetime, timedelta
+from typing import Any
+from uuid import UUID
+
+from globus_sdk import GlobusAPIError, SearchClient
+from sqlalchemy import create_engine, delete, func, select
+from sqlalchemy.dialects.sqlite import insert
+
+from metadata_migrate_sync.database import SnapshotBucket, SnapshotSubject
+from metadata_migrate_sync.delete import batch_delete_subjects
+from metadata_migrate_sync.partition import PartitionConfig, format_timestamp
+from metadata_migrate_sync.provenance import provenance
+
+
+class SnapshotConfig:
+    """config class for the subject snapshot."""
+
+    INTERVAL = "month"      # the date_histogram interval of the buckets
+    KEY_LENGTH = {"year": 4, "month": 7, "day": 10}     # the bucket key, a prefix of the _timestamp
+    HISTOGRAM_START = datetime(2000, 1, 1)
+    CHECK_BUCKETS = 2       # the least recently checked buckets checked with equal counts
+    SCROLL_LIMIT = 1000
+    WRITE_CHUNK = 500
+    MAX_DELETE_FRACTION = 0.1   # refuse to delete more of the snapshot in one check
+
+
+def _timestamp_of(gmeta: dict[str, Any]) -> str | None:
+    """Get the _timestamp of a gmeta entry of a search result."""
+    entries = gmeta.get("entries") or [{}]
+    return entries[0].get("content", {}).get("_timestamp")
+
+
+def bucket_range(bucket: str, interval: str = SnapshotConfig.INTERVAL) -> dict[str, Any]:
+    """The inclusive _timestamp range filter of a bucket."""
+    year, month, day = ([int(p) for p in bucket.split("-")] + [1, 1])[:3]
+    lower = datetime(year, month, day)
+    if interval == "year":
+        upper = lower.replace(year=lower.year + 1)
+    elif interval == "month":
+        upper = (lower + timedelta(days=32)).replace(day=1)
+    else:
+        upper = lower + timedelta(days=1)
+
+    return {
+        "type": "range",
+        "field_name": "_timestamp",
+        "values": [{
+            "from": format_timestamp(lower),
+            "to": format_timestamp(upper - PartitionConfig.RESOLUTION),
+        }],
+    }
+
+
+class SubjectSnapshot:
+    """The subjects of a staged index by their _timestamp bucket.
+
+    It is kept in its own sqlite file per staged index and target, which
+    outlives the per-day sync databases.
+    """
+
+    def __init__(
+        self,
+        db_filename: str | pathlib.Path,
+        source_index: str | UUID,
+        interval: str = SnapshotConfig.INTERVAL,
+    ):
+        self.source_index = str(source_index)
+        self.interval = interval
+        self._key_length = SnapshotConfig.KEY_LENGTH[interval]
+        self._engine = create_engine(f"sqlite:///{db_filename}", echo=False)
+        SnapshotSubject.metadata.create_all(
+            self._engine, tables=[SnapshotSubject.__table__, SnapshotBucket.__table__]
+        )
+
+    def bucket_of(self, timestamp: str) -> str:
+        """Get the bucket of a _timestamp."""
+        return timestamp[:self._key_length]
+
+    def record(self, subjects: dict[str, str]) -> None:
+        """Store the subjects with their _timestamp, moving the updated ones to their bucket."""
+        now = datetime.utcnow()
+        rows = [
+            {"source_index": self.source_index, "subject": subject, "bucket": self.bucket_of(ts),
+             "updated": now}
+            for subject, ts in subjects.items()
+        ]
+        with self._engine.begin() as conn:
+            for i in range(0, len(rows), SnapshotConfig.WRITE_CHUNK):
+                stmt = insert(SnapshotSubject).values(rows[i:i + SnapshotConfig.WRITE_CHUNK])
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=["source_index", "subject"],
+                    set_={"bucket": stmt.excluded.bucket, "updated": stmt.excluded.updated},
+                )
+                conn.execute(stmt)
+
+    def record_page(self, page: dict[str, Any]) -> None:
+        """Store the subjects of a page of search results."""
+        self.record({
+            g["subject"]: ts for g in page.get("gmeta", []) if (ts := _timestamp_of(g)) is not None
+        })
+
+    def remove(self, subjects: list[str]) -> None:
+        """Drop the deleted subjects."""
+        with self._engine.begin() as conn:
+            for i in range(0, len(subjects), SnapshotConfig.WRITE_CHUNK):
+                conn.execute(delete(SnapshotSubject).where(
+                    SnapshotSubject.source_index == self.source_index,
+                    SnapshotSubject.subject.in_(subjects[i:i + SnapshotConfig.WRITE_CHUNK]),
+                ))
+
+    def bucket_counts(self) -> dict[str, int]:
+        """Count the subjects of the buckets."""
+        with self._engine.connect() as conn:
+            return dict(conn.execute(
+                select(SnapshotSubject.bucket, func.count())
+                .where(SnapshotSubject.source_index == self.source_index)
+                .group_by(SnapshotSubject.bucket)
+            ).all())
+
+    def subjects(self, bucket: str) -> set[str]:
+        """Get the subjects of a bucket."""
+        with self._engine.connect() as conn:
+            return set(conn.execute(
+                select(SnapshotSubject.subject).where(
+                    SnapshotSubject.source_index == self.source_index,
+                    SnapshotSubject.bucket == bucket,
+                )
+            ).scalars())
+
+    def mark_checked(self, bucket: str, n_subjects: int) -> None:
+        """Record the count of a listed bucket."""
+        stmt = insert(SnapshotBucket).values(
+            source_index=self.source_index, bucket=bucket, n_subjects=n_subjects, checked=datetime.utcnow()
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["source_index", "bucket"],
+            set_={"n_subjects": stmt.excluded.n_subjects, "checked": stmt.excluded.checked},
+        )
+        with self._engine.begin() as conn:
+            conn.execute(stmt)
+
+    def least_checked(self, buckets: set[str], n: int) -> list[str]:
+        """Get the n buckets checked the longest ago, the never checked ones first."""
+        with self._engine.connect() as conn:
+            checked = dict(conn.execute(
+                select(SnapshotBucket.bucket, SnapshotBucket.checked)
+                .where(SnapshotBucket.source_index == self.source_index)
+            ).all())
+        return sorted(buckets, key=lambda b: (checked.get(b) or datetime.min, b))[:n]
+
+
+def live_bucket_counts(
+    sc: SearchClient,
+    index_id: str | UUID,
+    filters: list[dict[str, Any]],
+    interval: str = SnapshotConfig.INTERVAL,
+) -> dict[str, int]:
+    """Count the documents of the _timestamp buckets with a date_histogram facet."""
+    response = sc.post_search(
+        index_id,
+        {
+            "q": "*",
+            "filters": filters,
+            "limit": 0,
+            "facets": [{
+                "name": "_timestamp",
+                "type": "date_histogram",
+                "field_name": "_timestamp",
+                "date_interval": interval,
+                "histogram_range": {
+                    "low": format_timestamp(SnapshotConfig.HISTOGRAM_START),
+                    "high": format_timestamp(datetime.utcnow() + timedelta(days=1)),
+                },
+            }],
+        },
+    )
+    key_length = SnapshotConfig.KEY_LENGTH[interval]
+    return {
+        b["value"][:key_length]: b["count"]
+        for b in response.data["facet_results"][0]["buckets"]
+        if b["count"] > 0
+    }
+
+
+def list_bucket(
+    sc: SearchClient,
+    index_id: str | UUID,
+    filters: list[dict[str, Any]],
+    bucket: str,
+    interval: str = SnapshotConfig.INTERVAL,
+) -> dict[str, str]:
+    """Get the subjects of a bucket with their _timestamp."""
+    query = {
+        "q": "*",
+        "filters": [*filters, bucket_range(bucket, interval)],
+        "limit": SnapshotConfig.SCROLL_LIMIT,
+    }
+    subjects = {}
+    for batch in sc.paginated.scroll(index_id, query):
+        for g in batch.data["gmeta"]:
+            subjects[g["subject"]] = _timestamp_of(g) or ""
+    return subjects
+
+
+def _moved(sc: SearchClient, index_id: str | UUID, subjects: set[str]) -> dict[str, str]:
+    """Get the _timestamp of the subjects still in the index, moved to another bucket."""
+    moved = {}
+    for subject in sorted(subjects):
+        try:
+            response = sc.get_subject(index_id, subject)
+        except GlobusAPIError as e:
+            if e.http_status == 404:
+                continue
+            raise
+        moved[subject] = _timestamp_of(response.data) or ""
+    return moved
+
+
+def delete_removed_subjects(
+    sc_source: SearchClient,
+    source_index: str | UUID,
+    filters: list[dict[str, Any]],
+    snapshot: SubjectSnapshot,
+    sc_target: SearchClient,
+    target_index: str | UUID,
+    *,
+    dry_run: bool = False,
+    check_buckets: int = SnapshotConfig.CHECK_BUCKETS,
+) -> dict[str, int]:
+    """Delete from the target the subjects of the snapshot removed from the staged index."""
+    logger = (
+        provenance._instance.get_logger(__name__)
+        if provenance._instance is not None else logging.getLogger()
+    )
+
+    live = live_bucket_counts(sc_source, source_index, filters, snapshot.interval)
+    local = snapshot.bucket_counts()
+    all_buckets = live.keys() | local.keys()
+    changed = {b for b in all_buckets if live.get(b, 0) != local.get(b, 0)}
+    buckets = sorted(changed) + snapshot.least_checked(all_buckets - changed, check_buckets)
+    logger.info(f"{len(changed)} of {len(all_buckets)} buckets changed, listing {len(buckets)}")
+
+    removed: set[str] = set()
+    n_listed = 0
+    for bucket in buckets:
+        listed = list_bucket(sc_source, source_index, filters, bucket, snapshot.interval)
+        n_listed += len(listed)
+        missing = snapshot.subjects(bucket) - listed.keys()
+
+        # a subject updated after the window of the last sync is in a newer bucket
+        moved = _moved(sc_source, source_index, missing)
+        snapshot.record({**listed, **moved})
+        snapshot.mark_checked(bucket, len(listed))
+        removed |= missing - moved.keys()
+
+    counts = {"buckets": len(buckets), "listed": n_listed, "removed": len(removed), "deleted": 0}
+    if not removed:
+        return counts
+
+    n_snapshot = sum(local.values())
+    if len(removed) > SnapshotConfig.MAX_DELETE_FRACTION * n_snapshot:
+        logger.error(
+            f"{len(removed)} of the {n_snapshot} subjects are removed from the staged index, "
+            "more than MAX_DELETE_FRACTION, they are not deleted from the target"
+        )
+        return counts
+
+    result = batch_delete_subjects(sc_target, target_index, sorted(removed), dry_run=dry_run)
+    if not dry_run and result["failed_chunks"] == 0:
+        # the subjects of the failed chunks are found again by the next check
+        snapshot.remove(sorted(removed))
+    counts["deleted"] = result["subjects"]
+    logger.info(f"deletion propagation {counts}")
+    return counts
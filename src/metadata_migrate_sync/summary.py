@@ -0,0 +1,218 @@
+"""Summary tables of the migration databases and the report read from them.
+
+prov_collect adds the counts of the files/datasets rows it writes to the
+page_summary and day_summary tables in the same transaction, and the rows
+deleted for a restarted page are taken out of them, so the report reads a
+few rows per day instead of scanning the files and query tables. The
+summaries of a database written before them are rebuilt once (rebuild).
+The report opens the database read-only, it never writes.
+"""
+import pathlib
+import sqlite3
+from collections.abc import Iterable
+from datetime import datetime
+from typing import Any
+
+from sqlalchemy import case, create_engine, func, inspect
+from sqlalchemy.orm import Session, sessionmaker
+
+from metadata_migrate_sync.codec import dumps
+from metadata_migrate_sync.database import (
+    Datasets,
+    DaySummary,
+    Files,
+    FilesCompact,
+    Ingest,
+    PageSummary,
+    Query,
+)
+from metadata_migrate_sync.db_query import iter_skipped
+
+# the count column of the success codes (see ingest._doc_success), n_other for the rest
+SUCCESS_COLUMNS = {0: "n_submitted", -9: "n_skipped", 2: "n_unchanged"}
+COUNT_COLUMNS = ("n_docs", "n_submitted", "n_skipped", "n_unchanged", "n_other", "bytes", "n_ingests")
+
+
+def _counts(rows: Iterable[dict[str, Any]], n_ingests: int) -> dict[str, int]:
+    counts = dict.fromkeys(COUNT_COLUMNS, 0)
+    for row in rows:
+        counts["n_docs"] += 1
+        counts[SUCCESS_COLUMNS.get(row["success"], "n_other")] += 1
+        counts["bytes"] += max(row.get("size") or 0, 0)
+    counts["n_ingests"] = n_ingests
+    return counts
+
+
+def _add_counts(summary: PageSummary | DaySummary, counts: dict[str, int], sign: int = 1) -> None:
+    for column, n in counts.items():
+        setattr(summary, column, (getattr(summary, column) or 0) + sign * n)
+
+
+def _day_summary(session: Session, day: str, at: datetime) -> DaySummary:
+    day_row = session.query(DaySummary).filter(DaySummary.day == day).first()
+    if day_row is None:
+        day_row = DaySummary(
+            day=day, n_pages=0, query_time=0.0, first_at=at, last_at=at, **dict.fromkeys(COUNT_COLUMNS, 0)
+        )
+        session.add(day_row)
+    return day_row
+
+
+def add_page_rows(
+    session: Session,
+    page: Query | None,
+    rows: list[dict[str, Any]],
+    n_ingests: int,
+    at: datetime,
+) -> None:
+    """Add the files/datasets rows and ingest rows of a page to the summaries."""
+    if page is None:
+        return
+
+    counts = _counts(rows, n_ingests)
+    page_row = session.query(PageSummary).filter(PageSummary.pages == page.pages).first()
+    new_page = page_row is None
+    if page_row is None:
+        page_row = PageSummary(
+            pages=page.pages,
+            day=at.date().isoformat(),
+            query_time=float(page.query_time or 0),
+            **dict.fromkeys(COUNT_COLUMNS, 0),
+        )
+        session.add(page_row)
+    _add_counts(page_row, counts)
+
+    day_row = _day_summary(session, page_row.day, at)
+    _add_counts(day_row, counts)
+    if new_page:
+        day_row.n_pages = day_row.n_pages + 1  # type: ignore[assignment]
+        day_row.query_time = day_row.query_time + page_row.query_time  # type: ignore[assignment]
+    day_row.last_at = max(day_row.last_at or at, at)  # type: ignore[assignment]
+
+
+def drop_pages(session: Session, pages: Iterable[int]) -> None:
+    """Take the pages out of the summaries, as their rows are deleted for a restart."""
+    for page_row in session.query(PageSummary).filter(PageSummary.pages.in_(list(pages))).all():
+        day_row = session.query(DaySummary).filter(DaySummary.day == page_row.day).first()
+        if day_row is not None:
+            _add_counts(day_row, {column: getattr(page_row, column) or 0 for column in COUNT_COLUMNS}, -1)
+            day_row.n_pages = day_row.n_pages - 1  # type: ignore[assignment]
+            day_row.query_time = day_row.query_time - (page_row.query_time or 0)  # type: ignore[assignment]
+        session.delete(page_row)
+
+
+def rebuild(session: Session) -> int:
+    """Rebuild the summaries from the files, datasets and ingest tables (one scan)."""
+    session.query(PageSummary).delete(synchronize_session=False)
+    session.query(DaySummary).delete(synchronize_session=False)
+
+    page_counts: dict[int, dict[str, int]] = {}
+    for table in (Files, FilesCompact, Datasets):
+        size = func.max(table.size, 0) if hasattr(table, "size") else 0
+        for pages, success, n, n_bytes in (
+            session.query(table.pages, table.success, func.count(), func.sum(size))
+            .group_by(table.pages, table.success)
+        ):
+            counts = page_counts.setdefault(pages, dict.fromkeys(COUNT_COLUMNS, 0))
+            counts["n_docs"] += n
+            counts[SUCCESS_COLUMNS.get(success, "n_other")] += n
+            counts["bytes"] += n_bytes or 0
+
+    for pages, n in session.query(Ingest.pages, func.count()).group_by(Ingest.pages):
+        page_counts.setdefault(pages, dict.fromkeys(COUNT_COLUMNS, 0))["n_ingests"] = n
+
+    for page in session.query(Query).filter(Query.pages.in_(list(page_counts))):
+        at = page.query_datetime or datetime.utcnow()
+        page_row = PageSummary(
+            pages=page.pages, day=at.date().isoformat(), query_time=float(page.query_time or 0),
+            **dict.fromkeys(COUNT_COLUMNS, 0),
+        )
+        _add_counts(page_row, page_counts[page.pages])
+        session.add(page_row)
+
+        day_row = _day_summary(session, page_row.day, at)
+        _add_counts(day_row, page_counts[page.pages])
+        day_row.n_pages = day_row.n_pages + 1  # type: ignore[assignment]
+        day_row.query_time = day_row.query_time + page_row.query_time  # type: ignore[assignment]
+        day_row.first_at = min(day_row.first_at, at)  # type: ignore[assignment]
+        day_row.last_at = max(day_row.last_at, at)  # type: ignore[assignment]
+
+    return len(page_counts)
+
+
+def read_only_session(db_file: str | pathlib.Path) -> sessionmaker[Session]:
+    """Get the sessions of a database opened read-only, no table is created or altered."""
+    engine = create_engine(
+        "sqlite://", creator=lambda: sqlite3.connect(f"file:{db_file}?mode=ro", uri=True)
+    )
+    return sessionmaker(bind=engine)
+
+
+def needs_rebuild(session: Session) -> bool:
+    """Check if the summaries are missing while the files and datasets tables have rows."""
+    tables = set(inspect(session.get_bind()).get_table_names())
+    if {PageSummary.__tablename__, DaySummary.__tablename__} - tables:
+        return True
+    if session.query(PageSummary.id).first() is not None:
+        return False
+    return any(
+        session.query(t.id).first() is not None
+        for t in (Files, FilesCompact, Datasets) if t.__tablename__ in tables
+    )
+
+
+def report(session: Session) -> dict[str, Any]:
+    """Get the throughput and backlog statistics from the summaries."""
+    days = []
+    totals = dict.fromkeys(("n_pages", "query_time", *COUNT_COLUMNS), 0)
+    for day_row in session.query(DaySummary).order_by(DaySummary.day):
+        for column in totals:
+            totals[column] += getattr(day_row, column) or 0
+        elapsed = max((day_row.last_at - day_row.first_at).total_seconds(), 1.0)
+        days.append({
+            "day": day_row.day,
+            "pages": day_row.n_pages,
+            "docs": day_row.n_docs,
+            "skipped": day_row.n_skipped,
+            "bytes": day_row.bytes,
+            "docs_per_hour": round(day_row.n_docs / elapsed * 3600, 1) if day_row.n_pages > 1 else None,
+            "mean_query_time": round(day_row.query_time / day_row.n_pages, 3) if day_row.n_pages else None,
+        })
+
+    # the tasks, one ingest row per request
+    n_tasks, n_succeeded, n_failed = session.query(
+        func.count(),
+        func.sum(case((Ingest.succeeded == 1, 1), else_=0)),
+        func.sum(case((Ingest.n_failed > 0, 1), else_=0)),
+    ).filter(Ingest.task_id != "skip").one()
+
+    last_page = session.query(Query).order_by(Query.id.desc()).first()
+
+    if totals["n_pages"]:
+        totals["mean_query_time"] = round(totals["query_time"] / totals["n_pages"], 3)
+
+    return {
+        "totals": totals,
+        "tasks": {
+            "submitted": n_tasks,
+            "succeeded": n_succeeded or 0,
+            "failed": n_failed or 0,
+            "pending": n_tasks - (n_succeeded or 0) - (n_failed or 0),
+        },
+        "last_page": {
+            "pages": last_page.pages,
+            "numFound": last_page.numFound,
+            "cursorMark_next": last_page.cursorMark_next,
+        } if last_page is not None else None,
+        "days": days,
+    }
+
+
+def write_skipped(db_file: str | pathlib.Path, meta: str, out_file: str | pathlib.Path) -> int:
+    """Stream the skipped ids to a NDJSON file, one {"id", "date_range"} per line."""
+    n = 0
+    with open(out_file, "w") as fh:
+        for doc_id, date_range in iter_skipped(db_file, meta):
+            fh.write(dumps({"id": doc_id, "date_range": date_range}) + "\n")
+            n += 1
+    return n
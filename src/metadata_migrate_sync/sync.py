@@ -1,22 +1,35 @@
 """syncing the indexes from the staged ones to the public (one way)."""
-import json
 import logging
 import math
 import pathlib
+import sqlite3
 import sys
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Any, Literal
+from functools import partial
+from typing import Any, Literal, TypeVar
 
 from pydantic import validate_call
+from sqlalchemy.orm import Session
 from tqdm import tqdm
 
-from metadata_migrate_sync.database import MigrationDB, Query
+from metadata_migrate_sync.coalesce import CoalesceConfig, IngestCoalescer
+from metadata_migrate_sync.codec import encoded_size
+from metadata_migrate_sync.context import RunContext, current_context, run_in_contexts
+from metadata_migrate_sync.database import Files, FilesCompact, Ingest, MigrationDB, Query, QueryTemplate
+from metadata_migrate_sync.fingerprint import FingerprintStore
 from metadata_migrate_sync.globus import GlobusClient, GlobusCV
 from metadata_migrate_sync.ingest import GlobusIngest, generate_gmeta_list_globus
 from metadata_migrate_sync.project import ProjectReadWrite
 from metadata_migrate_sync.provenance import provenance
 from metadata_migrate_sync.query import GlobusQuery
-from metadata_migrate_sync.util import get_last_value, get_utc_time_from_server
+from metadata_migrate_sync.subjects import SubjectSnapshot, delete_removed_subjects
+from metadata_migrate_sync.summary import drop_pages
+from metadata_migrate_sync.task_tracker import IngestTaskTracker, TrackerConfig
+from metadata_migrate_sync.util import get_last_query, get_last_value, get_utc_time_from_server
+
+T = TypeVar("T")
 
 
 class SyncConfig:
@@ -28,6 +41,14 @@ class SyncConfig:
 
 
 
+class SyncTargetsError(RuntimeError):
+    """The errors of the targets failing a call of a multi-target sync."""
+
+    def __init__(self, errors: dict[str, Exception]):
+        self.errors = errors
+        super().__init__("the targets failed: " + ", ".join(f"{name}: {e!r}" for name, e in errors.items()))
+
+
 @validate_call
 def _process_batches(
     gmeta_list: list[dict[str, Any]],
@@ -39,7 +60,7 @@ def _process_batches(
     current_size = 0
 
     for gmeta in gmeta_list:
-        gmeta_size = len(json.dumps(gmeta))
+        gmeta_size = encoded_size(gmeta)
         if current_batch and (current_size + gmeta_size) > max_size_bytes:
             batches.append(current_batch)
             current_batch = []
@@ -94,13 +115,12 @@ def _setup_time_range_filter(
         logger.info(f"Looking for previous database file {prev_db}")
 
         if pathlib.Path(prev_db).is_file():
-            query_str = get_last_value('query_str', "query", db_path=prev_db)
+            query_json = get_last_query(db_path=prev_db)
 
             cursorMark_next = get_last_value('cursorMark_next', "query", db_path=prev_db)
 
 
-            if query_str:
-                query_json = json.loads(query_str)
+            if query_json:
                 for fi in query_json["filters"]:
                     if (fi.get("type") == 'range' and fi.get("field_name") == "_timestamp"):
                         time_range["restart"] = fi
@@ -130,56 +150,466 @@ def _setup_time_range_filter(
     return time_range
 
 
+def _record_n_batch(session: Session, n_failed: int) -> None:
+    """Set the number of the ingest rows of the last page, a failed submission is missing.
+
+    A bisected batch writes an ingest row per accepted half, so the rows are
+    counted rather than the batches.
+    """
+    prepage = session.query(Query).order_by(Query.id.desc()).first()
+    if prepage is not None:
+        n_rows = session.query(Ingest).filter(Ingest.pages == prepage.pages).count()
+        prepage.n_datasets = n_rows + n_failed  # type: ignore[assignment]
+    else:
+        raise ValueError("cannot find the previous page in the query table")
+
+
+def _record_end_of_query(session: Session) -> None:
+    """Mark the last page as the end of the query."""
+    prepage = session.query(Query).order_by(Query.id.desc()).first()
+    if prepage is not None:
+        prepage.cursorMark_next = "end of this query"  # type: ignore[assignment]
+    else:
+        raise ValueError("cannot find the previous page in the query table")
+
+
+def _last_page_state(db_file: str | pathlib.Path) -> tuple[Any, ...] | None:
+    """Get the last page of a sync database with its number of ingest rows, None if it is new."""
+    if not pathlib.Path(db_file).is_file():
+        return None
+
+    with sqlite3.connect(f"file:{db_file}?mode=ro", uri=True) as conn:
+        page = conn.execute(
+            'SELECT "pages", "cursorMark", "cursorMark_next", "n_datasets", "n_failed" '
+            'FROM "query" ORDER BY "id" DESC LIMIT 1'
+        ).fetchone()
+        if page is None:
+            return None
+        n_ingests = conn.execute('SELECT COUNT(*) FROM "ingest" WHERE "pages" = ?', (page[0],)).fetchone()
+    return (*page, n_ingests[0])
+
+
+def _page_template(query: Any) -> dict[str, Any] | None:  # noqa ANN401
+    """Get the template of a page, to mirror the page in the databases of the other targets."""
+    if query is None or query.template_id is None:
+        return None
+    with MigrationDB.get_session()() as session:
+        template = session.get(QueryTemplate, query.template_id)
+        return {
+            "digest": template.digest,
+            "filters_digest": template.filters_digest,
+            "template": template.template,
+        }
+
+
+def _mirror_page(query: Any, template: dict[str, Any] | None) -> Query:  # noqa ANN401
+    """Get the page of the query table of the first target in the database of this one.
+
+    A page already in the database is a restarted page: its files and ingest
+    rows are deleted and its row is updated from the first target, as
+    get_offset_marker and prov_collect do for the first target.
+    """
+    MigrationDB.barrier()
+    with MigrationDB.get_session()() as session:
+        mirrored = session.query(Query).filter(Query.pages == query.pages).first()
+        if mirrored is not None:
+            for table in (Ingest, Files, FilesCompact):
+                session.query(table).filter(table.pages == query.pages).delete(synchronize_session=False)
+            drop_pages(session, [query.pages])
+            for column in ("query_time", "n_failed", "cursorMark_next", "numFound"):
+                setattr(mirrored, column, getattr(query, column))
+        else:
+            mirrored = Query(**{
+                c.name: getattr(query, c.name)
+                for c in Query.__table__.columns
+                if c.name not in ("id", "template_id")
+            })
+            if template is not None:
+                mirrored.template = (
+                    session.query(QueryTemplate).filter(QueryTemplate.digest == template["digest"]).first()
+                    or QueryTemplate(**template)
+                )
+            session.add(mirrored)
+        session.commit()
+        return session.query(Query).filter(Query.pages == query.pages).first()
+
+
+class _SyncTarget:
+    """A target of the sync with its own provenance, database and ingestion.
+
+    The first target runs in the context of the caller, the others in their
+    own RunContext, so every target keeps its provenance and its query and
+    ingest rows (the pages read for the first target are mirrored), and
+    resumes from its own database.
+    """
+
+    def __init__(
+        self,
+        *,
+        source_epname: str,
+        target_epname: str,
+        project: ProjectReadWrite,
+        production: bool,
+        skip_unchanged: bool,
+        track_tasks: bool,
+        max_pending: int,
+        coalesce: bool,
+        max_age: float,
+        propagate_deletes: bool,
+        ctx: RunContext | None = None,
+    ) -> None:
+        self.name = target_epname
+        self.primary = ctx is None
+        self.n_rejected = 0
+        self._ctx = ctx if ctx is not None else current_context()
+        self._owns_ctx = ctx is not None
+        self.run(
+            self._setup,
+            source_epname=source_epname,
+            project=project,
+            production=production,
+            skip_unchanged=skip_unchanged,
+            track_tasks=track_tasks,
+            max_pending=max_pending,
+            coalesce=coalesce,
+            max_age=max_age,
+            propagate_deletes=propagate_deletes,
+        )
+
+    def run(self, fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:  # noqa ANN401
+        """Call a function in the context of the target."""
+        if self._ctx is None:
+            return fn(*args, **kwargs)
+        return self._ctx.run(fn, *args, **kwargs)
+
+    def _setup(
+        self,
+        *,
+        source_epname: str,
+        project: ProjectReadWrite,
+        production: bool,
+        skip_unchanged: bool,
+        track_tasks: bool,
+        max_pending: int,
+        coalesce: bool,
+        max_age: float,
+        propagate_deletes: bool,
+    ) -> None:
+        target_epname = self.name
+        target_client, target_index = GlobusClient.get_client_index_names(target_epname, target_epname)
+
+        source_client, source_index = GlobusClient.get_client_index_names(source_epname, project.value)
+
+        self.path_db_base = f"synchronization_{source_epname}_{target_epname}_{project.value}"
+        file_base = f"{self.path_db_base}_{datetime.now().strftime('%Y-%m-%d')}"
+
+        prov = provenance(
+            task_name="sync",
+            source_index_id=GlobusClient.globus_clients[source_client].indexes[source_index],
+            source_index_type="globus",
+            source_index_name=source_epname,
+            source_index_schema="ESGF1.5",
+            ingest_index_id=GlobusClient.globus_clients[target_client].indexes[target_index],
+            ingest_index_type="globus",
+            ingest_index_name=target_epname,
+            ingest_index_schema="ESGF1.5",
+            log_file=f"{file_base}.log",
+            prov_file=f"{file_base}.json",
+            db_file=f"{file_base}.sqlite",
+            type_query="mixed (datasets and files)",
+            cmd_line=" ".join(sys.argv),
+        )
+        self.prov = prov
+
+        pathlib.Path(prov.prov_file).write_text(prov.model_dump_json(indent=2))
+
+        logger = (
+            provenance._instance.get_logger(__name__)
+            if provenance._instance is not None else logging.getLogger()
+        )
+        self.logger = logger
+
+        logger.info(f"set up the provenance and save it to {prov.prov_file}")
+        logger.info(f"log file is at {prov.log_file}")
+
+        # database
+        _ = MigrationDB(prov.db_file, True)
+        MigrationDB.start_writer()
+        logger.info(f"initialized the sqlite database at {prov.db_file}")
+
+        # ingest
+        self.ig = GlobusIngest(
+            end_point=prov.ingest_index_id,
+            ep_name=target_epname,
+            project=project,
+        )
+
+        if skip_unchanged:
+            fingerprint_db = f"fingerprints_{target_epname}_{project.value}.sqlite"
+            self.ig.use_fingerprints(FingerprintStore(fingerprint_db, prov.ingest_index_id))
+            logger.info(f"skip the unchanged documents with the fingerprints in {fingerprint_db}")
+            if not track_tasks:
+                # the fingerprints are stored when the tracker finds their task succeeded
+                logger.info("skip_unchanged tracks the ingest tasks")
+
+        self.tracker = None
+        if track_tasks or skip_unchanged:
+            self.tracker = IngestTaskTracker(
+                GlobusClient.get_client(target_epname).search_client, max_pending=max_pending
+            ).start()
+            self.ig.use_tracker(self.tracker)
+            logger.info(f"track the ingest tasks, pause above {max_pending} pending tasks")
+
+        self.coalescer = None
+        if coalesce:
+            self.coalescer = IngestCoalescer(
+                self.ig,
+                SyncConfig.PROD_MAX_INGEST_SIZE if production else SyncConfig.TEST_MAX_INGEST_SIZE,
+                max_age=max_age,
+            )
+            logger.info("coalesce the ingest entries of consecutive pages")
+
+        self.snapshot = None
+        if propagate_deletes:
+            snapshot_db = f"subjects_{source_epname}_{target_epname}_{project.value}.sqlite"
+            self.snapshot = SubjectSnapshot(snapshot_db, prov.source_index_id)
+            logger.info(f"keep the synced subjects in {snapshot_db} to propagate the deletions")
+
+    def ingest_page(
+        self,
+        current_query: Any,  # noqa ANN401
+        template: dict[str, Any] | None,
+        page: dict[str, Any],
+        gmeta_list: list[dict[str, Any]],
+        skipped: list[dict[str, Any]],
+        batches: list[list[dict[str, Any]]],
+    ) -> None:
+        """Ingest the batches of a page and record them, in the context of the target."""
+        logger = self.logger
+        ig = self.ig
+        if not self.primary and current_query is not None:
+            current_query = _mirror_page(current_query, template)
+
+        if self.snapshot is not None:
+            self.snapshot.record_page(page)
+
+        # record the skipped entries
+        if len(skipped) > 0:
+
+            ig._response_data = {}
+            ig._submitted = True
+
+            ig.prov_collect(
+                [g[GlobusCV.CONTENT.value] for g in skipped],
+                review=False,
+                current_query=current_query,
+                metatype="files",
+                batch_num=0,
+            )
+
+            logger.info(f"Skipped {len(skipped)}")
+
+        if self.coalescer is not None:
+            # the page is closed after its entries are ingested, with the next pages
+            self.coalescer.add(current_query, gmeta_list)
+            return
+
+        if len(gmeta_list) == 0:
+            return  #possble entire page skipped, but next page, there are no-skipped docs
+
+        n_failed = 0
+        for n_batch, batch in enumerate(batches, start=1):
+
+            ig._submitted = False
+            logger.debug(f"Processing batch {n_batch}")
+
+            ig.ingest(
+                {
+                    GlobusCV.INGEST_TYPE.value: GlobusCV.GMETALIST.value,
+                    GlobusCV.INGEST_DATA.value: {
+                        GlobusCV.GMETA.value: batch,
+                    }
+                }
+            )
+            self.n_rejected += len(ig._rejected)
+            if not ig._submitted:
+                n_failed += 1
+
+            ig.prov_collect(
+                [g[GlobusCV.CONTENT.value] for g in batch],
+                review=False,
+                current_query=current_query,
+                metatype="files",
+                batch_num=n_batch,
+            )
+
+        # update the n_batch in the query table, after the ingest rows of the page
+        MigrationDB.write(partial(_record_n_batch, n_failed=n_failed))
+
+    def end_step(self) -> None:
+        """Close the coalesced pages and mark the end of the query."""
+        if self.coalescer is not None:
+            self.coalescer.close()
+
+        # set the marker of the end of this query/search
+        MigrationDB.write(_record_end_of_query)
+
+    def finish(self, source_epname: str, base_filters: list[dict[str, Any]], n_pages: int) -> None:
+        """Propagate the deletions, stop the writer and the tracker and save the provenance."""
+        logger = self.logger
+        prov = self.prov
+
+        if self.coalescer is not None:
+            self.n_rejected += self.coalescer.n_rejected
+            logger.info(f"Coalesced ingest requests: {self.coalescer.n_flushed}")
+
+        if self.snapshot is not None:
+            counts = delete_removed_subjects(
+                GlobusClient.get_client(source_epname).search_client,
+                prov.source_index_id,
+                base_filters,
+                self.snapshot,
+                GlobusClient.get_client(self.name).search_client,
+                prov.ingest_index_id,
+            )
+            logger.info(f"Deleted subjects removed from the source: {counts}")
+
+        MigrationDB.stop_writer()
+        if self.tracker is not None:
+            self.tracker.stop()
+
+        current_timestr = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        logger.info(f"Synchronization stop at {current_timestr}")
+        logger.info(f"Processed total pages: {n_pages}")
+        if self.n_rejected > 0:
+            logger.warning(f"Rejected documents: {self.n_rejected}, see the error column of the files table")
+
+        prov.successful = True
+        pathlib.Path(prov.prov_file).write_text(prov.model_dump_json(indent=2))
+
+    def close(self) -> None:
+        """Release the context of a target after the first one."""
+        if self._owns_ctx and self._ctx is not None:
+            self._ctx.close()
+
+
+def _fan_out(
+    executor: ThreadPoolExecutor | None,
+    targets: list[_SyncTarget],
+    method: str,
+    *args: Any,  # noqa ANN401
+) -> None:
+    """Call a method of every target in its context, concurrently with several targets.
+
+    Every target finishes the call before a SyncTargetsError with the errors
+    of all the failed targets is raised, so the targets stop at the same page
+    and the failed ones resume from it.
+    """
+    if executor is None:
+        for target in targets:
+            target.run(getattr(target, method), *args)
+        return
+
+    futures = {target.name: executor.submit(target.run, getattr(target, method), *args) for target in targets}
+    errors = {}
+    for target in targets:
+        try:
+            futures[target.name].result()
+        except Exception as e:  # noqa BLE001
+            target.logger.error(f"the target {target.name} failed: {e!r}")
+            errors[target.name] = e
+    if errors:
+        raise SyncTargetsError(errors) from next(iter(errors.values()))
+
+
 @validate_call
 def metadata_sync(
     *,
     source_epname: Literal["stage", "test", "test_1"],
-    target_epname: Literal["public", "test", "test_1", "backup"],
+    target_epname: (
+        Literal["public", "test", "test_1", "backup"] | list[Literal["public", "test", "test_1", "backup"]]
+    ),
     project: ProjectReadWrite,
     production: bool,
     sync_freq: int | None = None,
     start_time: datetime | None = None,
+    skip_unchanged: bool = False,
+    track_tasks: bool = False,
+    max_pending: int = TrackerConfig.MAX_PENDING,
+    coalesce: bool = False,
+    max_age: float = CoalesceConfig.MAX_AGE,
+    propagate_deletes: bool = False,
 ) -> None:
-    """Sync the metadata between two Globus Indexes."""
-    target_client, target_index = GlobusClient.get_client_index_names(target_epname, target_epname)
-
-    source_client, source_index = GlobusClient.get_client_index_names(source_epname, project.value)
-
-    current_timestr = datetime.now().strftime("%Y-%m-%d")
-
-    file_base = f"synchronization_{source_epname}_{target_epname}_{project.value}_{current_timestr}"
-
-    prov = provenance(
-        task_name="sync",
-        source_index_id=GlobusClient.globus_clients[source_client].indexes[source_index],
-        source_index_type="globus",
-        source_index_name=source_epname,
-        source_index_schema="ESGF1.5",
-        ingest_index_id=GlobusClient.globus_clients[target_client].indexes[target_index],
-        ingest_index_type="globus",
-        ingest_index_name=target_epname,
-        ingest_index_schema="ESGF1.5",
-        log_file=f"{file_base}.log",
-        prov_file=f"{file_base}.json",
-        db_file=f"{file_base}.sqlite",
-        type_query="mixed (datasets and files)",
-        cmd_line=" ".join(sys.argv),
-    )
-
+    """Sync the metadata between two Globus Indexes.
+
+    With skip_unchanged, the documents whose content fingerprint is unchanged
+    in the target are not ingested again (e.g. the overlapping restart window).
+    It tracks the ingest tasks, as the fingerprints of a task are stored once
+    the task succeeded.
+    With track_tasks, the ingest tasks are checked during the run and the
+    ingestion pauses while too many tasks are pending in the target.
+    With coalesce, the entries of consecutive pages fill the ingest requests
+    up to the size limit, or for max_age seconds (see the coalesce module).
+    With propagate_deletes, the subjects of the synced pages are kept in a
+    subject snapshot, and the subjects removed from the source are deleted
+    from the target after the sync (see the subjects module).
+
+    With several targets, every page is read and validated once and its
+    batches are ingested into the targets concurrently. Every target keeps
+    its own provenance and database, a target whose database is not at the
+    same page (or time window) as the first one is synced on its own after.
+    """
+    target_names = [target_epname] if isinstance(target_epname, str) else list(dict.fromkeys(target_epname))
+    settings = {
+        "source_epname": source_epname,
+        "project": project,
+        "production": production,
+        "skip_unchanged": skip_unchanged,
+        "track_tasks": track_tasks,
+        "max_pending": max_pending,
+        "coalesce": coalesce,
+        "max_age": max_age,
+        "propagate_deletes": propagate_deletes,
+    }
 
-    pathlib.Path(prov.prov_file).write_text(prov.model_dump_json(indent=2))
+    primary = _SyncTarget(target_epname=target_names[0], **settings)
+    prov = primary.prov
+    logger = primary.logger
 
-    logger = (
-        provenance._instance.get_logger(__name__)
-        if provenance._instance is not None else logging.getLogger()
+    time_range_filter = _setup_time_range_filter(
+        primary.path_db_base,
+        production,
+        sync_freq,
+        start_time,
+        logger,
     )
 
-    logger.info(f"set up the provenance and save it to {prov.prov_file}")
-    logger.info(f"log file is at {prov.log_file}")
+    # the other targets at the same page and time window share the reads of the first one
+    targets = [primary]
+    lagging = []
+    for name in target_names[1:]:
+        path_db_base = f"synchronization_{source_epname}_{name}_{project.value}"
+        today = datetime.now().strftime("%Y-%m-%d")
+        same_page = (
+            _last_page_state(f"{path_db_base}_{today}.sqlite")
+            == _last_page_state(prov.db_file)
+        )
+        same_window = True
+        if production and sync_freq is not None:
+            try:
+                window = _setup_time_range_filter(path_db_base, production, sync_freq, start_time, logger)
+            except ValueError:
+                window = {"restart": None, "normal": None}
+            same_window = window["restart"] == time_range_filter["restart"] and (
+                window["normal"] is not None
+                and window["normal"]["values"][0]["from"] == time_range_filter["normal"]["values"][0]["from"]
+            )
 
-    # database
-    _ = MigrationDB(prov.db_file, True)
-    logger.info(f"initialized the sqlite database at {prov.db_file}")
+        if same_page and same_window:
+            targets.append(_SyncTarget(target_epname=name, ctx=RunContext(name), **settings))
+        else:
+            logger.warning(f"the target {name} is not at the page of {target_names[0]}, it is synced alone")
+            lagging.append(name)
 
     # query generator
     # for e3sm, "values": ["CMIP6-E3SM-Ext"] if project.value == "e3sm" else [project.value]
@@ -197,17 +627,7 @@ def metadata_sync(
         "limit": 10,
         "offset": 0,
     }
-
-
-    path_db_base = f"synchronization_{source_epname}_{target_epname}_{project.value}"   #_{time_str}.sqlite"
-    time_range_filter = _setup_time_range_filter(
-        path_db_base,
-        production,
-        sync_freq,
-        start_time,
-        logger,
-    )
-
+    base_filters = list(search_dict["filters"])
 
     if production:
         search_dict["limit"] = 1000
@@ -226,140 +646,116 @@ def metadata_sync(
         paginator="scroll",
     )
 
-    # ingest
-    ig = GlobusIngest(
-        end_point=prov.ingest_index_id,
-        ep_name=target_epname,
-        project=project,
-    )
-
-    logger.info("instantiate query and ingest classes")
-
-
-    for step in ["restart", "normal"]:
-
-        if step == "restart" and (not production or time_range_filter[step] is None):
-            continue
-
-        search_dict["filters"].append(time_range_filter[step])
+    logger.info(f"instantiate query and ingest classes for {[t.name for t in targets]}")
 
-        # set the initial cursormark
-        gq.get_offset_marker(review=False)
-        logger.info("find the offset at " + str(gq.query["offset"]))
+    max_ingest_size = SyncConfig.PROD_MAX_INGEST_SIZE if production else SyncConfig.TEST_MAX_INGEST_SIZE
 
-        current_timestr = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        logger.info("query-ingest start at " + current_timestr + f"step: {step} {time_range_filter[step]}")
-
-        with tqdm(
-            gq.run(),
-            desc="Processing",
-            unit="page",
-            colour="blue",
-            bar_format="{l_bar}{bar:50}{r_bar}",
-            ncols=100,
-            ascii=" ░▒▓█",
-        ) as pbar:
-
-            for page_num, page in enumerate(pbar):
-                if not pbar.total and hasattr(gq, "_numFound") and gq._numFound:
-                    pbar.total = math.ceil(gq._numFound / gq.query["limit"])
-
-                if len(page) == 0:
-                    logger.info(f"Empty page {page_num}. stop sync!")
-                    break
-
-                gmeta_ingest, gmeta_ingest_skipped = generate_gmeta_list_globus(page)
-
-                gq._n_batch = 0
-                # record the skipped entries
-                if len(
-                       gmeta_ingest_skipped[GlobusCV.INGEST_DATA.value][GlobusCV.GMETA.value]
-                   ) > 0:
-
-                    ig._response_data = {}
-                    ig._submitted = True
-
-                    ig.prov_collect(
-                        [
-                            g[GlobusCV.CONTENT.value]
-                            for g in gmeta_ingest_skipped[GlobusCV.INGEST_DATA.value][GlobusCV.GMETA.value]
-                        ],
-                        review=False,
-                        current_query=gq._current_query,
-                        metatype="files",
-                        batch_num=gq._n_batch,
-                    )
-
-                    skip_size = len(gmeta_ingest_skipped[GlobusCV.INGEST_DATA.value][GlobusCV.GMETA.value])
-                    logger.info(f"Skipped {skip_size}")
+    page_num = 0
+    executor = ThreadPoolExecutor(max_workers=len(targets)) if len(targets) > 1 else None
+    try:
+        for step in ["restart", "normal"]:
 
-                if len(gmeta_ingest[GlobusCV.INGEST_DATA.value][GlobusCV.GMETA.value]) == 0:
-                    #break
-                    continue  #possble entire page skipped, but next page, there are no-skipped docs
+            if step == "restart" and (not production or time_range_filter[step] is None):
+                continue
 
-                gmeta_list = gmeta_ingest[GlobusCV.INGEST_DATA.value][GlobusCV.GMETA.value]
+            search_dict["filters"].append(time_range_filter[step])
 
-                if production:
-                    batches = _process_batches(gmeta_list, SyncConfig.PROD_MAX_INGEST_SIZE)
-                else:
-                    batches = _process_batches(gmeta_list, SyncConfig.TEST_MAX_INGEST_SIZE)
+            # set the initial cursormark
+            gq.get_offset_marker(review=False)
+            logger.info("find the offset at " + str(gq.query["offset"]))
 
-                for n_batch, batch in enumerate(batches, start=1):
-
-                    gq._n_batch = n_batch
-                    ig._submitted = False
-                    logger.debug(f"Processing batch {gq._n_batch}")
+            current_timestr = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            logger.info(
+                "query-ingest start at " + current_timestr + f"step: {step} {time_range_filter[step]}"
+            )
 
-                    ig.ingest(
-                        {
-                            GlobusCV.INGEST_TYPE.value: GlobusCV.GMETALIST.value,
-                            GlobusCV.INGEST_DATA.value: {
-                                GlobusCV.GMETA.value: batch,
-                            }
-                        }
-                    )
+            with tqdm(
+                gq.run(),
+                desc="Processing",
+                unit="page",
+                colour="blue",
+                bar_format="{l_bar}{bar:50}{r_bar}",
+                ncols=100,
+                ascii=" ░▒▓█",
+            ) as pbar:
+
+                for page_num, page in enumerate(pbar):
+                    if not pbar.total and hasattr(gq, "_num_found") and gq._num_found:
+                        pbar.total = math.ceil(gq._num_found / gq.query["limit"])
+
+                    if len(page) == 0:
+                        logger.info(f"Empty page {page_num}. stop sync!")
+                        break
 
-                    ig.prov_collect(
-                        [g[GlobusCV.CONTENT.value] for g in batch],
-                        review=False,
-                        current_query=gq._current_query,
-                        metatype="files",
-                        batch_num=gq._n_batch,
+                    # the page is validated and split in batches once for all the targets
+                    gmeta_ingest, gmeta_ingest_skipped = generate_gmeta_list_globus(page)
+                    gmeta_list = gmeta_ingest[GlobusCV.INGEST_DATA.value][GlobusCV.GMETA.value]
+                    skipped = gmeta_ingest_skipped[GlobusCV.INGEST_DATA.value][GlobusCV.GMETA.value]
+                    batches = []
+                    if gmeta_list and not coalesce:
+                        batches = _process_batches(gmeta_list, max_ingest_size)
+
+                    template = _page_template(gq._current_query) if len(targets) > 1 else None
+                    _fan_out(
+                        executor, targets, "ingest_page",
+                        gq._current_query, template, page, gmeta_list, skipped, batches,
                     )
+                    gq._n_batch = 0
 
-                # update the n_batch in the query table
-                DBsession = MigrationDB.get_session()
-                with DBsession() as session, session.begin():
-                    prepage = session.query(Query).order_by(Query.id.desc()).first()
-                    if prepage is not None:
-                        prepage.n_datasets = gq._n_batch  # type: ignore[assignment]
-                        gq._n_batch = 0
-                    else:
-                        raise ValueError("cannot find the previous page in the query table")
-
-                logger.info(f"Batch {gq._n_batch} ingested successfully for the page{page_num}")
+                    logger.info(f"{len(batches)} batches ingested successfully for the page{page_num}")
 
-                if not production and (maxpage is not None) and page_num > maxpage:
-                    break
+                    if not production and (maxpage is not None) and page_num > maxpage:
+                        break
 
-        # set the marker of the end of this query/search
-        DBsession = MigrationDB.get_session()
-        with DBsession() as session, session.begin():
-            prepage = session.query(Query).order_by(Query.id.desc()).first()
-            if prepage is not None:
-                prepage.cursorMark_next = "end of this query"  # type: ignore[assignment]
-            else:
-                raise ValueError("cannot find the previous page in the query table")
+            _fan_out(executor, targets, "end_step")
 
+        _fan_out(executor, targets, "finish", source_epname, base_filters, page_num)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        for target in targets:
+            target.close()
 
-    current_timestr = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    logger.info(f"Synchronization stop at {current_timestr}")
-    logger.info(f"Processed total pages: {page_num}")
+    # the lagging targets are synced before the logs are closed
+    for name in lagging:
+        ctx = RunContext(name)
+        try:
+            ctx.run(metadata_sync, **{**settings, "target_epname": name, "sync_freq": sync_freq,
+                                      "start_time": start_time})
+        finally:
+            ctx.close()
 
     # clean up
     logging.shutdown()
-    prov.successful = True
-    pathlib.Path(prov.prov_file).write_text(prov.model_dump_json(indent=2))
+
+
+def metadata_sync_many(
+    *,
+    source_epname: Literal["stage", "test", "test_1"],
+    target_epname: (
+        Literal["public", "test", "test_1", "backup"] | list[Literal["public", "test", "test_1", "backup"]]
+    ),
+    projects: list[ProjectReadWrite],
+    max_workers: int | None = None,
+    **kwargs: Any,
+) -> dict[str, Any]:
+    """Sync several projects concurrently in one process.
+
+    Every project runs metadata_sync in its own RunContext (database,
+    provenance and log file), sharing the globus clients and one thread pool.
+    The result of a project is None or the exception that stopped it.
+    """
+    jobs = {
+        project.value: partial(
+            metadata_sync,
+            source_epname=source_epname,
+            target_epname=target_epname,
+            project=project,
+            **kwargs,
+        )
+        for project in projects
+    }
+    return run_in_contexts(jobs, max_workers=max_workers)
 
 
 if __name__ == "__main__":
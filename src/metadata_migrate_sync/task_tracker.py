@@ -0,0 +1,192 @@
+"""Track the ingest tasks of a run while it is running.
+
+The tracker polls the submitted ingest tasks in a background thread and
+marks Ingest.succeeded (or counts Ingest.n_failed) as the tasks finish, so
+the separate check_task --update pass is not needed. With too many tasks
+pending in the target index, wait_for_capacity blocks the submission of new
+ingests, which pauses the query pipeline until the index catches up.
+"""
+import logging
+import threading
+import time
+from collections.abc import Callable
+from typing import Any
+
+from globus_sdk import GlobusAPIError, SearchClient
+
+from metadata_migrate_sync.context import in_current_context
+from metadata_migrate_sync.database import Ingest, MigrationDB
+from metadata_migrate_sync.provenance import provenance
+
+
+class TrackerConfig:
+    """config class for the ingest task tracker."""
+
+    MAX_PENDING = 20        # pause the submission above this many pending tasks
+    POLL_INTERVAL = 5.0     # seconds between the polls of the pending tasks
+    DRAIN_TIMEOUT = 600.0   # seconds to wait for the pending tasks at the end
+
+
+class IngestTaskTracker:
+    """Poll the pending ingest tasks and update the ingest table."""
+
+    def __init__(
+        self,
+        sc: SearchClient,
+        *,
+        max_pending: int = TrackerConfig.MAX_PENDING,
+        poll_interval: float = TrackerConfig.POLL_INTERVAL,
+    ) -> None:
+        self.sc = sc
+        self.max_pending = max_pending
+        self.poll_interval = poll_interval
+
+        self.n_succeeded = 0
+        self.n_failed = 0
+
+        self._pending: dict[str, float] = {}
+        self._on_failed: list[Callable[[str], None]] = []
+        self._on_succeeded: list[Callable[[str], None]] = []
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+        self._logger = (
+            provenance._instance.get_logger(__name__)
+            if provenance._instance is not None else logging.getLogger()
+        )
+
+    @property
+    def n_pending(self) -> int:
+        """The number of the tasks not finished yet."""
+        with self._cond:
+            return len(self._pending)
+
+    def start(self) -> "IngestTaskTracker":
+        """Start the poller thread."""
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=in_current_context(self._poll_loop), name="ingest-task-tracker", daemon=True
+            )
+            self._thread.start()
+        return self
+
+    def track(self, task_id: str | None) -> None:
+        """Track a submitted task, after its row is in the ingest table."""
+        if not task_id or task_id == "skip":
+            return
+        with self._cond:
+            self._pending[task_id] = time.monotonic()
+
+    def on_failed(self, callback: Callable[[str], None]) -> None:
+        """Call back with the id of every task found failed (e.g. to drop its fingerprints)."""
+        if callback not in self._on_failed:
+            self._on_failed.append(callback)
+
+    def on_succeeded(self, callback: Callable[[str], None]) -> None:
+        """Call back with the id of every task found succeeded (e.g. to store its fingerprints)."""
+        if callback not in self._on_succeeded:
+            self._on_succeeded.append(callback)
+
+    def wait_for_capacity(self) -> None:
+        """Block while the pending tasks are above the threshold."""
+        with self._cond:
+            if len(self._pending) < self.max_pending:
+                return
+            self._logger.info(f"{len(self._pending)} ingest tasks pending, pause the submission")
+            start = time.monotonic()
+            while len(self._pending) >= self.max_pending and not self._stop.is_set():
+                self._cond.wait(timeout=self.poll_interval)
+            self._logger.info(f"resume the submission after {time.monotonic() - start:.1f}s")
+
+    def stop(self, drain: bool = True, timeout: float = TrackerConfig.DRAIN_TIMEOUT) -> None:
+        """Stop the poller, waiting for the pending tasks first with drain."""
+        if drain:
+            deadline = time.monotonic() + timeout
+            with self._cond:
+                while self._pending and time.monotonic() < deadline and self._thread is not None:
+                    self._cond.wait(timeout=self.poll_interval)
+
+        self._stop.set()
+        with self._cond:
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        if self._pending:
+            self._logger.warning(
+                f"{len(self._pending)} ingest tasks still pending, check them with check_task --update"
+            )
+        self._logger.info(f"ingest tasks succeeded: {self.n_succeeded}, failed: {self.n_failed}")
+
+    def __enter__(self) -> "IngestTaskTracker":
+        """Start the poller thread."""
+        return self.start()
+
+    def __exit__(self, exc_type: Any, exc: Any, tb: Any) -> None:  # noqa ANN401
+        """Stop the poller, without waiting for the tasks when the run is aborted."""
+        self.stop(drain=exc_type is None)
+
+    def poll(self) -> None:
+        """Check every pending task once and record the finished ones."""
+        with self._cond:
+            task_ids = list(self._pending)
+
+        finished: dict[str, str] = {}
+        for task_id in task_ids:
+            if self._stop.is_set():
+                break
+            try:
+                state = self.sc.get_task(task_id).data["state"]
+            except GlobusAPIError as e:
+                self._logger.error(f"Error checking the task {task_id}: {e}")
+                continue
+            if state in ("SUCCESS", "FAILED"):
+                finished[task_id] = state
+
+        if not finished:
+            return
+
+        self._record(finished)
+
+        for task_id, state in finished.items():
+            callbacks = self._on_succeeded if state == "SUCCESS" else self._on_failed
+            for callback in callbacks:
+                try:
+                    callback(task_id)
+                except Exception as e:  # noqa BLE001
+                    self._logger.error(f"the callback of the {state} task {task_id} failed: {e}")
+
+        with self._cond:
+            for task_id in finished:
+                self._pending.pop(task_id, None)
+            self._cond.notify_all()
+
+    def _record(self, finished: dict[str, str]) -> None:
+        """Update the ingest rows of the finished tasks."""
+        # the rows of the tracked tasks may be queued in the provenance writer
+        MigrationDB.barrier()
+        DBsession = MigrationDB.get_session()
+        with DBsession() as session, session.begin():
+            for task_id, state in finished.items():
+                for item in session.query(Ingest).filter_by(task_id=task_id):
+                    if state == "SUCCESS":
+                        item.succeeded = 1  # type: ignore[assignment]
+                    else:
+                        item.n_failed = (item.n_failed or 0) + 1  # type: ignore[assignment]
+
+                if state == "SUCCESS":
+                    self.n_succeeded += 1
+                else:
+                    self.n_failed += 1
+                    self._logger.warning(f"the ingest task {task_id} failed")
+
+    def _poll_loop(self) -> None:
+        while not self._stop.is_set():
+            try:
+                self.poll()
+            except Exception as e:  # noqa BLE001
+                # a failed poll is retried, the run is not stopped by the tracker
+                self._logger.error(f"the ingest task poll failed: {e}")
+            self._stop.wait(self.poll_interval)
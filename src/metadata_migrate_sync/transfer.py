@@ -1,9 +1,34 @@
+"""Transfer the data files between the globus endpoints."""
+import hashlib
+import logging
 import pathlib
-import subprocess
-from typing import Literal
+import time
+from collections.abc import Generator, Iterable, Iterator
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor
+from concurrent.futures import wait as wait_futures
+from datetime import datetime
+from itertools import islice
+from typing import Any, Literal
 
 import ijson
-from globus_sdk import TransferClient
+from globus_sdk import MISSING, GlobusAPIError, TransferClient, TransferData
+
+from metadata_migrate_sync.codec import dumps
+from metadata_migrate_sync.context import in_current_context
+from metadata_migrate_sync.database import MigrationDB, Transfer
+from metadata_migrate_sync.globus import GlobusClient
+from metadata_migrate_sync.provenance import provenance
+
+
+class TransferConfig:
+    """config class for the transfer."""
+
+    PER_PAGE = 5000         # files in one transfer task
+    MAX_IN_FLIGHT = 20      # unfinished transfer tasks of the run
+    MAX_WORKERS = 4         # concurrent submit_transfer calls
+    POLL_INTERVAL = 30.0    # seconds between the polls of the active tasks
+    UNFINISHED = ("ACTIVE", "INACTIVE")
+
 
 globus_endpoints = {
     "llnl": "1889ea03-25ad-4f9f-8110-1ce8833a9d7e",
@@ -59,6 +84,22 @@ def paginate_json(file_path: str, page: int, per_page: int, json_type:str):
         'current_page': page
     }
 
+def iter_json_paths(file_path: str | pathlib.Path, json_type: str) -> Generator[str, None, None]:
+    """Stream the file paths of the json file in one pass (see paginate_json)."""
+    with open(file_path, 'rb') as f:
+        if json_type == "RootDict":
+            for _, data in ijson.kvitems(f, ''):
+                for item in data.get('details', []):
+                    yield item["local_path"]
+        elif json_type == "RootArray":
+            for item in ijson.items(f, 'item'):
+                yield item["source_path"]
+        elif json_type == "RootList":
+            yield from ijson.items(f, 'item')
+        else:
+            raise ValueError(f"unknown json type {json_type}")
+
+
 def _activate_ep(tc: TransferClient) -> None:
 
     for ep in globus_endpoints.values():
@@ -70,105 +111,215 @@ def _activate_ep(tc: TransferClient) -> None:
             print(f"Successfully activate {ep}")
 
 
-def _build_globus_transfer(
-    source_ep: str,
-    target_ep: str,
-    file_name: str,
-    label: str,
-    options: str,
-    batch_n: int,
-) -> list[str]:
-
-    return [
-        'globus', 'transfer',
-        f'{source_ep}',
-        f'{target_ep}',
-        '--batch',
-        f'{file_name}',
-        '--label',
-        f'{label}-{batch_n}',
-        f'{options}',
-    ]
-
-
-def _run(batch_n: int, cmd: list[str]) -> None:
-
-    print("Transferring files...")
-    try:
-        # Using shell=True for input redirection
-        result = subprocess.run(' '.join(cmd), shell=True, check=True)
-        print(f"Batch {batch_n} submitted successfully")
-    except subprocess.CalledProcessError as e:
-        print(f"Error transferring batch {batch_n}: {e}")
-    #-finally:
-    #-    # Clean up batch file
-    #-    os.remove('globus_batch.txt')
-
-def globus_transfer(
-    source_epname: Literal["llnl", "anl"],
-    target_epname: Literal["ornl", "ornl-test"],
-    path_list: list[str],
-    batch_n: int,
-    transfer_label: str = "cmip6",
-) -> None:
-
-    #-tc: TransferClient = GlobusClient.get_transfer_client()
-
-    #-_activate_ep(tc)
 
-    source_ep = globus_endpoints[source_epname]
-    target_ep = globus_endpoints[target_epname]
 
-    #-td = TransferData(tc,
-    #-    source_ep,
-    #-    target_ep,
-    #-    encrypt_data = True,
-    #-    verify_checksum = True,
-    #-    preserve_timestamp = True,
-    #-    fail_on_quota_errors = True,
-    #-)
+def _chunked(paths: Iterable[str], size: int) -> Iterator[list[str]]:
+    it = iter(paths)
+    while chunk := list(islice(it, size)):
+        yield chunk
 
-    src_path = pathlib.Path(globus_path_prefix[source_epname])
-    dst_path = pathlib.Path(globus_path_prefix[target_epname])
 
-    print (src_path, source_epname)
-    print (dst_path, target_epname)
+def iter_json_batches(
+    file_path: str | pathlib.Path,
+    json_type: str,
+    per_page: int = TransferConfig.PER_PAGE,
+) -> Iterator[list[str]]:
+    """Stream the file paths of the json file in batches of per_page."""
+    return _chunked(iter_json_paths(file_path, json_type), per_page)
 
 
-    batch_name = f"{transfer_label}_batch_{batch_n}.txt"
+def _batch_digest(paths: list[str]) -> str:
+    return hashlib.sha256("\n".join(paths).encode("utf-8")).hexdigest()
 
-    with open(batch_name, 'w') as batch_file:
-        for rpath in path_list:
 
-            relative_path = rpath.removeprefix("/")
-            src_file = src_path / relative_path
-            dst_file = dst_path / relative_path
+def build_transfer_data(
+    source_epname: str,
+    target_epname: str,
+    path_list: list[str],
+    label: str,
+    submission_id: str | None = None,
+) -> TransferData:
+    """Build the transfer document of a batch of files.
 
-            #td.add_item(str(src_path), str(dst_path))
-            batch_file.write(f"{src_file}  {dst_file}\n")
+    The paths are relative to the data roots of the two endpoints, and the
+    options are the ones of the former `globus transfer --skip-source-errors -s exists`.
+    """
+    src_path = pathlib.Path(globus_path_prefix[source_epname])
+    dst_path = pathlib.Path(globus_path_prefix[target_epname])
 
-    cmd = _build_globus_transfer(
-        source_ep,
-        target_ep,
-        batch_name,
-        transfer_label,
-        '--skip-source-errors -s exists',
-        batch_n
+    td = TransferData(
+        globus_endpoints[source_epname],
+        globus_endpoints[target_epname],
+        label=label,
+        submission_id=submission_id if submission_id is not None else MISSING,
+        sync_level="exists",
+        skip_source_errors=True,
+        verify_checksum=True,
+        preserve_timestamp=True,
+        fail_on_quota_errors=True,
     )
+    for rpath in path_list:
+        relative_path = rpath.removeprefix("/")
+        td.add_item(str(src_path / relative_path), str(dst_path / relative_path))
+    return td
 
-    print (cmd)
-
-    # need to add a dryrun in future XXXX
-    # _run(batch_n, cmd)
 
-    #-try:
-    #-    task = tc.submit_transfer(td)
+def _submit_batch(tc: TransferClient, td: TransferData) -> dict[str, Any]:
+    return tc.submit_transfer(td).data
 
-    #-    print (task.get("status"))
-    #-    print (task.get("task_id"))
-    #-    print (task.get("request_time"))
 
-    #-except Exception as e:
-
-    #-    print("some error")
-    #-    print(f"{source_epname}->{target_epname} - exception: {e}")
+def globus_transfer(
+    source_epname: Literal["llnl", "anl"],
+    target_epname: Literal["ornl", "ornl-test", "ornl-misc"],
+    batches: Iterable[list[str]],
+    transfer_label: str = "cmip6",
+    *,
+    first_batch: int = 1,
+    max_in_flight: int = TransferConfig.MAX_IN_FLIGHT,
+    max_workers: int = TransferConfig.MAX_WORKERS,
+    poll_interval: float = TransferConfig.POLL_INTERVAL,
+    wait: bool = False,
+    dry_run: bool = False,
+    tc: TransferClient | None = None,
+) -> dict[str, int]:
+    """Submit the batches of files as transfer tasks, a few at a time.
+
+    At most max_workers submissions run concurrently, and a new batch waits
+    while max_in_flight tasks of the run are active (or inactive) in globus.
+    Every batch is recorded in the transfer table by the digest of its paths,
+    with the task id and the last seen status, so a rerun skips the submitted
+    batches and reuses the submission id of an unconfirmed one, which globus
+    accepts once only.
+    """
+    logger = (
+        provenance._instance.get_logger(__name__)
+        if provenance._instance is not None else logging.getLogger()
+    )
+    DBsession = MigrationDB.get_session()
+
+    if tc is None and not dry_run:
+        tc = GlobusClient.get_transfer_client()
+
+    with DBsession() as session:
+        done = {digest for (digest,) in session.query(Transfer.digest).filter_by(submitted=1)}
+        submission_ids = {
+            digest: sid for digest, sid in
+            session.query(Transfer.digest, Transfer.submission_id).filter_by(submitted=0)
+        }
+        # the unfinished tasks of a previous run count against the cap
+        active = {
+            task_id for (task_id,) in session.query(Transfer.task_id).filter(
+                Transfer.submitted == 1, Transfer.status.in_(TransferConfig.UNFINISHED),
+            )
+        }
+
+    counts = {"batches": 0, "files": 0, "skipped_batches": 0, "failed_batches": 0,
+              "succeeded_tasks": 0, "failed_tasks": 0}
+
+    def _record(batch_n: int, digest: str, paths: list[str], **values: Any) -> None:  # noqa ANN401
+        with DBsession() as session, session.begin():
+            session.merge(Transfer(
+                id=session.query(Transfer.id).filter_by(digest=digest).scalar(),
+                batch_n=batch_n,
+                digest=digest,
+                label=transfer_label,
+                source_ep=globus_endpoints[source_epname],
+                target_ep=globus_endpoints[target_epname],
+                n_files=len(paths),
+                first_path=paths[0],
+                last_path=paths[-1],
+                updated=datetime.utcnow(),
+                **values,
+            ))
+
+    def _poll() -> None:
+        finished: dict[str, str] = {}
+        for task_id in list(active):
+            try:
+                status = tc.get_task(task_id)["status"]
+            except GlobusAPIError as e:
+                logger.error(f"Error checking the transfer task {task_id}: {e}")
+                continue
+            if status not in TransferConfig.UNFINISHED:
+                finished[task_id] = status
+
+        if not finished:
+            return
+        with DBsession() as session, session.begin():
+            for task_id, status in finished.items():
+                for item in session.query(Transfer).filter_by(task_id=task_id):
+                    item.status = status  # type: ignore[assignment]
+                    item.updated = datetime.utcnow()  # type: ignore[assignment]
+                active.discard(task_id)
+                if status == "SUCCEEDED":
+                    counts["succeeded_tasks"] += 1
+                else:
+                    counts["failed_tasks"] += 1
+                    logger.warning(f"the transfer task {task_id} {status}")
+
+    def _collect(futures: dict[Future[dict[str, Any]], tuple[int, str, list[str]]], block: bool) -> None:
+        finished, _ = wait_futures(futures, return_when=FIRST_COMPLETED) if block else (
+            [f for f in futures if f.done()], None)
+        for fut in finished:
+            batch_n, digest, paths = futures.pop(fut)
+            try:
+                data = fut.result()
+            except GlobusAPIError as e:
+                logger.error(f"failed to submit the batch {batch_n}: {e}")
+                counts["failed_batches"] += 1
+                continue
+            counts["batches"] += 1
+            counts["files"] += len(paths)
+            active.add(data["task_id"])
+            _record(
+                batch_n, digest, paths,
+                task_id=data["task_id"],
+                status="ACTIVE",
+                transfer_response=dumps(data),
+                submitted=1,
+            )
+            logger.info(f"submitted the batch {batch_n} ({len(paths)}) task {data['task_id']}")
+
+    def _wait_for_capacity(futures: dict[Future[dict[str, Any]], tuple[int, str, list[str]]]) -> None:
+        while len(futures) + len(active) >= max_in_flight:
+            if futures:
+                _collect(futures, block=True)
+                continue
+            _poll()
+            if len(active) >= max_in_flight:
+                time.sleep(poll_interval)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures: dict[Future[dict[str, Any]], tuple[int, str, list[str]]] = {}
+        for batch_n, paths in enumerate(batches, start=first_batch):
+            digest = _batch_digest(paths)
+            if digest in done:
+                counts["skipped_batches"] += 1
+                continue
+
+            label = f"{transfer_label}-{batch_n}"
+            if dry_run:
+                print (batch_n, len(paths), paths[0], paths[-1])
+                continue
+
+            _wait_for_capacity(futures)
+
+            submission_id = submission_ids.get(digest) or tc.get_submission_id()["value"]
+            # recorded before the submission, a rerun submits the batch with the same id
+            _record(batch_n, digest, paths, submission_id=submission_id, submitted=0)
+
+            td = build_transfer_data(source_epname, target_epname, paths, label, submission_id)
+            futures[executor.submit(in_current_context(_submit_batch), tc, td)] = (batch_n, digest, paths)
+            _collect(futures, block=False)
+
+        while futures:
+            _collect(futures, block=True)
+
+    if not dry_run:
+        _poll()
+        while wait and active:
+            time.sleep(poll_interval)
+            _poll()
+
+    logger.info(f"transfer submission finished {counts}, {len(active)} tasks still active")
+    return counts
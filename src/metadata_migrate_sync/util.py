@@ -5,11 +5,14 @@ import os
 import sqlite3
 import sys
 from pathlib import Path
+from typing import Any
 
 import ntplib
 import requests
 from ntplib import NTPException
 
+from metadata_migrate_sync.codec import loads
+
 
 def create_lock(lockfile_path: str) -> int:
     """Create a lock file to prevent multiple instances."""
@@ -105,3 +108,27 @@ def get_last_value(column_name:str, table_name:str, db_path:str='database.db') -
         cursor.execute(safe_query)
         result = cursor.fetchone()
         return result[0] if result else None
+
+
+def get_last_query(db_path:str='database.db') -> dict[str, Any] | None:
+    """Get the query of the last page, over its template if any (older databases have none)."""
+    with sqlite3.connect(f"file:{db_path}?mode=ro", uri=True) as conn:
+        cursor = conn.cursor()
+
+        columns = {row[1] for row in cursor.execute('PRAGMA table_info("query")')}
+        if "template_id" in columns:
+            cursor.execute(
+                'SELECT "query"."query_str", "query_template"."template" FROM "query" '
+                'LEFT JOIN "query_template" ON "query"."template_id" = "query_template"."id" '
+                'ORDER BY "query"."id" DESC LIMIT 1'
+            )
+        else:
+            cursor.execute('SELECT "query_str", NULL FROM "query" ORDER BY id DESC LIMIT 1')
+        result = cursor.fetchone()
+
+    if not result or not result[0]:
+        return None
+    query = loads(result[0])
+    if result[1] is not None:
+        query = {**loads(result[1]), **query}
+    return query
@@ -0,0 +1,401 @@
+"""A lease-based work queue to run a migration on several hosts.
+
+A coordinator splits a migration into work units, the _timestamp slices of
+a migrate or the page ranges of the json ids of a replica or a revise, and
+puts them into a sqlite queue on a shared file system. Every worker leases
+the next pending unit, renews the lease with a heartbeat while it runs the
+pipeline of the unit, and marks it done (or failed) at the end. A unit whose
+lease expires, the worker died or lost the file system, is leased again by
+another worker, up to MAX_ATTEMPTS times.
+
+The pipeline of a unit runs in its own RunContext and writes its database
+in the directory of the worker, <work_dir>/<worker>/unit-<id>, so a worker
+restarted with the same name resumes the unit from its database. After the
+run, merge_databases copies the pages of the done units into one database.
+
+The throughput grows with the workers until the source or target rate
+limits are reached, the rate limiters are per process. There should be a
+few units per worker, the slices of the busy years take longer.
+"""
+import logging
+import os
+import pathlib
+import socket
+import threading
+from collections.abc import Callable
+from datetime import datetime, timedelta
+from typing import Any
+
+import ijson
+from sqlalchemy import create_engine, func, select, text, update
+from sqlalchemy.orm import Session
+
+from metadata_migrate_sync import summary
+from metadata_migrate_sync.codec import dumps, loads
+from metadata_migrate_sync.context import RunContext
+from metadata_migrate_sync.database import (
+    FILES_VIEW,
+    Base,
+    Datasets,
+    Files,
+    FilesCompact,
+    Ingest,
+    Query,
+    WorkUnit,
+)
+from metadata_migrate_sync.provenance import provenance
+
+
+class WorkQueueConfig:
+    """config class for the work queue."""
+
+    LEASE_SECONDS = 300     # a unit without heartbeat for so long is leased again
+    HEARTBEAT_SECONDS = 60
+    MAX_ATTEMPTS = 5
+    BUSY_TIMEOUT = 60       # seconds to wait for the sqlite lock of the other workers
+    SOLR_DATETIME = "%Y-%m-%dT%H:%M:%SZ"
+    CUTOFF = datetime(2025, 3, 16)      # the _timestamp ranges of metadata_migrate
+    FINAL_END = datetime(2025, 4, 28)
+
+
+def default_worker_name() -> str:
+    """The host name and the process id."""
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def timestamp_slices(start: datetime, end: datetime, n_units: int, open_start: bool = False) -> list[str]:
+    """Split [start, end] into the solr _timestamp fq of n_units slices.
+
+    The slices are half-open ([a TO b}) except the last one, so they are
+    disjoint, and with open_start the first one takes everything before start.
+    """
+    step = (end - start) / n_units
+    bounds = [(start + step * i).strftime(WorkQueueConfig.SOLR_DATETIME) for i in range(n_units)]
+    bounds.append(end.strftime(WorkQueueConfig.SOLR_DATETIME))
+    if open_start:
+        bounds[0] = "*"
+
+    return [
+        f"_timestamp:[{bounds[i]} TO {bounds[i + 1]}" + ("]" if i == n_units - 1 else "}")
+        for i in range(n_units)
+    ]
+
+
+def id_chunks(json_file: str | pathlib.Path, per_page: int, pages_per_unit: int) -> list[tuple[int, int]]:
+    """Split the ids of a json list into the (page_start, page_end) ranges of the units."""
+    with open(json_file, "rb") as f:
+        n_ids = sum(1 for _ in ijson.items(f, "item"))
+    n_pages = -(-n_ids // per_page)
+    return [
+        (page_start, min(page_start + pages_per_unit, n_pages))
+        for page_start in range(0, n_pages, pages_per_unit)
+    ]
+
+
+class WorkQueue:
+    """The units of a distributed migration in a sqlite file.
+
+    The lease is one UPDATE ... RETURNING statement, sqlite runs the writes
+    one at a time, so two workers never lease the same unit.
+    """
+
+    def __init__(
+        self,
+        db_filename: str | pathlib.Path,
+        lease_seconds: float = WorkQueueConfig.LEASE_SECONDS,
+        max_attempts: int = WorkQueueConfig.MAX_ATTEMPTS,
+    ):
+        self.db_filename = str(db_filename)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._engine = create_engine(
+            f"sqlite:///{db_filename}",
+            echo=False,
+            connect_args={"timeout": WorkQueueConfig.BUSY_TIMEOUT},
+        )
+        WorkUnit.metadata.create_all(self._engine, tables=[WorkUnit.__table__])
+
+    def put(self, kind: str, specs: list[tuple[str, dict[str, Any]]]) -> int:
+        """Add the (label, pipeline arguments) units of a kind."""
+        now = datetime.utcnow()
+        with self._engine.begin() as conn:
+            conn.execute(WorkUnit.__table__.insert(), [
+                {"kind": kind, "label": label, "spec": dumps(spec), "status": "pending",
+                 "attempts": 0, "updated": now}
+                for label, spec in specs
+            ])
+        return len(specs)
+
+    def lease(self, worker: str) -> dict[str, Any] | None:
+        """Lease the next pending unit, or one with an expired lease."""
+        now = datetime.utcnow()
+        with self._engine.begin() as conn:
+            # the expired units out of attempts are not leased again
+            conn.execute(
+                update(WorkUnit)
+                .where(
+                    WorkUnit.status == "leased",
+                    WorkUnit.lease_expires < now,
+                    WorkUnit.attempts >= self.max_attempts,
+                )
+                .values(status="failed", result=dumps({"error": "the lease expired"}), updated=now)
+            )
+
+            next_unit = (
+                select(WorkUnit.id)
+                .where(
+                    (WorkUnit.status == "pending")
+                    | ((WorkUnit.status == "leased") & (WorkUnit.lease_expires < now))
+                )
+                .order_by(WorkUnit.id)
+                .limit(1)
+                .scalar_subquery()
+            )
+            row = conn.execute(
+                update(WorkUnit)
+                .where(WorkUnit.id == next_unit)
+                .values(
+                    status="leased",
+                    worker=worker,
+                    lease_expires=now + timedelta(seconds=self.lease_seconds),
+                    heartbeat_at=now,
+                    attempts=WorkUnit.attempts + 1,
+                    updated=now,
+                )
+                .returning(WorkUnit.id, WorkUnit.kind, WorkUnit.label, WorkUnit.spec, WorkUnit.attempts)
+            ).first()
+
+        if row is None:
+            return None
+        return {"id": row.id, "kind": row.kind, "label": row.label, "spec": loads(row.spec),
+                "attempts": row.attempts}
+
+    def _update_lease(self, unit_id: int, worker: str, **values: Any) -> bool:  # noqa ANN401
+        """Update a unit still leased by the worker, False if the lease is lost."""
+        with self._engine.begin() as conn:
+            result = conn.execute(
+                update(WorkUnit)
+                .where(WorkUnit.id == unit_id, WorkUnit.worker == worker, WorkUnit.status == "leased")
+                .values(updated=datetime.utcnow(), **values)
+            )
+        return result.rowcount == 1
+
+    def heartbeat(self, unit_id: int, worker: str) -> bool:
+        """Renew the lease of a unit."""
+        now = datetime.utcnow()
+        return self._update_lease(
+            unit_id, worker, heartbeat_at=now, lease_expires=now + timedelta(seconds=self.lease_seconds)
+        )
+
+    def complete(self, unit_id: int, worker: str, result: dict[str, Any]) -> bool:
+        """Mark a unit done, the result of a worker which lost the lease is dropped."""
+        return self._update_lease(unit_id, worker, status="done", result=dumps(result))
+
+    def fail(self, unit_id: int, worker: str, error: str) -> bool:
+        """Put a failed unit back in the queue, or mark it failed after MAX_ATTEMPTS."""
+        with self._engine.connect() as conn:
+            attempts = conn.execute(select(WorkUnit.attempts).where(WorkUnit.id == unit_id)).scalar()
+        status = "failed" if (attempts or 0) >= self.max_attempts else "pending"
+        return self._update_lease(unit_id, worker, status=status, result=dumps({"error": error}))
+
+    def counts(self) -> dict[str, int]:
+        """Count the units by status."""
+        with self._engine.connect() as conn:
+            return dict(conn.execute(select(WorkUnit.status, func.count()).group_by(WorkUnit.status)).all())
+
+    def done_units(self) -> list[dict[str, Any]]:
+        """The done units with their results, in the order of the units."""
+        with self._engine.connect() as conn:
+            rows = conn.execute(
+                select(WorkUnit.id, WorkUnit.label, WorkUnit.result)
+                .where(WorkUnit.status == "done")
+                .order_by(WorkUnit.id)
+            ).all()
+        return [{"id": row.id, "label": row.label, **loads(row.result)} for row in rows]
+
+    def close(self) -> None:
+        """Release the database engine."""
+        self._engine.dispose()
+
+
+class _Heartbeat:
+    """Renew the lease of a unit in a thread while the unit runs."""
+
+    def __init__(self, queue: WorkQueue, unit_id: int, worker: str, interval: float) -> None:
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, args=(queue, unit_id, worker, interval), daemon=True
+        )
+
+    def _run(self, queue: WorkQueue, unit_id: int, worker: str, interval: float) -> None:
+        while not self._stop.wait(interval):
+            if not queue.heartbeat(unit_id, worker):
+                self.lost = True
+                return
+
+    def __enter__(self) -> "_Heartbeat":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        self._stop.set()
+        self._thread.join()
+
+
+def run_unit(unit: dict[str, Any], unit_dir: pathlib.Path) -> dict[str, Any]:
+    """Run the pipeline of a unit, its files go to the unit directory."""
+    # the pipelines import the globus clients, only the workers need them
+    from metadata_migrate_sync.migrate import metadata_migrate
+    from metadata_migrate_sync.project import ProjectReadOnly, ProjectReadWrite
+    from metadata_migrate_sync.replica import metadata_replica
+    from metadata_migrate_sync.revise import metadata_revise
+
+    spec = dict(unit["spec"])
+    project = spec.pop("project")
+    read_only = project in {p.value for p in ProjectReadOnly}
+    spec["project"] = ProjectReadOnly(project) if read_only else ProjectReadWrite(project)
+
+    if unit["kind"] == "migrate":
+        metadata_migrate(**spec, output_path=str(unit_dir))
+    elif unit["kind"] == "replica":
+        metadata_replica(**spec, output_path=str(unit_dir))
+    elif unit["kind"] == "revise":
+        metadata_revise(**spec, output_path=str(unit_dir))
+    else:
+        raise ValueError(f"unknown kind of work unit: {unit['kind']}")
+
+    # replica and revise stop at a failed page without raising
+    prov = provenance._instance
+    if prov is None or not prov.successful:
+        raise RuntimeError(f"the {unit['kind']} pipeline of the unit {unit['id']} did not finish")
+    return {"db_file": prov.db_file}
+
+
+def run_worker(
+    queue: WorkQueue,
+    work_dir: str | pathlib.Path,
+    worker: str | None = None,
+    runner: Callable[[dict[str, Any], pathlib.Path], dict[str, Any]] = run_unit,
+    max_units: int | None = None,
+    heartbeat: float = WorkQueueConfig.HEARTBEAT_SECONDS,
+) -> int:
+    """Lease and run the units until the queue is empty, get the number of the done units."""
+    worker = worker or default_worker_name()
+    logger = logging.getLogger(__name__)
+
+    n_done = 0
+    while max_units is None or n_done < max_units:
+        unit = queue.lease(worker)
+        if unit is None:
+            break
+
+        unit_dir = pathlib.Path(work_dir) / worker / f"unit-{unit['id']}"
+        unit_dir.mkdir(parents=True, exist_ok=True)
+        logger.info(f"{worker} runs the unit {unit['id']} ({unit['label']}), attempt {unit['attempts']}")
+
+        ctx = RunContext(f"{worker}-unit-{unit['id']}")
+        try:
+            with _Heartbeat(queue, unit["id"], worker, heartbeat) as beat, ctx.bind():
+                result = runner(unit, unit_dir)
+        except (Exception, SystemExit) as e:  # noqa BLE001
+            # the pipelines stop with sys.exit on the bad settings
+            logger.warning(f"the unit {unit['id']} failed: {e!r}")
+            queue.fail(unit["id"], worker, repr(e))
+            continue
+        finally:
+            ctx.close()
+
+        if beat.lost or not queue.complete(unit["id"], worker, result):
+            logger.warning(f"{worker} lost the lease of the unit {unit['id']}, its result is dropped")
+            continue
+        n_done += 1
+
+    return n_done
+
+
+# the tables copied by merge_databases, with the pages shifted
+_PAGE_TABLES = (Query, Ingest, Files, Datasets)
+
+
+def _columns(table: Any, skip: tuple[str, ...] = ()) -> list[str]:  # noqa ANN401
+    return [c.name for c in table.__table__.columns if c.name != "id" and c.name not in skip]
+
+
+def merge_databases(units: list[dict[str, Any]], out_file: str | pathlib.Path) -> int:
+    """Copy the pages of the unit databases into a new database, get the number of pages.
+
+    The pages of a unit follow the ones of the previous units, the unit label
+    is kept as the partition of its pages, and the summaries are rebuilt.
+    """
+    if pathlib.Path(out_file).exists():
+        raise FileExistsError(f"{out_file} exists, the units are merged into a new database")
+
+    engine = create_engine(f"sqlite:///{out_file}", echo=False)
+    Base.metadata.create_all(engine)
+
+    n_pages = 0
+    with engine.connect() as conn:
+        conn.execute(text(FILES_VIEW))
+        conn.commit()
+        for unit in units:
+            if not unit.get("db_file") or not pathlib.Path(unit["db_file"]).is_file():
+                continue
+
+            conn.execute(text("ATTACH DATABASE :db_file AS unit"), {"db_file": str(unit["db_file"])})
+            offset = conn.execute(text("SELECT COALESCE(MAX(pages), 0) FROM main.query")).scalar()
+
+            conn.execute(text(
+                'INSERT OR IGNORE INTO main."index" (index_id, index_name, index_type) '
+                'SELECT index_id, index_name, index_type FROM unit."index"'
+            ))
+            conn.execute(text(
+                "INSERT OR IGNORE INTO main.query_template (digest, filters_digest, template) "
+                "SELECT digest, filters_digest, template FROM unit.query_template"
+            ))
+
+            for table in _PAGE_TABLES:
+                skip = ("pages", "template_id", "partition") if table is Query else ("pages",)
+                columns = ", ".join(f'"{c}"' for c in _columns(table, skip))
+                extra, values = "", ""
+                if table is Query:
+                    extra = ", template_id, partition"
+                    values = (
+                        ", (SELECT m.id FROM main.query_template m JOIN unit.query_template u"
+                        " ON m.digest = u.digest WHERE u.id = t.template_id)"
+                        ", COALESCE(t.partition, :label)"
+                    )
+                conn.execute(
+                    text(
+                        f"INSERT INTO main.{table.__tablename__} ({columns}, pages{extra}) "  # noqa: S608
+                        f"SELECT {columns}, t.pages + :offset{values} FROM unit.{table.__tablename__} t"
+                    ),
+                    {"offset": offset, "label": unit.get("label")},
+                )
+
+            # the compact files rows refer to the index table by its row id
+            skip = ("pages", "source_key", "target_key")
+            columns = ", ".join(f'"{c}"' for c in _columns(FilesCompact, skip))
+            key = (
+                "(SELECT m.id FROM main.\"index\" m JOIN unit.\"index\" u"
+                " ON m.index_id = u.index_id WHERE u.id = t.{0})"
+            )
+            conn.execute(
+                text(
+                    f"INSERT INTO main.files_compact ({columns}, pages, source_key, target_key) "  # noqa: S608
+                    f"SELECT {columns}, t.pages + :offset, {key.format('source_key')}, "
+                    f"{key.format('target_key')} FROM unit.files_compact t"
+                ),
+                {"offset": offset},
+            )
+
+            n_pages += conn.execute(text("SELECT COUNT(*) FROM unit.query")).scalar() or 0
+            # a unit is merged in one transaction, sqlite detaches outside of it
+            conn.commit()
+            conn.execute(text("DETACH DATABASE unit"))
+
+    with Session(engine) as session:
+        summary.rebuild(session)
+        session.commit()
+    engine.dispose()
+    return n_pages
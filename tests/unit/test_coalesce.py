@@ -0,0 +1,113 @@
+import pytest
+
+from metadata_migrate_sync.coalesce import IngestCoalescer
+from metadata_migrate_sync.codec import dumps, encoded_size
+from metadata_migrate_sync.context import RunContext
+from metadata_migrate_sync.database import Ingest, MigrationDB, Query
+from metadata_migrate_sync.ingest import GlobusIngest
+from metadata_migrate_sync.project import ProjectReadOnly
+from metadata_migrate_sync.query import GlobusQuery
+
+INDEX_ID = "52eff156-6141-4fde-9efe-c08c92f3a706"
+FILTERS = [{"type": "match_all", "field_name": "project", "values": ["CMIP6"]}]
+
+
+def _gmeta(subject):
+    return {"id": "file", "subject": subject, "visible_to": ["public"], "content": {"id": subject}}
+
+
+@pytest.fixture
+def coalesce_db(tmp_path, mocker, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    mocker.patch("metadata_migrate_sync.ingest.provenance")
+    mocker.patch("metadata_migrate_sync.query.provenance")
+
+    ctx = RunContext("coalesce")
+    with ctx.bind():
+        MigrationDB(tmp_path / "coalesce.sqlite", False)
+        with MigrationDB.get_session()() as session, session.begin():
+            for n in range(3):
+                session.add(Query(
+                    project="CMIP6", project_type="readonly", query_str=dumps({"filters": FILTERS}),
+                    pages=n + 1, n_datasets=0, n_failed=0,
+                    cursorMark=f"marker{n}", cursorMark_next=f"marker{n + 1}",
+                ))
+        with MigrationDB.get_session()() as session:
+            pages = session.query(Query).order_by(Query.pages).all()
+        yield pages
+    ctx.close()
+
+
+@pytest.fixture
+def coalescer(mocker):
+    submitted = []
+
+    def _ingest(self, gingest):
+        submitted.append([g["subject"] for g in gingest["ingest_data"]["gmeta"]])
+        self._response_data = {"acknowledged": True, "success": True, "task_id": f"task-{len(submitted)}"}
+        self._submissions = []
+        self._rejected = {}
+        self._submitted = True
+
+    mocker.patch.object(GlobusIngest, "ingest", _ingest)
+    ig = GlobusIngest(end_point=INDEX_ID, ep_name="test", project=ProjectReadOnly.CMIP6)
+
+    # three entries per request
+    max_bytes = 3 * encoded_size(_gmeta("p1-0")) + 1
+    return IngestCoalescer(ig, max_bytes, max_age=3600), submitted
+
+
+def _offset_marker():
+    gq = GlobusQuery(
+        end_point=INDEX_ID,
+        ep_type="globus",
+        ep_name="test",
+        project=ProjectReadOnly.CMIP6,
+        query={"filters": FILTERS, "limit": 2},
+        paginator="scroll",
+    )
+    gq.get_offset_marker(review=False)
+    return gq
+
+
+def _add_pages(coalescer, pages):
+    for page in pages:
+        coalescer.add(page, [_gmeta(f"p{page.pages}-{n}") for n in range(2)])
+
+
+def test_coalescer(coalesce_db, coalescer):
+
+    coalescer, submitted = coalescer
+    _add_pages(coalescer, coalesce_db)
+    coalescer.close()
+
+    assert submitted == [["p1-0", "p1-1", "p2-0"], ["p2-1", "p3-0", "p3-1"]]
+
+    with MigrationDB.get_session()() as session:
+        tasks = {
+            page.pages: sorted(i.task_id for i in session.query(Ingest).filter(Ingest.pages == page.pages))
+            for page in session.query(Query)
+        }
+        assert tasks == {1: ["task-1"], 2: ["task-1", "task-2"], 3: ["task-2"]}
+        assert [(q.n_datasets, q.coalesced) for q in session.query(Query).order_by(Query.pages)] == [
+            (1, 1), (2, 1), (1, 1)
+        ]
+
+    # every page is complete, it continues after the last one
+    gq = _offset_marker()
+    assert (gq.query["marker"], gq._restart) == ("marker3", False)
+
+
+def test_coalescer_restart(coalesce_db, coalescer):
+
+    coalescer, submitted = coalescer
+    # stopped before the last request, the pages 2 and 3 are not closed
+    _add_pages(coalescer, coalesce_db)
+    assert submitted == [["p1-0", "p1-1", "p2-0"]]
+
+    gq = _offset_marker()
+    assert (gq.query["marker"], gq._restart) == ("marker1", True)
+
+    with MigrationDB.get_session()() as session:
+        assert [q.pages for q in session.query(Query).order_by(Query.pages)] == [1, 2]
+        assert [i.pages for i in session.query(Ingest)] == [1]
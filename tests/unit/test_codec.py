@@ -0,0 +1,71 @@
+import hashlib
+import json
+import math
+
+import pytest
+
+from metadata_migrate_sync import codec
+from metadata_migrate_sync.fingerprint import VOLATILE_FIELDS, content_fingerprint
+
+DOCS = [
+    {"filters": [{"type": "range", "field_name": "_timestamp",
+                  "values": [{"from": "2024-05-01T00:00:00Z", "to": "*"}]}], "limit": 2000, "offset": 0},
+    {"acknowledged": True, "success": True, "task_id": "a04ae23d-6fd4-42af-b52c-d54577db97dc",
+     "num_documents_ingested": 0, "error": None},
+    {"title": "Température de surface ☀ 😀", "note": "a, b: c", "quote": 'say "hi" \\ bye'},
+    {"north_degrees": 90.0, "tiny": 1e-05, "huge": 1e16, "neg": -0.0, "third": 0.1 + 0.2},
+    {"big": 2**70, "control": "\x00\x1f\x7f", "nested": [[], {}, [[{"a": [1, 2]}]]]},
+    [],
+    "",
+]
+
+
+@pytest.fixture(params=["orjson", "json"])
+def backend(request, monkeypatch):
+    monkeypatch.setattr(codec.CodecConfig, "BACKEND", request.param)
+    return request.param
+
+
+@pytest.mark.parametrize("doc", DOCS)
+def test_dumps_bytes(backend, doc):
+
+    assert codec.dumps(doc) == json.dumps(doc)
+    assert codec.dumps(doc, compact=True, sort_keys=True) == json.dumps(
+        doc, separators=(",", ":"), sort_keys=True)
+    assert codec.encoded_size(doc) == len(json.dumps(doc))
+
+
+@pytest.mark.parametrize("doc", DOCS)
+def test_round_trip(backend, doc):
+
+    assert codec.loads(codec.dumpb(doc)) == doc
+    assert codec.loads(json.dumps(doc)) == doc
+    assert codec.loads(json.dumps(doc).encode("utf-8")) == doc
+
+
+def test_json_only_values(backend):
+
+    data = codec.loads('{"x": NaN, "y": Infinity, "z": 123456789012345678901234567890}')
+    assert math.isnan(data["x"])
+    assert data["y"] == math.inf
+    assert data["z"] == 123456789012345678901234567890
+
+    # not written as null
+    assert math.isnan(codec.loads(codec.dumpb({"x": math.nan}))["x"])
+
+
+def test_stored_strings(backend, gmeta_sample_wrong_type):
+
+    page = gmeta_sample_wrong_type
+    assert codec.encoded_size(page) == len(json.dumps(page))
+    assert codec.loads(codec.dumpb(page)) == page
+
+    gmeta = page["gmeta"][0]
+    entry = {"id": "file", "visible_to": ["public"], "content": gmeta["entries"][0]["content"]}
+    content = {k: v for k, v in entry["content"].items() if k not in VOLATILE_FIELDS}
+    stable = json.dumps(
+        {"id": "file", "visible_to": ["public"], "content": content},
+        sort_keys=True, separators=(",", ":"), default=str,
+    )
+    # the fingerprints in the store do not change with the codec
+    assert content_fingerprint(entry) == hashlib.sha256(stable.encode("utf-8")).hexdigest()
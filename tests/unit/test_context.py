@@ -0,0 +1,77 @@
+import threading
+
+from metadata_migrate_sync.context import RunContext, current_context, in_current_context, run_in_contexts
+from metadata_migrate_sync.database import MigrationDB, Query
+from metadata_migrate_sync.provenance import provenance
+
+
+def _pipeline(tmp_path, name, n_pages, barrier):
+    prov = provenance(
+        task_name="sync",
+        source_index_id="a37bc34d-de15-493b-9221-b95b13114fd8",
+        source_index_type="globus",
+        source_index_name="stage",
+        ingest_index_id="a37bc34d-de15-493b-9221-b95b13114fd8",
+        ingest_index_type="globus",
+        ingest_index_name="test",
+        cmd_line=name,
+        log_file=str(tmp_path / f"{name}.log"),
+        db_file=str(tmp_path / f"{name}.sqlite"),
+    )
+    MigrationDB(prov.db_file, False)
+    # both pipelines are set up before any of them writes
+    barrier.wait()
+
+    with MigrationDB.get_session()() as session, session.begin():
+        for page in range(n_pages):
+            session.add(Query(project=name, project_type="ReadWrite", query_str="{}", pages=page))
+
+    def _in_thread():
+        provenance.get_logger(__name__).info(f"page count of {name}")
+        with MigrationDB.get_session()() as session:
+            return session.query(Query).count()
+
+    counts = []
+    t = threading.Thread(target=in_current_context(lambda: counts.append(_in_thread())))
+    t.start()
+    t.join()
+
+    return provenance._instance.cmd_line, counts[0]
+
+
+def test_run_in_contexts(tmp_path):
+
+    barrier = threading.Barrier(2)
+    results = run_in_contexts({
+        "one": lambda: _pipeline(tmp_path, "one", 1, barrier),
+        "two": lambda: _pipeline(tmp_path, "two", 2, barrier),
+    })
+
+    assert results == {"one": ("one", 1), "two": ("two", 2)}
+    assert "page count of one" in (tmp_path / "one.log").read_text()
+    assert "page count of two" not in (tmp_path / "one.log").read_text()
+    assert current_context() is None
+
+
+def test_run_in_contexts_failure():
+
+    def _fail():
+        raise SystemExit("bad settings")
+
+    results = run_in_contexts({"bad": _fail, "good": lambda: current_context().name})
+
+    assert isinstance(results["bad"], SystemExit)
+    assert results["good"] == "good"
+
+
+def test_context_hides_singleton(tmp_path, monkeypatch):
+
+    # the log file of a context without provenance is named after it
+    monkeypatch.chdir(tmp_path)
+    ctx = RunContext("hidden")
+    with ctx.bind():
+        assert provenance._instance is None
+        MigrationDB(tmp_path / "hidden.sqlite", False)
+        assert ctx.db is not None
+        assert ctx.db is not MigrationDB._instance
+    ctx.close()
@@ -1,4 +1,4 @@
-from metadata_migrate_sync.convert import fix_dtype_gmeta
+from metadata_migrate_sync.convert import _process_urls, fix_dtype_gmeta, get_url_rewriter
 import pytest
 import datetime
 
@@ -33,3 +33,51 @@ def test_convert_fix_dtype(gmeta_name, expected, request):
 
 
     
+
+
+ORNL_UUID = "dea29ae8-bb92-4c63-bdbc-260522c92fe8"
+PATH = "/css03_data/CMIP6/CMIP/NCAR/CESM2/tas_Amon_CESM2_historical_r1i1p1f1_gn_185001-201412.nc"
+
+
+@pytest.mark.parametrize("urls", [
+    [
+        f"https://esgf-data1.llnl.gov/thredds/fileServer{PATH}|application/netcdf|HTTPServer",
+        f"https://esgf-data1.llnl.gov/thredds/dodsC{PATH}.html|application/opendap-html|OPENDAP",
+        f"gsiftp://esgf-data1.llnl.gov:2811{PATH}|application/gridftp|GridFTP",
+        f"globus:415a6320-e49c-11e5-9798-22000b9da45e{PATH}|Globus|Globus",
+    ],
+    [f"globus:415a6320-e49c-11e5-9798-22000b9da45e{PATH}|Globus|Globus"],
+    [
+        "https://aims3.llnl.gov",
+        "http://aims3.llnl.gov:8080",
+        "http://aims3.llnl.gov:abc/thredds/x",
+        "https:///thredds/x",
+        "https://a.gov/thredds/x?next=https://b.gov/y",
+        f"globus:415a6320-e49c-11e5-9798-22000b9da45e{PATH}|globus:x/y",
+    ],
+])
+@pytest.mark.parametrize("globus_uuid", [ORNL_UUID, "None"])
+def test_url_rewriter_same_as_regex(urls, globus_uuid):
+
+    rewriter = get_url_rewriter("esgf-node.ornl.gov", globus_uuid)
+    assert rewriter is get_url_rewriter("esgf-node.ornl.gov", globus_uuid)
+
+    if globus_uuid == "None" and all("thredds" not in u for u in urls):
+        # the regex version fails without a globus url to build the alternates from
+        with pytest.raises(UnboundLocalError):
+            _process_urls(list(urls), "esgf-node.ornl.gov", globus_uuid)
+        assert rewriter.rewrite(urls) == urls
+        return
+
+    assert rewriter.rewrite(list(urls)) == _process_urls(list(urls), "esgf-node.ornl.gov", globus_uuid)
+
+
+def test_url_rewriter_edge_cases():
+
+    rewriter = get_url_rewriter("esgf-node.ornl.gov", ORNL_UUID)
+
+    assert rewriter.dataset_id(["CMIP6.a.b.v1|aims3.llnl.gov"]) == "CMIP6.a.b.v1|esgf-node.ornl.gov"
+    assert rewriter.dataset_id("CMIP6.a.b.v1|aims3.llnl.gov") == "CMIP6.a.b.v1|esgf-node.ornl.gov"
+    assert rewriter.globus_url(
+        ["https://app.globus.org/file-manager?origin_id=old&origin_path=/a/b"]
+    ) == [f"https://app.globus.org/file-manager?origin_id={ORNL_UUID}&origin_path=/a/b"]
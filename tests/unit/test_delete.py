@@ -0,0 +1,81 @@
+import json
+from unittest.mock import MagicMock
+
+import pytest
+from globus_sdk import SearchClient
+
+from metadata_migrate_sync.database import DeleteChunk, MigrationDB
+from metadata_migrate_sync.delete import batch_delete_subjects, iter_subjects_file
+
+INDEX_ID = "a37bc34d-de15-493b-9221-b95b13114fd8"
+
+
+def _gmeta(n, project="CMIP6"):
+    return {"subject": f"s{n}", "entries": [{"content": {"project": [project]}}]}
+
+
+def test_iter_subjects_file(tmp_path):
+
+    page = tmp_path / "page.json"
+    page.write_text(json.dumps({"gmeta": [_gmeta(n) for n in range(3)]}))
+    assert list(iter_subjects_file(page, "CMIP6")) == ["s0", "s1", "s2"]
+
+    with pytest.raises(ValueError):
+        list(iter_subjects_file(page, "CMIP5"))
+
+    ndjson = tmp_path / "subjects.ndjson"
+    ndjson.write_text('"s0"\n{"subject": "s1"}\n\n"s2"\n')
+    assert list(iter_subjects_file(ndjson)) == ["s0", "s1", "s2"]
+
+
+@pytest.fixture
+def mock_search_client(mocker, tmp_path):
+    mocker.patch("metadata_migrate_sync.delete.provenance")
+    MigrationDB(tmp_path / "delete.sqlite", False)
+    sc = MagicMock(spec=SearchClient)
+    sc.batch_delete_by_subject.side_effect = lambda index_id, subjects: MagicMock(
+        data={"task_id": subjects[0]}
+    )
+    return sc
+
+
+def test_batch_delete_resume(mock_search_client):
+
+    subjects = [f"s{n}" for n in range(25)]
+
+    deleted_chunks = {}
+    counts = batch_delete_subjects(
+        mock_search_client, INDEX_ID, iter(subjects), chunk_size=10, max_workers=2,
+        on_deleted=lambda chunk, data: deleted_chunks.update({data["task_id"]: chunk}),
+    )
+    assert counts["chunks"] == 3
+    assert counts["subjects"] == 25
+
+    calls = mock_search_client.batch_delete_by_subject.call_args_list
+    deleted = sorted(s for call in calls for s in call.kwargs["subjects"])
+    assert deleted == sorted(subjects)
+    # the subjects of each chunk are passed with its task
+    assert deleted_chunks == {chunk[0]: chunk for chunk in (subjects[:10], subjects[10:20], subjects[20:])}
+
+    with MigrationDB.get_session()() as session:
+        assert session.query(DeleteChunk).filter_by(submitted=1).count() == 3
+
+    # a rerun skips the submitted chunks
+    mock_search_client.batch_delete_by_subject.reset_mock()
+    counts = batch_delete_subjects(
+        mock_search_client, INDEX_ID, iter(subjects), chunk_size=10, max_workers=2
+    )
+    assert counts["skipped_chunks"] == 3
+    mock_search_client.batch_delete_by_subject.assert_not_called()
+
+
+def test_batch_delete_dry_run(mock_search_client):
+
+    subjects = [f"s{n}" for n in range(25)]
+
+    counts = batch_delete_subjects(
+        mock_search_client, INDEX_ID, iter(subjects), chunk_size=10, max_workers=2, dry_run=True
+    )
+    assert (counts["dry_run_chunks"], counts["dry_run_subjects"]) == (3, 25)
+    assert counts["chunks"] == 0
+    mock_search_client.batch_delete_by_subject.assert_not_called()
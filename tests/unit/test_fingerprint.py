@@ -0,0 +1,128 @@
+import copy
+from unittest.mock import MagicMock
+
+import pytest
+from globus_sdk import SearchClient
+
+from metadata_migrate_sync.fingerprint import FingerprintStore, content_fingerprint
+from metadata_migrate_sync.ingest import GlobusIngest, _doc_success
+from metadata_migrate_sync.project import ProjectReadWrite
+from metadata_migrate_sync.task_tracker import IngestTaskTracker
+
+INDEX_ID = "a37bc34d-de15-493b-9221-b95b13114fd8"
+
+
+def _gmeta(n, timestamp="2025-04-17T02:27:00.000Z"):
+    return {
+        "id": "file",
+        "subject": f"obs4MIPs.file_{n}.nc|esgf-node.ornl.gov",
+        "visible_to": ["public"],
+        "content": {"id": f"obs4MIPs.file_{n}.nc|esgf-node.ornl.gov", "size": n, "_timestamp": timestamp},
+    }
+
+
+def test_fingerprint_ignores_volatile_fields():
+
+    assert content_fingerprint(_gmeta(1)) == content_fingerprint(_gmeta(1, "2026-01-01T00:00:00.000Z"))
+    assert content_fingerprint(_gmeta(1)) != content_fingerprint(_gmeta(2))
+
+
+def test_fingerprint_store(tmp_path):
+
+    store = FingerprintStore(tmp_path / "fp.sqlite", INDEX_ID)
+    store.record([_gmeta(1), _gmeta(2)], task_id="task")
+
+    modified = _gmeta(2)
+    modified["content"]["size"] = 99
+
+    changed, unchanged = store.filter_unchanged([_gmeta(1, "2026-01-01T00:00:00.000Z"), modified, _gmeta(3)])
+    assert [g["subject"] for g in unchanged] == [_gmeta(1)["subject"]]
+    assert [g["subject"] for g in changed] == [modified["subject"], _gmeta(3)["subject"]]
+
+    # another target does not share the fingerprints
+    other = FingerprintStore(tmp_path / "fp.sqlite", "another-index")
+    assert other.lookup([_gmeta(1)["subject"]]) == {}
+
+
+@pytest.fixture
+def mock_search_client(mocker):
+    mocker.patch("metadata_migrate_sync.ingest.provenance")
+    mocker.patch("metadata_migrate_sync.globus.provenance")
+    sc = MagicMock(spec=SearchClient)
+    sc.ingest.return_value.data = {"acknowledged": True, "success": True, "task_id": "new-task"}
+    client = MagicMock()
+    client.search_client = sc
+    client.indexes = {"backup": INDEX_ID}
+    mocker.patch("metadata_migrate_sync.ingest.GlobusClient.get_client", return_value=client)
+    return sc
+
+
+def test_ingest_drops_unchanged(tmp_path, mocker, mock_search_client):
+
+    store = FingerprintStore(tmp_path / "fp.sqlite", INDEX_ID)
+    store.record([_gmeta(1)])
+    tracker = IngestTaskTracker(mock_search_client)
+    mocker.patch.object(tracker, "_record")
+    mock_search_client.get_task.return_value.data = {"state": "SUCCESS"}
+
+    ig = GlobusIngest(end_point=INDEX_ID, ep_name="backup", project=ProjectReadWrite.OBS4MIPS)
+    ig.use_fingerprints(store)
+    ig.use_tracker(tracker)
+
+    batch = [copy.deepcopy(_gmeta(1)), _gmeta(2)]
+    unchanged = ig.ingest({"ingest_type": "GMetaList", "ingest_data": {"gmeta": batch}})
+
+    submitted = mock_search_client.ingest.call_args[0][1]["ingest_data"]["gmeta"]
+    assert [g["subject"] for g in submitted] == [_gmeta(2)["subject"]]
+    assert unchanged == {_gmeta(1)["subject"]}
+    assert [_doc_success(g["content"], unchanged=unchanged) for g in batch] == [2, 0]
+    # the entries of the caller are not modified
+    assert batch == [_gmeta(1), _gmeta(2)]
+
+    # the fingerprints are stored once the task succeeded
+    assert store.lookup([_gmeta(2)["subject"]]) == {}
+    tracker.track("new-task")
+    tracker.poll()
+    assert store.lookup([_gmeta(2)["subject"]]) != {}
+
+    # everything is unchanged now, no submission at all
+    mock_search_client.ingest.reset_mock()
+    ig.ingest({"ingest_type": "GMetaList", "ingest_data": {"gmeta": [_gmeta(1), _gmeta(2)]}})
+
+    mock_search_client.ingest.assert_not_called()
+    assert ig._submitted
+    assert ig._response_data == {}
+
+
+def test_failed_task_drops_fingerprints(tmp_path, mocker, mock_search_client):
+
+    store = FingerprintStore(tmp_path / "fp.sqlite", INDEX_ID)
+    tracker = IngestTaskTracker(mock_search_client)
+    mock_search_client.get_task.return_value.data = {"state": "FAILED"}
+
+    # the tracker is set first, the callbacks are wired by the last setter
+    ig = GlobusIngest(end_point=INDEX_ID, ep_name="backup", project=ProjectReadWrite.OBS4MIPS)
+    ig.use_tracker(tracker)
+    ig.use_fingerprints(store)
+
+    ig.ingest({"ingest_type": "GMetaList", "ingest_data": {"gmeta": [_gmeta(1)]}})
+    assert store._staged == {"new-task": [(_gmeta(1)["subject"], content_fingerprint(_gmeta(1)))]}
+
+    # the failed task is submitted again by the next run
+    mocker.patch.object(tracker, "_record")
+    tracker.track("new-task")
+    tracker.poll()
+    assert store._staged == {}
+    assert store.lookup([_gmeta(1)["subject"]]) == {}
+
+
+def test_pending_task_keeps_no_fingerprints(tmp_path, mock_search_client):
+
+    store = FingerprintStore(tmp_path / "fp.sqlite", INDEX_ID)
+    ig = GlobusIngest(end_point=INDEX_ID, ep_name="backup", project=ProjectReadWrite.OBS4MIPS)
+    ig.use_fingerprints(store)
+    ig.use_tracker(IngestTaskTracker(mock_search_client))
+
+    # the task is not finished when the run stops
+    ig.ingest({"ingest_type": "GMetaList", "ingest_data": {"gmeta": [_gmeta(1)]}})
+    assert store.lookup([_gmeta(1)["subject"]]) == {}
@@ -0,0 +1,18 @@
+from datetime import datetime
+
+from metadata_migrate_sync.database import MigrationDB
+from metadata_migrate_sync.fixes import _store_partitions, _stored_partitions
+from metadata_migrate_sync.partition import timestamp_partitions
+
+
+def test_partitions_kept_for_restart(tmp_path):
+
+    MigrationDB(tmp_path / "fixation.sqlite", False)
+    assert _stored_partitions("_timestamp") == []
+
+    split = timestamp_partitions(datetime(2025, 1, 1), datetime(2025, 1, 2), 3)
+    _store_partitions("_timestamp", split)
+
+    # the restart gets the boundaries of the first run
+    assert _stored_partitions("_timestamp") == split
+    assert _stored_partitions("source_id") == []
@@ -39,3 +39,29 @@ def test_gmeta_fix_dtype(gmeta_sample_wrong_type):
     assert len(gm_list_skip[GlobusCV.INGEST_DATA.value][GlobusCV.GMETA.value]) == 0
     assert len(gm_list[GlobusCV.INGEST_DATA.value][GlobusCV.GMETA.value]) == 1
 
+
+
+def test_gmeta_process_pool(gmeta_sample_wrong_type, mocker):
+
+    mocker.patch("metadata_migrate_sync.gmeta.GmetaConfig.MIN_ENTRIES_PER_WORKER", 2)
+
+    entry = gmeta_sample_wrong_type["gmeta"][0]
+    entries = []
+    for n in range(9):
+        g = json.loads(json.dumps(entry))
+        g["subject"] = f"s{n}"
+        if n % 3 == 0:
+            del g["entries"][0]["content"]["_timestamp"]
+        entries.append(g)
+
+    # the in-process generator modifies the entries in place
+    expected = ModifiedGmetaGenerator(modifier = fix_dtype_gmeta).generate(
+        {"gmeta": json.loads(json.dumps(entries))}
+    )
+
+    with ModifiedGmetaGenerator(modifier = fix_dtype_gmeta, processes = 3) as gm:
+        result = gm.generate({"gmeta": entries})
+        assert gm._pool is not None
+
+    assert result == expected
+    assert len(result[1][GlobusCV.INGEST_DATA.value][GlobusCV.GMETA.value]) == 3
@@ -1,10 +1,23 @@
 import json
+import zlib
 
 import pytest
-
-from metadata_migrate_sync.database import Files, Ingest, MigrationDB, Query
+import requests
+from globus_sdk import GlobusAPIError, SearchClient
+
+from metadata_migrate_sync.context import RunContext
+from metadata_migrate_sync.database import (
+    Files,
+    FilesCompact,
+    Index,
+    Ingest,
+    MigrationDB,
+    Query,
+    StorageConfig,
+)
+from metadata_migrate_sync.db_query import query_files_table_context
 from metadata_migrate_sync.globus import GlobusClient
-from metadata_migrate_sync.ingest import GlobusIngest, generate_gmeta_list
+from metadata_migrate_sync.ingest import GlobusIngest, IngestConfig, generate_gmeta_list
 from metadata_migrate_sync.project import ProjectReadOnly
 
 
@@ -116,7 +129,7 @@ def test_ingest_prov_collect(query_dummy, solr_file, datadir):
     files_ver = {'source_index': 'http://127.0.0.1:8983', 'target_index': '52eff156-6141-4fde-9efe-c08c92f3a706', 'files_id':
         'cmip5.output.CCCma.CanAM4.amip.3hr.atmos.r3i1p1.v20130331.sfcWind_cf3hr_CanAM4_amip_r3i1p1_197901010300-201001010000.nc|crd-esgf-drc.ec.gc.ca',
         'uri': 'http://crd-esgf-drc.ec.gc.ca/thredds/fileServer/esg_dataroot/AR5/CMIP5/output/CCCma/CanAM4/amip/3hr/atmos/sfcWind/r3i1p1/sfcWind_cf3hr_CanAM4_amip_r3i1p1_197901010300-201001010000.nc|application/netcdf|HTTPServer,gsiftp://crd-esgf-drc.ec.gc.ca:2811//esg_dataroot/AR5/CMIP5/output/CCCma/CanAM4/amip/3hr/atmos/sfcWind/r3i1p1/sfcWind_cf3hr_CanAM4_amip_r3i1p1_197901010300-201001010000.nc|application/gridftp|GridFTP,http://crd-esgf-drc.ec.gc.ca/thredds/dodsC/esg_dataroot/AR5/CMIP5/output/CCCma/CanAM4/amip/3hr/atmos/sfcWind/r3i1p1/sfcWind_cf3hr_CanAM4_amip_r3i1p1_197901010300-201001010000.nc.html|application/opendap-html|OPENDAP',
-         'success': 0}
+         'success': 0, 'error': None}
 
 
     gmeta_list = generate_gmeta_list(solr_file.get("response").get("docs")[0:1], "files")
@@ -171,6 +184,161 @@ def test_ingest_prov_collect(query_dummy, solr_file, datadir):
 
 
 
+def _rejection(status, code):
+    r = requests.Response()
+    r.status_code = status
+    r._content = json.dumps({"code": code, "message": "rejected"}).encode()
+    r.headers["Content-Type"] = "application/json"
+    r.request = requests.Request("POST", "https://search.api.globus.org/v1/index/x/ingest").prepare()
+    return GlobusAPIError(r)
+
+
+def test_ingest_bisect(tmp_path, mocker):
+
+    mocker.patch("metadata_migrate_sync.ingest.provenance")
+    mocker.patch("metadata_migrate_sync.globus.provenance")
+    MigrationDB(tmp_path / "bisect.sqlite", False)
+    with MigrationDB.get_session()() as session, session.begin():
+        session.add(Query(project="CMIP6", project_type="readonly", query_str="{}", pages=1))
+    with MigrationDB.get_session()() as session:
+        query = session.query(Query).one()
+
+    submitted = []
+
+    def _ingest(index_id, gingest):
+        gmeta = gingest["ingest_data"]["gmeta"]
+        if len(gmeta) > 2:
+            raise _rejection(413, "RequestTooLarge")
+        if any(g["subject"] == "bad" for g in gmeta):
+            raise _rejection(400, "BadRequest")
+        submitted.append([g["subject"] for g in gmeta])
+        return mocker.Mock(data={"acknowledged": True, "success": True, "task_id": f"task-{len(submitted)}"})
+
+    gc = mocker.patch("metadata_migrate_sync.ingest.GlobusClient").get_client.return_value
+    gc.indexes = {"test": "52eff156-6141-4fde-9efe-c08c92f3a706"}
+    gc.search_client = mocker.Mock(spec=SearchClient)
+    gc.search_client.ingest.side_effect = _ingest
+
+    ig = GlobusIngest(
+        end_point="52eff156-6141-4fde-9efe-c08c92f3a706", ep_name="test", project=ProjectReadOnly.CMIP6
+    )
+    docs = [{"id": subject} for subject in ["a", "b", "bad", "c", "d"]]
+    ig.ingest({
+        "ingest_type": "GMetaList",
+        "ingest_data": {"gmeta": [
+            {"id": "file", "subject": doc["id"], "visible_to": ["public"], "content": doc} for doc in docs
+        ]},
+    })
+
+    assert ig._submitted
+    assert submitted == [["a", "b"], ["c", "d"]]
+    assert list(ig._rejected) == ["bad"]
+
+    ig.prov_collect(docs, review=False, current_query=query, metatype="files")
+
+    with MigrationDB.get_session()() as session:
+        ingests = session.query(Ingest).order_by(Ingest.id).all()
+        assert [(i.task_id, i.n_ingested) for i in ingests] == [("task-1", 2), ("task-2", 2)]
+        files = {f.files_id: (f.success, f.error) for f in session.query(Files)}
+        assert files["bad"] == (-9, "400 BadRequest: rejected")
+        assert files["a"] == (0, None)
+
+
+
+def test_ingest_bad_request(tmp_path, mocker):
+
+    mocker.patch("metadata_migrate_sync.ingest.provenance")
+    mocker.patch("metadata_migrate_sync.globus.provenance")
+    MigrationDB(tmp_path / "bad_request.sqlite", False)
+    with MigrationDB.get_session()() as session, session.begin():
+        session.add(Query(project="CMIP6", project_type="readonly", query_str="{}", pages=1))
+
+    calls = []
+
+    def _ingest(index_id, gingest):
+        gmeta = gingest["ingest_data"]["gmeta"]
+        calls.append(len(gmeta))
+        if all(g["subject"] == "a" for g in gmeta):
+            return mocker.Mock(data={"acknowledged": True, "success": True, "task_id": "task-a"})
+        raise _rejection(400, "BadRequest")
+
+    gc = mocker.patch("metadata_migrate_sync.ingest.GlobusClient").get_client.return_value
+    gc.indexes = {"test": "52eff156-6141-4fde-9efe-c08c92f3a706"}
+    gc.search_client = mocker.Mock(spec=SearchClient)
+    gc.search_client.ingest.side_effect = _ingest
+
+    def _gmeta(subjects):
+        return {
+            "ingest_type": "GMetaList",
+            "ingest_data": {"gmeta": [
+                {"id": "file", "subject": s, "visible_to": ["public"], "content": {"id": s}} for s in subjects
+            ]},
+        }
+
+    ig = GlobusIngest(
+        end_point="52eff156-6141-4fde-9efe-c08c92f3a706", ep_name="test", project=ProjectReadOnly.CMIP6
+    )
+
+    # a request rejected for every document stops after the first rejected documents
+    with pytest.raises(GlobusAPIError):
+        ig.ingest(_gmeta([f"s{n}" for n in range(256)]))
+    assert len(calls) < 20
+
+    # the tasks submitted before the error are recorded
+    with pytest.raises(GlobusAPIError):
+        ig.ingest(_gmeta(["a"] + [f"s{n}" for n in range(IngestConfig.MAX_REJECTED + 1)]))
+    MigrationDB.barrier()
+    with MigrationDB.get_session()() as session:
+        assert [(i.task_id, i.pages) for i in session.query(Ingest)] == [("task-a", 1)]
+
+
+def test_prov_collect_compact(tmp_path, mocker, monkeypatch):
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(StorageConfig, "MODE", "compact")
+    mocker.patch("metadata_migrate_sync.ingest.provenance")
+
+    ctx = RunContext("compact")
+    with ctx.bind():
+        MigrationDB(tmp_path / "compact.sqlite", False)
+        with MigrationDB.get_session()() as session, session.begin():
+            session.add(Index(index_id="solr-ornl", index_name="ornl", index_type="solr"))
+            session.add(Query(project="CMIP6", project_type="readonly", query_str="{}", pages=1,
+                              index_id="solr-ornl", date_range="[]"))
+        with MigrationDB.get_session()() as session:
+            query = session.query(Query).one()
+
+        ig = GlobusIngest(end_point="52eff156-6141-4fde-9efe-c08c92f3a706", ep_name="test",
+                          project=ProjectReadOnly.CMIP6)
+        ig._submitted = True
+        ig._response_data = {"acknowledged": True, "success": True, "task_id": "task-1",
+                             "num_documents_ingested": 2, "request_id": "r1"}
+        docs = [
+            {
+                "id": "a",
+                "size": 10,
+                "url": ["https://a.nc|application/netcdf|HTTPServer", "globus:a.nc|Globus|Globus"],
+            },
+            {"id": "b", "skip_ingest": True},
+        ]
+        ig.prov_collect(docs, review=False, current_query=query, metatype="files")
+
+        with MigrationDB.get_session()() as session:
+            assert session.query(Files).count() == 0
+            rows = {f.files_id: f for f in session.query(FilesCompact)}
+            assert zlib.decompress(rows["a"].uri_z).decode() == ",".join(docs[0]["url"])
+            assert (rows["a"].n_urls, rows["b"].n_urls, rows["b"].success) == (2, 0, -9)
+            assert session.get(Index, rows["a"].source_key).index_id == "solr-ornl"
+            assert session.get(Index, rows["a"].target_key).index_id == str(ig.end_point)
+            assert json.loads(session.query(Ingest).one().ingest_response) == {
+                "acknowledged": True, "success": True, "task_id": "task-1"
+            }
+    ctx.close()
+
+    # the skipped files are read through the compatibility view
+    assert query_files_table_context(str(tmp_path / "compact.sqlite"), "File") == [("b", "[]")]
+
+
 #-#mdb.init_index()
 #-GlobusMeta.model_validate(test_entries[0])
 #-m = GlobusIngest(**test_gmeta)
@@ -0,0 +1,53 @@
+from metadata_migrate_sync.convert import SOURCE_FILTER_QUERIES
+from metadata_migrate_sync.database import Ingest, MigrationDB, Query
+from metadata_migrate_sync.migrate import _count_pushdown_skipped, _review_from_spool
+
+
+def test_count_pushdown_skipped(mocker):
+
+    pushdown = SOURCE_FILTER_QUERIES["ornl"]
+    facet_query = pushdown[0]
+    request = mocker.patch(
+        "metadata_migrate_sync.migrate.SolrQuery._make_request",
+        return_value=(
+            {"response": {"numFound": 100}, "facet_counts": {"facet_queries": {facet_query: 30}}},
+            0.1,
+            "url",
+        ),
+    )
+
+    search_dict = {"q": "project:CMIP6", "fq": ["_timestamp:[* TO 2025-03-16T00:00:00Z]", *pushdown]}
+    assert _count_pushdown_skipped("https://solr/files/select", search_dict, pushdown) == (100, 70)
+
+    params = request.call_args[0][1]
+    assert params["rows"] == 0
+    assert params["fq"] == ["_timestamp:[* TO 2025-03-16T00:00:00Z]"]
+    assert params["facet.query"] == facet_query
+
+
+def test_ornl_filter_keeps_missing_data_node():
+
+    # convert_to_esgf_1_5 keeps the documents without data_node
+    ornl_filter = SOURCE_FILTER_QUERIES["ornl"][0]
+    assert ornl_filter.startswith("(data_node:(")
+    assert ornl_filter.endswith(" OR (*:* -data_node:*))")
+
+
+def test_review_failed_tasks_only(mocker, tmp_path):
+
+    mocker.patch("metadata_migrate_sync.migrate.provenance")
+    spooled = mocker.patch("metadata_migrate_sync.migrate._ingest_spooled", return_value=True)
+
+    MigrationDB(tmp_path / "review.sqlite", True)
+    with MigrationDB.get_session()() as session, session.begin():
+        for page in range(1, 4):
+            session.add(Query(project="CMIP6", project_type="readonly", query_str="{}", pages=page))
+        # succeeded, failed (twice), pending
+        session.add(Ingest(pages=1, task_id="t1", submitted=1, succeeded=1))
+        session.add(Ingest(pages=2, task_id="t2", submitted=1, succeeded=0, n_failed=1))
+        session.add(Ingest(pages=2, task_id="t3", submitted=1, succeeded=0, n_failed=1))
+        session.add(Ingest(pages=3, task_id="t4", submitted=1, succeeded=0))
+
+    _review_from_spool(mocker.Mock(), mocker.Mock(), "files")
+
+    assert [call.args[1] for call in spooled.call_args_list] == [2]
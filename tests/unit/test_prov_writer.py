@@ -0,0 +1,91 @@
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from metadata_migrate_sync.database import Base, Files, Ingest, MigrationDB, Query
+from metadata_migrate_sync.ingest import GlobusIngest
+from metadata_migrate_sync.project import ProjectReadOnly
+from metadata_migrate_sync.prov_writer import ProvWriter
+
+
+@pytest.fixture
+def session_factory(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'writer.sqlite'}")
+    Base.metadata.create_all(engine)
+    return sessionmaker(bind=engine)
+
+
+def _add_query(pages):
+    def _record(session):
+        session.add(Query(project="CMIP5", project_type="readonly", query_str="{}", pages=pages))
+    return _record
+
+
+def test_group_commit(session_factory):
+
+    sessions = []
+
+    def _counting_factory():
+        sessions.append(1)
+        return session_factory()
+
+    writer = ProvWriter(_counting_factory, group_size=3, group_ms=10_000)
+    for pages in range(7):
+        writer.submit(_add_query(pages))
+    writer.barrier()
+
+    with session_factory() as session:
+        assert session.query(Query).count() == 7
+    # two full groups and the rest committed at the barrier
+    assert len(sessions) == 3
+
+    writer.close()
+
+
+def test_writer_error(session_factory):
+
+    def _fail(session):
+        raise ValueError("bad record")
+
+    writer = ProvWriter(session_factory, group_ms=0)
+    writer.submit(_fail)
+    with pytest.raises(RuntimeError):
+        writer.barrier()
+    with pytest.raises(RuntimeError):
+        writer.submit(_add_query(1))
+
+
+def test_ingest_prov_collect_behind(tmp_path, mocker):
+
+    mocker.patch("metadata_migrate_sync.ingest.provenance")
+    MigrationDB(tmp_path / "behind.sqlite", False)
+    MigrationDB.start_writer(group_ms=10_000)
+
+    with MigrationDB.get_session()() as session, session.begin():
+        session.add(Query(project="CMIP5", project_type="readonly", query_str="{}", pages=1))
+        session.add(Query(project="CMIP5", project_type="readonly", query_str="{}", pages=2))
+    with MigrationDB.get_session()() as session:
+        first_page = session.query(Query).filter_by(pages=1).one()
+
+    ig = GlobusIngest(
+        end_point="52eff156-6141-4fde-9efe-c08c92f3a706", ep_name="test", project=ProjectReadOnly.CMIP5
+    )
+    ig._submitted = True
+    ig._response_data = {"acknowledged": True, "success": True, "task_id": "task"}
+
+    docs = [{"id": "f1", "size": 1, "url": ["u1"]}, {"id": "f2", "skip_ingest": True}]
+    ig.prov_collect(docs, review=False, current_query=first_page, metatype="files")
+    docs.clear()
+
+    # queued behind the pipeline until the barrier
+    with MigrationDB.get_session()() as session:
+        assert session.query(Ingest).count() == 0
+
+    MigrationDB.barrier()
+    with MigrationDB.get_session()() as session:
+        ingest = session.query(Ingest).one()
+        assert (ingest.pages, ingest.task_id, ingest.n_files) == (1, "task", 2)
+        files = {f.files_id: (f.pages, f.uri, f.success) for f in session.query(Files)}
+        assert files == {"f1": (1, "u1", 0), "f2": (1, "NoURL", -9)}
+
+    MigrationDB.stop_writer()
@@ -2,9 +2,17 @@ import pytest
 import requests
 import responses
 
-from metadata_migrate_sync.database import MigrationDB
+from metadata_migrate_sync.context import RunContext
+from metadata_migrate_sync.database import MigrationDB, Query, QueryTemplate
 from metadata_migrate_sync.project import ProjectReadOnly
-from metadata_migrate_sync.query import SolrQuery, params_search
+from metadata_migrate_sync.query import (
+    GlobusQuery,
+    PartitionedGlobusQuery,
+    SolrQuery,
+    params_search,
+    partition_key,
+)
+from metadata_migrate_sync.util import get_last_query
 
 cmip6_cusormark_list_row10_idasc_ornl = [
 'AoE/b0NNSVA2LkFlckNoZW1NSVAuQkNDLkJDQy1FU00xLnNzcDM3MC5yMWkxcDFmMS5BbW9uLnBzLmduLnYyMDE5MDYyNC5wc19BbW9uX0JDQy1FU00xX3NzcDM3MF9yMWkxcDFmMV9nbl8yMDE1MDEtMjA1NTEyLm5jfGVzZ2YtZGF0YTA0LmRpYXNqcC5uZXQ=',
@@ -178,3 +186,247 @@ def test_query_exhaust_retries():
     assert len(responses.calls) == 4
 
 
+
+
+@responses.activate
+def test_solr_export_pages(mocker):
+    mocker.patch("metadata_migrate_sync.query.provenance")
+
+    select = "https://esgf-node.ornl.gov/esgf-1-5-bridge/files/select"
+    export = "https://esgf-node.ornl.gov/esgf-1-5-bridge/files/export"
+    docs = [{"id": f"CMIP5.file_{n}.nc|aims3.llnl.gov", "size": n + 0.5} for n in range(5)]
+
+    schema = "https://esgf-node.ornl.gov/esgf-1-5-bridge/files/schema/fields"
+    fields = [{"name": "id", "docValues": True}, {"name": "size", "docValues": True}]
+
+    responses.add(responses.GET, schema, json={"fields": fields})
+    responses.add(responses.GET, select, json={"response": {"numFound": 5, "docs": []}})
+    exported = {"responseHeader": {"status": 0}, "response": {"numFound": 5, "docs": docs}}
+    responses.add(responses.GET, export, json=exported)
+
+    sq = SolrQuery(
+        end_point=select,
+        ep_type="solr",
+        ep_name="ornl",
+        project=ProjectReadOnly.CMIP5,
+        query={
+            "q": "project:CMIP5", "fq": "_timestamp:[* TO *]", "rows": 2, "cursorMark": docs[0]["id"],
+            "fl": "id,size",
+        },
+        skip_prov=True,
+        export=True,
+    )
+
+    pages = list(sq.run())
+
+    assert [len(p) for p in pages] == [2, 2, 1]
+    assert pages[0][0]["size"] == 0.5
+    assert sq.query["cursorMark"] == docs[-1]["id"]
+    assert sq._num_found == 5
+
+    export_call = responses.calls[2].request
+    assert export_call.url.startswith(export)
+    assert "sort=id+asc" in export_call.url
+    # the export restarts after the id in the cursorMark
+    assert "id%3A%7B%22CMIP5.file_0.nc%7Caims3.llnl.gov%22+TO+%2A%5D" in export_call.url
+
+
+@responses.activate
+def test_solr_export_fields(mocker):
+    mocker.patch("metadata_migrate_sync.query.provenance")
+
+    select = "https://esgf-node.ornl.gov/esgf-1-5-bridge/files/select"
+    schema = "https://esgf-node.ornl.gov/esgf-1-5-bridge/files/schema/fields"
+    fields = [{"name": "id", "docValues": True}, {"name": "url", "docValues": False}]
+    responses.add(responses.GET, schema, json={"fields": fields})
+
+    sq = SolrQuery(
+        end_point=select, ep_type="solr", ep_name="ornl", project=ProjectReadOnly.CMIP5,
+        query={"q": "project:CMIP5", "rows": 2}, skip_prov=True, export=True,
+    )
+
+    # no field list
+    with pytest.raises(ValueError, match="docValues"):
+        list(sq.run())
+
+    # a field without docValues
+    sq.query["fl"] = "id,url"
+    with pytest.raises(ValueError, match=r"without docValues: \['url'\]"):
+        list(sq.run())
+
+    # no schema api, a field missing in the /select documents
+    responses.replace(responses.GET, schema, status=404)
+    responses.add(responses.GET, select, json={"response": {"numFound": 1, "docs": [{"id": "a"}]}})
+    with pytest.raises(ValueError, match=r"\['url'\] are not in the documents"):
+        list(sq.run())
+
+
+@responses.activate
+def test_solr_id_only_csv(mocker):
+    mocker.patch("metadata_migrate_sync.query.provenance")
+
+    select = "https://esgf-node.ornl.gov/esgf-1-5-bridge/files/select"
+    responses.add(responses.GET, select, json={"response": {"numFound": 3, "docs": []}})
+    responses.add(responses.GET, select, body='a|x\n"b,c|x"\n')
+    responses.add(responses.GET, select, body='"d,e|x"\n')
+
+    sq = SolrQuery(
+        end_point=select,
+        ep_type="solr",
+        ep_name="ornl",
+        project=ProjectReadOnly.CMIP5,
+        query={"q": "project:CMIP5", "fq": ["data_node:x"], "rows": 2, "wt": "csv", "cursorMark": "*"},
+        skip_prov=True,
+        id_only=True,
+    )
+
+    pages = list(sq.run())
+
+    assert pages == [[{"id": "a|x"}, {"id": "b,c|x"}], [{"id": "d,e|x"}]]
+    assert sq._num_found == 3
+    assert "fl=id" in responses.calls[1].request.url
+    assert "id%3A%7B%22b%2Cc%7Cx%22+TO+%2A%5D" in responses.calls[2].request.url
+
+
+def test_globus_ids_only():
+
+    gq = GlobusQuery(
+        end_point="a37bc34d-de15-493b-9221-b95b13114fd8",
+        ep_type="globus",
+        ep_name="test",
+        project=ProjectReadOnly.CMIP5,
+        query={"filters": [], "limit": 2},
+        paginator="scroll",
+        ids_only=True,
+    )
+    page = {"total": 1, "gmeta": [{"subject": "s1", "entries": [{"content": {"id": "s1"}}]}]}
+
+    assert gq._keep_ids(page) == {"total": 1, "gmeta": [{"subject": "s1"}]}
+
+
+def _partitioned_query():
+    return PartitionedGlobusQuery(
+        end_point="a37bc34d-de15-493b-9221-b95b13114fd8",
+        ep_type="globus",
+        ep_name="test",
+        project=ProjectReadOnly.CMIP5,
+        query={"filters": [{"type": "match_all", "field_name": "project", "values": ["CMIP5"]}], "limit": 2},
+        partitions=[{"type": "match_any", "field_name": "source_id", "values": [v]} for v in "ab"],
+        skip_prov=True,
+    )
+
+
+def test_partitioned_globus_query_run(mocker):
+
+    def _run(self):
+        value = self.query["filters"][-1]["values"][0]
+        for n in range(3):
+            self._current_query = f"{value}{n}"
+            yield {"total": 3, "gmeta": [{"subject": f"{value}{n}"}]}
+
+    mocker.patch.object(GlobusQuery, "run", _run)
+    pq = _partitioned_query()
+
+    # the pages of a partition are keyed by its filter, not by its position
+    assert [gq.partition for gq in pq._queries] == [partition_key(p) for p in pq.partitions]
+    assert partition_key(pq.partitions[1]) == partition_key(dict(reversed(pq.partitions[1].items())))
+    assert pq._queries[1].query["filters"][0]["field_name"] == "project"
+
+    subjects = []
+    for page in pq.run():
+        # the current query follows the partition of the page
+        assert pq._current_query == page["gmeta"][0]["subject"]
+        subjects.append(page["gmeta"][0]["subject"])
+
+    assert sorted(subjects) == ["a0", "a1", "a2", "b0", "b1", "b2"]
+    assert [s for s in subjects if s[0] == "a"] == ["a0", "a1", "a2"]
+    assert pq._num_found == 6
+
+
+def test_partitioned_globus_query_error(mocker):
+
+    def _run(self):
+        if self.query["filters"][-1]["values"] == ["b"]:
+            raise RuntimeError("boom")
+        yield {"total": 1, "gmeta": []}
+
+    mocker.patch.object(GlobusQuery, "run", _run)
+
+    with pytest.raises(RuntimeError):
+        list(_partitioned_query().run())
+
+
+def test_partition_last_query(tmp_path):
+
+    MigrationDB(tmp_path / "partition.sqlite", True)
+    pq = _partitioned_query()
+    keys = [gq.partition for gq in pq._queries]
+    with MigrationDB.get_session()() as session, session.begin():
+        for pages, n in enumerate([0, 1, 0, 1, 1], start=1):
+            partition = keys[n]
+            session.add(Query(
+                project="CMIP5", project_type="ReadOnly", query_str="{}",
+                pages=pages, partition=partition, cursorMark_next=f"marker{pages}",
+            ))
+
+    with MigrationDB.get_session()() as session:
+        assert pq._queries[0]._last_query(session).pages == 3
+        assert pq._queries[1]._last_query(session).pages == 5
+
+
+def _id_chunk_query(ids):
+    return GlobusQuery(
+        end_point="a37bc34d-de15-493b-9221-b95b13114fd8",
+        ep_type="globus",
+        ep_name="test",
+        project=ProjectReadOnly.CMIP5,
+        query={
+            "filters": [
+                {"type": "match_any", "field_name": "id", "values": ids},
+                {"type": "match_all", "field_name": "type", "values": ["File"]},
+            ],
+            "limit": 2,
+            "offset": 0,
+        },
+        generator=True,
+        paginator="post",
+    )
+
+
+def test_query_template(tmp_path, mocker, monkeypatch):
+
+    monkeypatch.chdir(tmp_path)
+    mocker.patch("metadata_migrate_sync.query.provenance")
+    ids = [f"CMIP5.output1.f{n}.nc|esgf-node.ornl.gov" for n in range(200)]
+
+    ctx = RunContext("template")
+    with ctx.bind():
+        MigrationDB(tmp_path / "template.sqlite", False)
+
+        gq = _id_chunk_query(ids)
+        for offset in (0, 2):
+            gq.query["offset"] = offset
+            sq = {"filters": gq.query["filters"], "q": "*", "limit": 2, "offset": offset}
+            gq.prov_collect({"total": 4, "gmeta": [{"subject": "s"}] * 2}, 0.1, sq)
+
+        with MigrationDB.get_session()() as session:
+            assert session.query(QueryTemplate).count() == 1
+            template = session.query(QueryTemplate).one().template
+            assert ids[0] not in template
+            pages = session.query(Query).order_by(Query.pages).all()
+            assert [p.query_str for p in pages] == ['{"offset": 0}', '{"offset": 2}']
+            assert pages[0].id_chunk == pages[1].id_chunk
+
+        # the same filters restart the last page, other ids are a new start
+        gq = _id_chunk_query(ids)
+        gq.get_offset_marker(review=False)
+        assert (gq.query["offset"], gq._restart) == (2, True)
+
+        gq = _id_chunk_query(ids[:150])
+        gq.get_offset_marker(review=False)
+        assert (gq.query["offset"], gq._restart) == (0, False)
+
+    ctx.close()
+
+    query = get_last_query(tmp_path / "template.sqlite")
+    assert (query["offset"], query["limit"], query["filters"][0]["values"]) == (2, 2, [])
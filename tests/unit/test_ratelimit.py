@@ -0,0 +1,110 @@
+import threading
+import time
+
+import pytest
+import requests
+from globus_sdk import GlobusAPIError, SearchClient
+
+from metadata_migrate_sync.ratelimit import (
+    AdaptiveLimiter,
+    RateLimitConfig,
+    api_class_of,
+    get_limiter,
+    install,
+    limited,
+    reset_limiters,
+)
+
+
+@pytest.fixture(autouse=True)
+def fresh_limiters():
+    reset_limiters()
+    yield
+    reset_limiters()
+
+
+def _api_error(status, retry_after=None):
+    r = requests.Response()
+    r.status_code = status
+    r._content = b'{"code": "RateLimited", "message": "slow down"}'
+    r.headers["Content-Type"] = "application/json"
+    if retry_after is not None:
+        r.headers["Retry-After"] = retry_after
+    r.request = requests.Request("POST", "https://search.api.globus.org/v1/index/x/search").prepare()
+    return GlobusAPIError(r)
+
+
+def test_api_class_of():
+
+    assert api_class_of("POST", "/v1/index/x/search") == "search"
+    assert api_class_of("POST", "/v1/index/x/scroll") == "search"
+    assert api_class_of("POST", "/v1/index/x/ingest") == "ingest"
+    assert api_class_of("POST", "/v1/index/x/batch_delete_by_subject") == "ingest"
+    assert api_class_of("GET", "/v1/task/abc") == "task"
+
+
+def test_limited_retries_429(mocker):
+
+    mocker.patch.object(RateLimitConfig, "MAX_RETRIES", 2)
+    calls = []
+
+    def _request(method, path, **kwargs):
+        calls.append(path)
+        if len(calls) == 1:
+            raise _api_error(429, retry_after="0")
+        return "ok"
+
+    request = limited(_request)
+    assert request("POST", "/v1/index/x/ingest") == "ok"
+    assert len(calls) == 2
+
+    limiter = get_limiter("ingest")
+    decreased = RateLimitConfig.RATES["ingest"] * RateLimitConfig.DECREASE
+    assert limiter.rate == decreased + RateLimitConfig.RATE_INCREASE
+    assert limiter.in_flight == 0
+
+    # the other errors and the exhausted retries are raised
+    with pytest.raises(GlobusAPIError):
+        limited(lambda method, path: (_ for _ in ()).throw(_api_error(500)))("POST", "/v1/index/x/search")
+    with pytest.raises(GlobusAPIError):
+        limited(lambda method, path: (_ for _ in ()).throw(_api_error(429, "0")))("GET", "/v1/task/t")
+    assert get_limiter("search").in_flight == get_limiter("task").in_flight == 0
+
+
+def test_limiter_concurrency():
+
+    limiter = AdaptiveLimiter("test", rate=1000.0, concurrency=2, latency_target=10.0)
+    peak = []
+    lock = threading.Lock()
+
+    def _work():
+        limiter.acquire()
+        with lock:
+            peak.append(limiter.in_flight)
+        time.sleep(0.01)
+        limiter.release(latency=0.01)
+
+    threads = [threading.Thread(target=_work) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert max(peak) <= 2
+    assert limiter.in_flight == 0
+
+    # a slow response shrinks the concurrency
+    limiter.acquire()
+    limiter.release(latency=20.0)
+    assert limiter.concurrency < 2
+
+
+def test_install():
+
+    sc = SearchClient()
+    install(sc)
+    install(sc)
+
+    assert 429 not in sc.retry_config.transient_error_status_codes
+    assert 429 not in sc.retry_config.retry_after_status_codes
+    assert sc.request.__wrapped__.__self__ is sc
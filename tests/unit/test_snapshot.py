@@ -0,0 +1,201 @@
+import gzip
+import hashlib
+import json
+from datetime import datetime, timedelta, timezone
+from unittest.mock import MagicMock
+
+import pytest
+from globus_sdk import SearchClient
+
+from metadata_migrate_sync.partition import (
+    facet_partitions,
+    format_timestamp,
+    histogram_partitions,
+    timestamp_partitions,
+)
+from metadata_migrate_sync.project import ProjectReadWrite
+from metadata_migrate_sync.query import GlobusQuery
+from metadata_migrate_sync.snapshot import _pack_batches, metadata_export, metadata_load
+
+
+def test_timestamp_partitions():
+
+    parts = timestamp_partitions(datetime(2025, 1, 1), datetime(2025, 1, 2), 4)
+
+    ranges = [(p["values"][0]["from"], p["values"][0]["to"]) for p in parts]
+    assert ranges[0] == ("2025-01-01T00:00:00.000Z", "2025-01-01T05:59:59.999Z")
+    assert ranges[1][0] == "2025-01-01T06:00:00.000Z"
+    assert ranges[-1] == ("2025-01-01T18:00:00.000Z", "2025-01-02T00:00:00.000Z")
+    assert len(parts) == 4
+
+
+def test_histogram_partitions():
+
+    sc = MagicMock(spec=SearchClient)
+    counts = [10, 0, 0, 10, 30, 10, 0, 20]
+    sc.post_search.return_value.data = {"facet_results": [{"buckets": [
+        {"value": f"2025-{m + 1:02d}-01T00:00:00.000Z", "count": c} for m, c in enumerate(counts)
+    ]}]}
+
+    parts = histogram_partitions(sc, "index", [], datetime(2025, 1, 1), datetime(2025, 9, 1), 4)
+
+    ranges = [(p["values"][0]["from"], p["values"][0]["to"]) for p in parts]
+    assert ranges == [
+        ("2025-01-01T00:00:00.000Z", "2025-04-30T23:59:59.999Z"),
+        ("2025-05-01T00:00:00.000Z", "2025-05-31T23:59:59.999Z"),
+        ("2025-06-01T00:00:00.000Z", "2025-06-30T23:59:59.999Z"),
+        ("2025-07-01T00:00:00.000Z", "2025-09-01T00:00:00.000Z"),
+    ]
+    facet = sc.post_search.call_args[0][1]["facets"][0]
+    assert facet["type"] == "date_histogram"
+
+    # the aware times are compared in UTC with the naive bucket values
+    utc = timezone.utc
+    assert histogram_partitions(
+        sc, "index", [], datetime(2025, 1, 1, tzinfo=utc), datetime(2025, 9, 1, tzinfo=utc), 4
+    ) == parts
+
+
+def test_facet_partitions():
+
+    parts = facet_partitions("source_id", ["a", "b"])
+
+    assert parts[0] == {"type": "match_any", "field_name": "source_id", "values": ["a"]}
+    assert parts[-1]["type"] == "not"
+    assert parts[-1]["filter"]["values"] == ["a", "b"]
+    assert facet_partitions("source_id", []) == []
+
+
+def test_metadata_export(tmp_path, mocker):
+
+    prov = mocker.patch("metadata_migrate_sync.snapshot.provenance")
+    prov.return_value.prov_file = tmp_path / "prov.json"
+    prov.return_value.model_dump_json.return_value = "{}"
+    mocker.patch("metadata_migrate_sync.snapshot.GlobusClient.get_client", return_value=MagicMock())
+
+    def _run(self):
+        lower = self.query["filters"][-1]["values"][0]["from"]
+        yield {"total": 2, "gmeta": [{"subject": f"{lower}-{n}"} for n in range(2)]}
+
+    mocker.patch.object(GlobusQuery, "run", _run)
+
+    manifest = metadata_export(
+        globus_epname="test",
+        project=ProjectReadWrite.OBS4MIPS,
+        out_dir=tmp_path / "export",
+        time_from=datetime(2025, 1, 1),
+        time_to=datetime(2025, 1, 2),
+        n_partitions=3,
+        max_workers=2,
+    )
+
+    assert manifest["total"] == 6
+    assert [s["shard"] for s in manifest["shards"]] == [f"shard_{n:04d}.ndjson.gz" for n in range(3)]
+
+    on_disk = json.loads((tmp_path / "export" / "manifest.json").read_text())
+    assert on_disk["total"] == 6
+
+    for shard in manifest["shards"]:
+        path = tmp_path / "export" / shard["shard"]
+        assert hashlib.sha256(path.read_bytes()).hexdigest() == shard["sha256"]
+        with gzip.open(path, "rt") as fh:
+            assert len([json.loads(line) for line in fh]) == shard["count"] == 2
+
+
+@pytest.fixture
+def load_env(tmp_path, mocker, gmeta_sample_wrong_type):
+    prov = mocker.patch("metadata_migrate_sync.snapshot.provenance")
+    prov.return_value.prov_file = tmp_path / "prov.json"
+    prov.return_value.db_file = tmp_path / "load.sqlite"
+    prov.return_value.model_dump_json.return_value = "{}"
+    mocker.patch("metadata_migrate_sync.snapshot.LoadConfig.CHUNK_LINES", 2)
+
+    sc = MagicMock(spec=SearchClient)
+    sc.ingest.return_value.data = {"acknowledged": True, "success": True, "task_id": "task"}
+    mocker.patch(
+        "metadata_migrate_sync.snapshot.GlobusClient.get_client", return_value=MagicMock(search_client=sc)
+    )
+
+    shard_dir = tmp_path / "shards"
+    shard_dir.mkdir()
+    gmeta = gmeta_sample_wrong_type["gmeta"][0]
+    with gzip.open(shard_dir / "shard_0000.ndjson.gz", "wt") as fh:
+        for n in range(5):
+            fh.write(json.dumps({**gmeta, "subject": f"s{n}"}) + "\n")
+            # the blank lines count in the progress of the shard
+            if n == 0:
+                fh.write("\n")
+    return sc, shard_dir
+
+
+def _ingested(sc):
+    return [
+        g["subject"] for call in sc.ingest.call_args_list
+        for g in call[0][1]["ingest_data"]["gmeta"]
+    ]
+
+
+def test_metadata_load_resume(load_env):
+
+    sc, shard_dir = load_env
+    kwargs = {
+        "globus_epname": "test", "project": ProjectReadWrite.OBS4MIPS,
+        "shard_dir": shard_dir, "max_workers": 1,
+    }
+
+    # the wrong data types are skipped without the fixes
+    totals = metadata_load(**kwargs, dry_run=True)
+    assert totals["n_skipped"] == 5
+    assert totals["n_ingested"] == 0
+
+    # the dry run does not move the progress
+    sc.ingest.assert_not_called()
+
+    # the second chunk fails
+    acknowledged = MagicMock(data={"acknowledged": True, "success": True})
+    sc.ingest.side_effect = [acknowledged, RuntimeError("boom")]
+    with pytest.raises(RuntimeError):
+        metadata_load(**kwargs, fix_dtype=True)
+
+    sc.ingest.reset_mock(side_effect=True)
+    sc.ingest.return_value = acknowledged
+    totals = metadata_load(**kwargs, fix_dtype=True)
+
+    assert totals["n_ingested"] == 3
+    assert _ingested(sc) == ["s2", "s3", "s4"]
+
+    # all shards are completed
+    sc.ingest.reset_mock()
+    assert metadata_load(**kwargs, fix_dtype=True)["n_ingested"] == 0
+    sc.ingest.assert_not_called()
+
+
+def test_pack_batches_exact_size():
+
+    gmeta_list = [{"subject": f"s{n}", "content": {"n": n}} for n in range(10)]
+    batches = _pack_batches(gmeta_list, 150)
+
+    assert [g for b in batches for g in b] == gmeta_list
+    for batch in batches:
+        size = len(json.dumps({"ingest_type": "GMetaList", "ingest_data": {"gmeta": batch}}))
+        assert size <= 150
+    overfull = batches[0] + batches[1][:1]
+    assert len(json.dumps({"ingest_type": "GMetaList", "ingest_data": {"gmeta": overfull}})) > 150
+
+
+def test_metadata_load_checksum(load_env):
+
+    sc, shard_dir = load_env
+    (shard_dir / "manifest.json").write_text(json.dumps({
+        "shards": [{"shard": "shard_0000.ndjson.gz", "sha256": "0" * 64}],
+    }))
+
+    with pytest.raises(ValueError, match="checksum"):
+        metadata_load(globus_epname="test", project=ProjectReadWrite.OBS4MIPS, shard_dir=shard_dir)
+    sc.ingest.assert_not_called()
+
+
+def test_format_timestamp_aware():
+
+    aware = datetime(2025, 1, 1, 2, tzinfo=timezone(timedelta(hours=2)))
+    assert format_timestamp(aware) == "2025-01-01T00:00:00.000Z"
@@ -0,0 +1,58 @@
+import os
+
+from metadata_migrate_sync.database import MigrationDB, Query
+from metadata_migrate_sync.spool import PageSpool
+
+
+def _page(n):
+    return {
+        "gmeta_ingest": {"ingest_type": "GMetaList", "ingest_data": {"gmeta": [{"subject": f"s{n}"}] * 50}},
+        "new_page": [{"id": f"s{n}"}],
+    }
+
+
+def test_spool_roundtrip(tmp_path):
+
+    spool = PageSpool(tmp_path / "spool")
+    path = spool.put(3, _page(3))
+
+    assert path.endswith("page_00000003.json.gz")
+    assert spool.get(3) == _page(3)
+    assert spool.get(4) is None
+
+
+def test_spool_lru_eviction(tmp_path):
+
+    spool = PageSpool(tmp_path / "spool")
+    for n in range(1, 4):
+        spool.put(n, _page(n))
+        # distinct access times
+        os.utime(spool.path(n), (n, n))
+
+    page_size = spool.path(1).stat().st_size
+
+    # page 1 becomes the most recently used one
+    spool.get(1)
+
+    spool.max_bytes = 3 * page_size
+    spool.put(4, _page(4))
+
+    assert spool.get(2) is None
+    assert spool.get(1) is not None
+    assert spool.get(3) is not None
+    assert spool.get(4) is not None
+    assert spool.size() <= spool.max_bytes
+
+
+def test_spool_link(tmp_path):
+
+    MigrationDB(tmp_path / "spool.sqlite", False)
+
+    with MigrationDB.get_session()() as session:
+        session.add(Query(project="CMIP6", project_type="readonly", query_str="q", pages=1))
+        session.commit()
+
+    PageSpool.link(1, "page_00000001.json.gz")
+
+    with MigrationDB.get_session()() as session:
+        assert session.query(Query).filter_by(pages=1).first().spool_file == "page_00000001.json.gz"
@@ -0,0 +1,129 @@
+from unittest.mock import MagicMock
+
+import pytest
+import requests
+from globus_sdk import GlobusAPIError, SearchClient
+
+from metadata_migrate_sync.context import RunContext
+from metadata_migrate_sync.database import MigrationDB
+from metadata_migrate_sync.subjects import SubjectSnapshot, bucket_range, delete_removed_subjects
+
+SOURCE_ID = "52eff156-6141-4fde-9efe-c08c92f3a706"
+TARGET_ID = "a37bc34d-de15-493b-9221-b95b13114fd8"
+
+
+def _gmeta(subject, timestamp):
+    return {"subject": subject, "entries": [{"content": {"_timestamp": timestamp}}]}
+
+
+def _not_found():
+    response = requests.Response()
+    response.status_code = 404
+    response._content = b'{"code": "NotFound.Generic"}'
+    response.headers["Content-Type"] = "application/json"
+    response.request = requests.Request("GET", "https://search.api.globus.org").prepare()
+    return GlobusAPIError(response)
+
+
+class _StagedIndex:
+    """The subjects of a staged index with their _timestamp."""
+
+    def __init__(self, docs):
+        self.docs = dict(docs)
+        self.listed = []
+
+    def client(self):
+        sc = MagicMock(spec=SearchClient)
+        sc.post_search.side_effect = self._histogram
+        sc.paginated = MagicMock()
+        sc.paginated.scroll.side_effect = self._scroll
+        sc.get_subject.side_effect = self._get_subject
+        return sc
+
+    def _histogram(self, index_id, query):
+        counts = {}
+        for ts in self.docs.values():
+            value = ts[:7] + "-01T00:00:00.000Z"
+            counts[value] = counts.get(value, 0) + 1
+        buckets = [{"value": value, "count": n} for value, n in sorted(counts.items())]
+        return MagicMock(data={"facet_results": [{"buckets": buckets}]})
+
+    def _scroll(self, index_id, query):
+        values = query["filters"][-1]["values"][0]
+        self.listed.append(values["from"][:7])
+        gmeta = [_gmeta(s, ts) for s, ts in self.docs.items() if values["from"] <= ts <= values["to"]]
+        return [MagicMock(data={"gmeta": gmeta})]
+
+    def _get_subject(self, index_id, subject):
+        if subject not in self.docs:
+            raise _not_found()
+        return MagicMock(data=_gmeta(subject, self.docs[subject]))
+
+
+@pytest.fixture
+def delete_db(tmp_path, mocker, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    mocker.patch("metadata_migrate_sync.delete.provenance")
+    mocker.patch("metadata_migrate_sync.subjects.provenance")
+    ctx = RunContext("subjects")
+    with ctx.bind():
+        MigrationDB(tmp_path / "sync.sqlite", False)
+        yield
+    ctx.close()
+
+
+def test_bucket_range():
+    assert bucket_range("2024-02")["values"] == [
+        {"from": "2024-02-01T00:00:00.000Z", "to": "2024-02-29T23:59:59.999Z"}
+    ]
+
+
+def test_delete_removed_subjects(tmp_path, delete_db):
+
+    docs = {f"s{n}": f"2024-0{1 + n % 3}-10T00:00:00.000Z" for n in range(30)}
+    staged = _StagedIndex(docs)
+    snapshot = SubjectSnapshot(tmp_path / "subjects.sqlite", SOURCE_ID)
+    target = MagicMock(spec=SearchClient)
+    target.batch_delete_by_subject.side_effect = lambda index_id, subjects: MagicMock(
+        data={"task_id": subjects[0]}
+    )
+
+    # the first check lists every bucket to fill the snapshot
+    counts = delete_removed_subjects(staged.client(), SOURCE_ID, [], snapshot, target, TARGET_ID)
+    assert (counts["buckets"], counts["listed"], counts["removed"]) == (3, 30, 0)
+    assert snapshot.bucket_counts() == {"2024-01": 10, "2024-02": 10, "2024-03": 10}
+
+    # s0 is deleted, s1 is updated in a newer bucket without a sync
+    del staged.docs["s0"]
+    staged.docs["s1"] = "2024-04-01T00:00:00.000Z"
+    staged.listed = []
+    counts = delete_removed_subjects(
+        staged.client(), SOURCE_ID, [], snapshot, target, TARGET_ID, check_buckets=0
+    )
+
+    # only the changed buckets are listed
+    assert staged.listed == ["2024-01", "2024-02", "2024-04"]
+    assert (counts["removed"], counts["deleted"]) == (1, 1)
+    assert target.batch_delete_by_subject.call_args.kwargs["subjects"] == ["s0"]
+    assert snapshot.bucket_counts() == {"2024-01": 9, "2024-02": 9, "2024-03": 10, "2024-04": 1}
+
+    # nothing changed, only the least recently checked bucket is listed
+    staged.listed = []
+    counts = delete_removed_subjects(
+        staged.client(), SOURCE_ID, [], snapshot, target, TARGET_ID, check_buckets=1
+    )
+    assert (staged.listed, counts["removed"]) == (["2024-03"], 0)
+
+
+def test_delete_fraction_guard(tmp_path, delete_db):
+
+    staged = _StagedIndex({f"s{n}": "2024-01-10T00:00:00.000Z" for n in range(10)})
+    snapshot = SubjectSnapshot(tmp_path / "subjects.sqlite", SOURCE_ID)
+    target = MagicMock(spec=SearchClient)
+    delete_removed_subjects(staged.client(), SOURCE_ID, [], snapshot, target, TARGET_ID)
+
+    # a half empty staged index is not propagated
+    staged.docs = {f"s{n}": "2024-01-10T00:00:00.000Z" for n in range(5)}
+    counts = delete_removed_subjects(staged.client(), SOURCE_ID, [], snapshot, target, TARGET_ID)
+    assert (counts["removed"], counts["deleted"]) == (5, 0)
+    target.batch_delete_by_subject.assert_not_called()
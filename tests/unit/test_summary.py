@@ -0,0 +1,90 @@
+import json
+import sqlite3
+
+from metadata_migrate_sync import summary
+from metadata_migrate_sync.context import RunContext
+from metadata_migrate_sync.database import DaySummary, MigrationDB, PageSummary, Query
+from metadata_migrate_sync.ingest import GlobusIngest
+from metadata_migrate_sync.project import ProjectReadOnly
+
+
+def _summaries(session):
+    pages = {
+        p.pages: (p.n_docs, p.n_submitted, p.n_skipped, p.bytes, p.n_ingests)
+        for p in session.query(PageSummary)
+    }
+    days = [(d.n_pages, d.n_docs, d.n_skipped, d.bytes) for d in session.query(DaySummary)]
+    return pages, days
+
+
+def test_summary(tmp_path, mocker, monkeypatch):
+
+    monkeypatch.chdir(tmp_path)
+    mocker.patch("metadata_migrate_sync.ingest.provenance")
+    db_file = tmp_path / "summary.sqlite"
+
+    ctx = RunContext("summary")
+    with ctx.bind():
+        MigrationDB(db_file, False)
+        with MigrationDB.get_session()() as session, session.begin():
+            for n in (1, 2):
+                session.add(Query(project="CMIP6", project_type="readonly", query_str="{}", pages=n,
+                                  query_time=0.5 * n, date_range="[]"))
+        with MigrationDB.get_session()() as session:
+            pages = session.query(Query).order_by(Query.pages).all()
+
+        ig = GlobusIngest(end_point="52eff156-6141-4fde-9efe-c08c92f3a706", ep_name="test",
+                          project=ProjectReadOnly.CMIP6)
+        for page, docs in zip(pages, (
+            [{"id": "a", "size": 10}, {"id": "b", "size": 20}],
+            [{"id": "c", "size": 30}, {"id": "d", "skip_ingest": True}],
+        )):
+            ig._submitted = True
+            ig._response_data = {"acknowledged": True, "success": True, "task_id": f"task-{page.pages}"}
+            ig.prov_collect(docs, review=False, current_query=page, metatype="files")
+
+        with MigrationDB.get_session()() as session:
+            incremental = _summaries(session)
+            assert incremental == ({1: (2, 2, 0, 30, 1), 2: (2, 1, 1, 30, 1)}, [(2, 4, 1, 60)])
+
+            # the same summaries from the files and ingest tables
+            assert summary.rebuild(session) == 2
+            session.commit()
+            assert _summaries(session) == incremental
+
+            stats = summary.report(session)
+            assert stats["totals"]["n_docs"] == 4
+            assert stats["totals"]["mean_query_time"] == 0.75
+            assert stats["tasks"] == {"submitted": 2, "succeeded": 0, "failed": 0, "pending": 2}
+
+            # a restarted page is taken out
+            summary.drop_pages(session, [2])
+            session.commit()
+            assert _summaries(session) == ({1: (2, 2, 0, 30, 1)}, [(1, 2, 0, 30)])
+    ctx.close()
+
+    # the report reads the database read-only
+    with summary.read_only_session(db_file)() as session:
+        assert not summary.needs_rebuild(session)
+        assert summary.report(session)["totals"]["n_docs"] == 2
+
+    assert summary.write_skipped(db_file, "File", tmp_path / "skipped.ndjson") == 1
+    lines = (tmp_path / "skipped.ndjson").read_text().splitlines()
+    assert [json.loads(line) for line in lines] == [{"id": "d", "date_range": "[]"}]
+
+
+def test_needs_rebuild_read_only(tmp_path):
+
+    db_file = tmp_path / "old.sqlite"
+    with sqlite3.connect(db_file) as conn:
+        conn.execute("CREATE TABLE datasets (id INTEGER PRIMARY KEY)")
+        conn.execute("INSERT INTO datasets (id) VALUES (1)")
+    conn.close()
+
+    with summary.read_only_session(db_file)() as session:
+        assert summary.needs_rebuild(session)
+
+    # no summary table is created
+    with sqlite3.connect(db_file) as conn:
+        assert [name for (name,) in conn.execute("SELECT name FROM sqlite_master")] == ["datasets"]
+    conn.close()
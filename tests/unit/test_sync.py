@@ -1,8 +1,19 @@
 from metadata_migrate_sync.project import ProjectReadWrite
 from metadata_migrate_sync.app import _validate_project
-from metadata_migrate_sync.sync import _setup_time_range_filter
+from metadata_migrate_sync.context import RunContext
+from metadata_migrate_sync.database import Files, MigrationDB, Query, QueryTemplate
+from metadata_migrate_sync.sync import (
+    SyncTargetsError,
+    _fan_out,
+    _last_page_state,
+    _mirror_page,
+    _page_template,
+    _setup_time_range_filter,
+)
 from metadata_migrate_sync.util import get_utc_time_from_server
+from concurrent.futures import ThreadPoolExecutor
 import logging
+import time
 from datetime import datetime
 from pathlib import Path
 import os
@@ -77,3 +88,101 @@ def test_setup_time_range_filter(datadir, input, expected):
             assert time_range["normal"]["values"][0]["from"] == get_utc_time_from_server(ahead_minutes=20)
 
     os.unlink(target)
+
+
+@pytest.fixture
+def two_targets(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    contexts = {name: RunContext(name) for name in ("public", "backup")}
+    for name, ctx in contexts.items():
+        with ctx.bind():
+            MigrationDB(tmp_path / f"{name}.sqlite", False)
+    yield contexts
+    for ctx in contexts.values():
+        ctx.close()
+
+
+def test_mirror_page(tmp_path, two_targets):
+
+    def _read_page():
+        with MigrationDB.get_session()() as session, session.begin():
+            template = QueryTemplate(digest="abc", filters_digest="def", template="{}")
+            query = Query(project="CMIP6", project_type="readwrite", query_str="{}", pages=1,
+                          cursorMark="*", cursorMark_next="next", template=template)
+            session.add(query)
+        with MigrationDB.get_session()() as session:
+            return session.query(Query).first()
+
+    query = two_targets["public"].run(_read_page)
+    template = two_targets["public"].run(_page_template, query)
+    assert template == {"digest": "abc", "filters_digest": "def", "template": "{}"}
+
+    # the page is mirrored once in the database of the other target
+    mirrored = two_targets["backup"].run(_mirror_page, query, template)
+    assert two_targets["backup"].run(_mirror_page, query, template).id == mirrored.id
+    assert (mirrored.pages, mirrored.cursorMark_next) == (1, "next")
+
+    assert _last_page_state(tmp_path / "backup.sqlite") == _last_page_state(tmp_path / "public.sqlite")
+    assert _last_page_state(tmp_path / "other.sqlite") is None
+
+
+def test_mirror_restarted_page(tmp_path, two_targets):
+
+    def _read_page(n_failed):
+        with MigrationDB.get_session()() as session, session.begin():
+            query = session.query(Query).first() or Query(
+                project="CMIP6", project_type="readwrite", query_str="{}", pages=1, n_failed=0,
+                cursorMark="*", cursorMark_next="next",
+            )
+            query.n_failed = n_failed
+            session.add(query)
+        with MigrationDB.get_session()() as session:
+            return session.query(Query).first()
+
+    def _add_skipped(page):
+        with MigrationDB.get_session()() as session, session.begin():
+            session.add(Files(pages=page.pages, files_id="a", success=-9))
+
+    def _n_files():
+        with MigrationDB.get_session()() as session:
+            return session.query(Files).count()
+
+    # the run stopped after the skipped entries of the page, before its ingest rows
+    query = two_targets["public"].run(_read_page, 0)
+    mirrored = two_targets["backup"].run(_mirror_page, query, None)
+    two_targets["backup"].run(_add_skipped, mirrored)
+
+    # the restarted page is cleaned up in the other target too
+    query = two_targets["public"].run(_read_page, 1)
+    mirrored = two_targets["backup"].run(_mirror_page, query, None)
+    assert mirrored.n_failed == 1
+    assert two_targets["backup"].run(_n_files) == 0
+
+
+def test_fan_out_waits_for_every_target():
+
+    class _Target:
+        def __init__(self, name, fail):
+            self.name, self.fail, self.pages = name, fail, []
+            self.logger = logging.getLogger(name)
+
+        def run(self, fn, *args):
+            return fn(*args)
+
+        def ingest_page(self, page):
+            if self.fail:
+                raise RuntimeError(self.name)
+            time.sleep(0.05)
+            self.pages.append(page)
+
+    targets = [_Target("public", True), _Target("backup", False)]
+    with ThreadPoolExecutor(max_workers=2) as executor, pytest.raises(SyncTargetsError, match="public"):
+        _fan_out(executor, targets, "ingest_page", 1)
+    assert targets[1].pages == [1]
+
+    # every failed target is in the error
+    targets = [_Target("public", True), _Target("backup", True)]
+    with ThreadPoolExecutor(max_workers=2) as executor, pytest.raises(SyncTargetsError) as excinfo:
+        _fan_out(executor, targets, "ingest_page", 1)
+    assert list(excinfo.value.errors) == ["public", "backup"]
+    assert "backup: RuntimeError('backup')" in str(excinfo.value)
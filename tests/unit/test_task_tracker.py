@@ -0,0 +1,69 @@
+import threading
+from unittest.mock import MagicMock
+
+import pytest
+from globus_sdk import SearchClient
+
+from metadata_migrate_sync.database import Ingest, MigrationDB
+from metadata_migrate_sync.task_tracker import IngestTaskTracker
+
+
+@pytest.fixture
+def ingest_db(tmp_path):
+    MigrationDB(tmp_path / "tracker.sqlite", True)
+    with MigrationDB.get_session()() as session, session.begin():
+        for task_id in ["t1", "t2", "t3"]:
+            session.add(Ingest(task_id=task_id, n_ingested=1, submitted=1))
+
+
+def _search_client(states):
+    sc = MagicMock(spec=SearchClient)
+    sc.get_task.side_effect = lambda task_id: MagicMock(data={"state": states[task_id]})
+    return sc
+
+
+def test_tracker_poll(ingest_db):
+
+    states = {"t1": "SUCCESS", "t2": "FAILED", "t3": "PENDING"}
+    tracker = IngestTaskTracker(_search_client(states))
+    for task_id in ["t1", "t2", "t3", "skip", None]:
+        tracker.track(task_id)
+    assert tracker.n_pending == 3
+
+    tracker.poll()
+
+    assert tracker.n_pending == 1
+    assert (tracker.n_succeeded, tracker.n_failed) == (1, 1)
+    with MigrationDB.get_session()() as session:
+        rows = {i.task_id: (i.succeeded, i.n_failed) for i in session.query(Ingest)}
+    assert rows == {"t1": (1, None), "t2": (0, 1), "t3": (0, None)}
+
+
+def test_tracker_backpressure(ingest_db):
+
+    states = {"t1": "PENDING", "t2": "PENDING", "t3": "PENDING"}
+    tracker = IngestTaskTracker(_search_client(states), max_pending=2, poll_interval=0.01)
+    tracker.track("t1")
+    tracker.track("t2")
+
+    resumed = threading.Event()
+
+    def _submit():
+        tracker.wait_for_capacity()
+        resumed.set()
+
+    with tracker:
+        submitter = threading.Thread(target=_submit)
+        submitter.start()
+        assert not resumed.wait(0.1)
+
+        # a finished task frees the capacity
+        states["t1"] = "SUCCESS"
+        assert resumed.wait(5)
+        submitter.join()
+
+        states["t2"] = "SUCCESS"
+
+    # the exit waits for the pending tasks
+    assert tracker.n_pending == 0
+    assert tracker.n_succeeded == 2
@@ -0,0 +1,72 @@
+import json
+import threading
+
+from metadata_migrate_sync.database import MigrationDB, Transfer
+from metadata_migrate_sync.transfer import globus_transfer, iter_json_batches
+
+
+class FakeTransferClient:
+    """Tasks finish at their first status check."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.unfinished = set()
+        self.max_unfinished = 0
+        self.submitted = []
+        self.n_ids = 0
+
+    def get_submission_id(self):
+        self.n_ids += 1
+        return {"value": f"sid-{self.n_ids}"}
+
+    def submit_transfer(self, td):
+        with self.lock:
+            task_id = f"task-{td['submission_id']}"
+            self.submitted.append((td["label"], len(td["DATA"])))
+            self.unfinished.add(task_id)
+            self.max_unfinished = max(self.max_unfinished, len(self.unfinished))
+
+        class _Response:
+            data = {"code": "Accepted", "task_id": task_id, "submission_id": td["submission_id"]}
+
+        return _Response()
+
+    def get_task(self, task_id):
+        with self.lock:
+            self.unfinished.discard(task_id)
+        return {"status": "SUCCEEDED"}
+
+
+def test_iter_json_batches(tmp_path):
+
+    json_file = tmp_path / "array.json"
+    json_file.write_text(json.dumps([{"source_path": f"/css03/f{n}.nc"} for n in range(5)]))
+
+    batches = list(iter_json_batches(json_file, "RootArray", per_page=2))
+    assert batches == [["/css03/f0.nc", "/css03/f1.nc"], ["/css03/f2.nc", "/css03/f3.nc"], ["/css03/f4.nc"]]
+
+
+def test_globus_transfer(tmp_path):
+
+    MigrationDB(tmp_path / "transfer.sqlite", False)
+    batches = [[f"/css03/f{n}_{m}.nc" for m in range(3)] for n in range(5)]
+
+    tc = FakeTransferClient()
+    counts = globus_transfer(
+        "llnl", "ornl", batches, "cmip6", max_in_flight=2, max_workers=2, poll_interval=0, tc=tc
+    )
+
+    assert (counts["batches"], counts["files"], counts["succeeded_tasks"]) == (5, 15, 5)
+    assert tc.max_unfinished <= 2
+    assert sorted(tc.submitted) == [(f"cmip6-{n}", 3) for n in range(1, 6)]
+
+    with MigrationDB.get_session()() as session:
+        rows = session.query(Transfer).order_by(Transfer.batch_n).all()
+        assert [(r.batch_n, r.submitted, r.status) for r in rows] == [
+            (n, 1, "SUCCEEDED") for n in range(1, 6)
+        ]
+        assert rows[0].first_path == "/css03/f0_0.nc"
+
+    # the submitted batches are skipped on the rerun
+    counts = globus_transfer("llnl", "ornl", batches, "cmip6", tc=tc)
+    assert (counts["batches"], counts["skipped_batches"]) == (0, 5)
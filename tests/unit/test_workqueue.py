@@ -0,0 +1,100 @@
+import multiprocessing
+import sqlite3
+import time
+from datetime import datetime
+
+import pytest
+
+from metadata_migrate_sync.database import Files, MigrationDB, Query
+from metadata_migrate_sync.workqueue import (
+    WorkQueue,
+    merge_databases,
+    run_unit,
+    run_worker,
+    timestamp_slices,
+)
+
+
+def _fake_runner(unit, unit_dir):
+    """Two pages of two files per unit, in the database of the unit."""
+    db_file = unit_dir / "unit.sqlite"
+    MigrationDB(db_file, False)
+    with MigrationDB.get_session()() as session, session.begin():
+        for page in (1, 2):
+            session.add(Query(project="CMIP6", project_type="readonly", query_str="{}", pages=page))
+            for n in range(2):
+                session.add(Files(pages=page, files_id=f"{unit['spec']['fq']}-{page}-{n}", size=1, success=0))
+    time.sleep(0.2)
+    return {"db_file": str(db_file)}
+
+
+def _worker(queue_file, work_dir, worker):
+    run_worker(WorkQueue(queue_file), work_dir, worker=worker, runner=_fake_runner, heartbeat=0.05)
+
+
+def test_timestamp_slices():
+    slices = timestamp_slices(datetime(2020, 1, 1), datetime(2020, 1, 3), 2, open_start=True)
+    assert slices == [
+        "_timestamp:[* TO 2020-01-02T00:00:00Z}",
+        "_timestamp:[2020-01-02T00:00:00Z TO 2020-01-03T00:00:00Z]",
+    ]
+
+
+def test_lease_expiry(tmp_path):
+    queue = WorkQueue(tmp_path / "queue.sqlite", lease_seconds=0, max_attempts=2)
+    queue.put("migrate", [("slice", {"fq": "a"})])
+
+    first = queue.lease("a")
+    # no heartbeat, the unit is leased again by the next worker
+    second = queue.lease("b")
+    assert (first["id"], second["id"], second["attempts"]) == (1, 1, 2)
+
+    assert not queue.complete(1, "a", {"db_file": None})
+    assert queue.fail(1, "b", "error")
+    assert queue.counts() == {"failed": 1}
+    assert queue.lease("c") is None
+
+
+def test_workers(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    queue_file = tmp_path / "queue.sqlite"
+    queue = WorkQueue(queue_file)
+    queue.put("migrate", [(f"slice {n}", {"fq": f"slice{n}"}) for n in range(6)])
+
+    # local worker processes sharing the queue
+    mp = multiprocessing.get_context("fork")
+    workers = [mp.Process(target=_worker, args=(queue_file, tmp_path, f"w{n}")) for n in range(3)]
+    for p in workers:
+        p.start()
+    for p in workers:
+        p.join(timeout=60)
+        assert p.exitcode == 0
+
+    assert queue.counts() == {"done": 6}
+    with sqlite3.connect(queue_file) as conn:
+        assert len({w for (w,) in conn.execute("SELECT worker FROM work_unit")}) > 1
+
+    assert merge_databases(queue.done_units(), tmp_path / "merged.sqlite") == 12
+    with sqlite3.connect(tmp_path / "merged.sqlite") as conn:
+        pages = conn.execute("SELECT pages, partition FROM query ORDER BY pages").fetchall()
+        assert [p for p, _ in pages] == list(range(1, 13))
+        assert pages[2] == (3, "slice 1")
+        assert conn.execute("SELECT COUNT(DISTINCT files_id), MAX(pages) FROM files").fetchone() == (24, 12)
+        assert conn.execute("SELECT SUM(n_docs) FROM page_summary").fetchone() == (24,)
+
+
+def test_run_unit_failed_pipeline(tmp_path, mocker):
+
+    prov = mocker.patch("metadata_migrate_sync.workqueue.provenance")
+    replica = mocker.patch("metadata_migrate_sync.replica.metadata_replica")
+    unit = {"id": 1, "kind": "replica", "spec": {"project": "CMIP6"}}
+
+    # replica stops at a failed page without raising
+    prov._instance.successful = False
+    with pytest.raises(RuntimeError, match="did not finish"):
+        run_unit(unit, tmp_path)
+    replica.assert_called_once()
+
+    prov._instance.successful = True
+    prov._instance.db_file = "unit.sqlite"
+    assert run_unit(unit, tmp_path) == {"db_file": "unit.sqlite"}